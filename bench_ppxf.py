@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+
+Created on 18/10/26
+
+@author: Carlos Eduardo Barbosa
+
+Benchmark of the pPXF kinematic fits using the MPFIT finite-difference
+derivatives against the analytic derivatives of the LOSVD (keyword jacobian).
+Simulated galaxies are made with the MILES templates, using known kinematics
+and noise, and fitted with the same setup as in run_ppxf.py.
+
+"""
+import time
+
+import numpy as np
+
+from config import *
+from ppxf import ppxf
+from load_templates import stellar_templates
+
+def make_galaxy(templates, velscale, sol, sn, npix, seed=0):
+    """ Simulated log-rebinned galaxy spectrum with Gauss-Hermite LOSVD.
+
+    The galaxy is a random positive combination of the templates, convolved
+    with the LOSVD sol=[V, sigma, h3, h4] in km/s, truncated to npix pixels
+    and with Gaussian noise with given signal-to-noise ratio per pixel. """
+    rng = np.random.RandomState(seed)
+    w = rng.uniform(0, 1, templates.shape[1])
+    w[rng.uniform(0, 1, len(w)) > 0.1] = 0.
+    if not np.any(w):
+        w[0] = 1.
+    star = templates.dot(w)
+    v, s, h3, h4 = np.array(sol) / [velscale, velscale, 1, 1]
+    dx = int(np.ceil(abs(v) + 6 * s))
+    y = (np.arange(-dx, dx + 1) - v) / s
+    losvd = np.exp(-0.5 * y**2) * (1 + h3 / np.sqrt(3) * (y * (2 * y**2 - 3))
+                                 + h4 / np.sqrt(24) * (y**2 * (4 * y**2 - 12) + 3))
+    galaxy = np.convolve(star, losvd / losvd.sum(), mode="same")[:npix]
+    galaxy /= np.median(galaxy)
+    noise = np.ones_like(galaxy) / sn
+    galaxy += rng.normal(0, 1. / sn, npix)
+    return galaxy, noise
+
+def benchmark(templates, velscale, nsim=10, sol=(100., 200., 0.05, -0.03),
+              sn=50., degree=20, npix=None, modes=None):
+    """ Fit nsim simulated spectra with each mode of the kinematic fit.
+
+    Returns a dictionary with the arrays of function evaluations, runtime and
+    fitted kinematics for each mode. """
+    if npix is None:
+        npix = int(0.8 * len(templates))
+    if modes is None:
+        modes = [("finite differences", {}),
+                 ("analytic LOSVD", {"analytic_losvd" : True}),
+                 ("analytic jacobian", {"jacobian" : True})]
+    goodpixels = np.arange(50, npix - 50)
+    results = {}
+    for name, kwargs in modes:
+        nfev, runtime, sols = [], [], []
+        for i in range(nsim):
+            galaxy, noise = make_galaxy(templates, velscale, sol, sn, npix,
+                                        seed=i)
+            t0 = time.time()
+            pp = ppxf(templates, galaxy, noise, velscale, [0., 150.],
+                      goodpixels=goodpixels, moments=4, degree=degree,
+                      mdegree=-1, quiet=True, **kwargs)
+            runtime.append(time.time() - t0)
+            nfev.append(pp.nfev)
+            sols.append(pp.sol)
+        results[name] = {"nfev" : np.array(nfev), "time" : np.array(runtime),
+                         "sol" : np.array(sols)}
+    return results
+
+def check_scale(templates, velscale, scale=1e-17, sol=(100., 200., 0.05, -0.03),
+                sn=50., degree=20, npix=None):
+    """ Fit the same simulated galaxy with the galaxy and the noise multiplied
+    by scale, as for flux-calibrated spectra, which must give the same
+    kinematics, chi2 and relative weights as the fit without scaling.
+
+    Returns the maximum relative differences of the kinematics, the chi2
+    and the weights. """
+    if npix is None:
+        npix = int(0.8 * len(templates))
+    goodpixels = np.arange(50, npix - 50)
+    galaxy, noise = make_galaxy(templates, velscale, sol, sn, npix)
+    fits = [ppxf(templates, galaxy * f, noise * f, velscale, [0., 150.],
+                 goodpixels=goodpixels, moments=4, degree=degree, mdegree=-1,
+                 quiet=True) for f in (1., scale)]
+    dsol = np.max(np.abs(fits[1].sol - fits[0].sol) /
+                  np.maximum(np.abs(fits[0].sol), 1e-3))
+    dchi2 = abs(fits[1].chi2 - fits[0].chi2) / fits[0].chi2
+    w0 = fits[0].weights[degree + 1:]
+    w1 = fits[1].weights[degree + 1:] / scale
+    dw = np.max(np.abs(w1 - w0)) / np.max(np.abs(w0))
+    return dsol, dchi2, dw
+
+def print_results(results, sol):
+    print "{0:<22}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}".format("# Mode", "Nfev",
+          "Time(s)", "dV", "dsigma", "dh4")
+    for name in sorted(results.keys()):
+        r = results[name]
+        bias = np.median(r["sol"], axis=0) - sol
+        print "{0:<22}{1:8.1f}{2:10.3f}{3:10.2f}{4:10.2f}{5:10.3f}".format(
+              name, r["nfev"].mean(), r["time"].mean(), bias[0], bias[1],
+              bias[3])
+
+if __name__ == "__main__":
+    templates = stellar_templates(velscale)[0]
+    templates /= np.median(templates)
+    sol = np.array([100., 200., 0.05, -0.03])
+    results = benchmark(templates, velscale, sol=sol)
+    print_results(results, sol)
+    dsol, dchi2, dw = check_scale(templates, velscale, sol=sol)
+    print "Galaxy and noise scaled by 1e-17: relative differences of " \
+          "{0:.1e} (kinematics), {1:.1e} (chi2), {2:.1e} (weights)".format(
+          dsol, dchi2, dw)
@@ -9,6 +9,9 @@ Study velocity dispersion correction of Lick indices in the Hydra I sample
 
 import os
 import pickle
+import time
+import traceback
+from multiprocessing import Pool, cpu_count
 
 import numpy as np
 import pyfits as pf
@@ -17,7 +20,8 @@ from scipy.interpolate import interp1d
 
 from config import *
 import lector as lector
-from run_ppxf import pPXF
+from run_ppxf import pPXF, fingerprint
+from results_store import ResultsStore, read_table
 
 def correct_indices(indices, inderr, indtempl, indtempl_b, types):
     """ Make corrections for the broadening in the spectra."""
@@ -100,13 +104,20 @@ class BroadCorr:
         return
         
     def __call__(self, sigma, lick): 
-        b = np.zeros(len(lick))
-        for i,l in enumerate(lick):
-            if np.isnan(l):
-                b[i] = 0.
-            else:
-                b[i] = self.fs[i](sigma, l)
-        return b
+        """ Correction factors for the indices lick measured in spectra 
+        with velocity dispersion sigma. 
+        
+        lick can be an array (nspec, 25) with sigma an array (nspec,) or a 
+        scalar, and the corrections have the same shape as lick. """
+        lick = np.asarray(lick, dtype=float)
+        l = np.atleast_2d(lick)
+        sigma = np.broadcast_to(np.ravel(sigma), (len(l),))
+        b = np.zeros_like(l)
+        for i, f in enumerate(self.fs):
+            good = ~np.isnan(l[:,i])
+            if good.any():
+                b[good,i] = f(np.column_stack((sigma[good], l[good,i])))
+        return b.reshape(lick.shape)
 
 class Vdisp_corr_k04():
     """ Correction for LOSVD only for multiplicative indices from
@@ -121,154 +132,308 @@ class Vdisp_corr_k04():
         self.coeff_k04 = np.loadtxt(table, usecols=np.arange(3,10))
         self.lick_indices = np.loadtxt(bands, usecols=(0,), dtype=str)
         self.lick_types = np.loadtxt(bands, usecols=(8,))
-
-    def __call__(self, lick, sigma, h3=0., h4=0.):
-        newlick = np.zeros(25)
-        for i,index in enumerate(lick_indices):
+        # Coefficients and type of correction for each index in BANDS, with
+        # null coefficients for indices without correction
+        self.coeffs = np.zeros((len(self.lick_indices), 7))
+        self.mult = np.zeros(len(self.lick_indices), dtype=bool)
+        for i,index in enumerate(self.lick_indices):
             if index in self.indices_k04:
                 idx = self.indices_k04.index(index)
-                a1, a2, a3, b1, b2, c1, c2 = self.coeff_k04[idx]
-                if self.type_k04[idx] == "m":
-                    C_k04 = 1. + a1 * sigma + a2 * sigma**2 + \
-                            a3 * sigma**3 + b1 * sigma * h3 + \
-                            b2 * sigma**2 * h3 + \
-                            c1 * sigma * h4 + c2 * sigma**2 * h4
-                    newlick[i] = C_k04 * lick[i]
-                else:
-                    C_k04 = a1 * sigma    + a2 * sigma**2 + \
-                            a3 * sigma**3 + b1 * sigma * h3 + \
-                            b2 * sigma**2 * h3 + \
-                            c1 * sigma * h4 + c2 * sigma**2 * h4
-                    newlick[i] = lick[i] + C_k04
-            else:
-                newlick[i] = lick[i]
-        return newlick
+                self.coeffs[i] = self.coeff_k04[idx]
+                self.mult[i] = self.type_k04[idx] == "m"
 
-if __name__ == "__main__":
-    workdir = os.path.join(home, "single2")
-    os.chdir(workdir)
-    if not os.path.exists(os.path.join(workdir, "logs")):
-        os.mkdir(os.path.join(workdir, "logs"))
-    kinfile = "ppxf_results.dat"
-    specs = np.genfromtxt(kinfile, usecols = (0,), dtype=None).tolist()
-    K04 = Vdisp_corr_k04()
+    def __call__(self, lick, sigma, h3=0., h4=0.):
+        """ Corrected indices. lick can be an array (nspec, 25), with sigma, 
+        h3 and h4 either scalars or arrays (nspec,). """
+        lick = np.asarray(lick, dtype=float)
+        sigma, h3, h4 = [np.reshape(x, np.shape(x) + (1,) * (lick.ndim > 1)) 
+                         for x in (sigma, h3, h4)]
+        a1, a2, a3, b1, b2, c1, c2 = self.coeffs.T
+        C_k04 = a1 * sigma + a2 * sigma**2 + \
+                a3 * sigma**3 + b1 * sigma * h3 + \
+                b2 * sigma**2 * h3 + \
+                c1 * sigma * h4 + c2 * sigma**2 * h4
+        return np.where(self.mult, (1. + C_k04) * lick, lick + C_k04)
+
+def load_tables(broad2lick=False):
+    """ Read the tables used in the measurement of the indices.
+
+    The tables are read only once for a run of the pipeline and are shared
+    with the processes of the pool. """
     bands = os.path.join(tables_dir, "BANDS")
-    lick_types = np.loadtxt(bands, usecols=(8,))
-    lick_indices = np.genfromtxt(bands, usecols=(0,), dtype=None).tolist()
+    corrfile = os.path.join(tables_dir, "lickcorr_m.txt")
+    offsetfile = os.path.join(tables_dir, "LICK_OFFSETS.dat")
+    k04file = os.path.join(tables_dir, "kuntschner2004.tab")
+    tables = {"bands" : bands, "broad2lick" : broad2lick,
+              "files" : [bands, corrfile, offsetfile, k04file],
+              "lick_types" : np.loadtxt(bands, usecols=(8,)),
+              "lick_indices" : np.genfromtxt(bands, usecols=(0,),
+                                             dtype=None).tolist(),
+              "bcorr" : BroadCorr(corrfile),
+              "offset" : np.loadtxt(offsetfile, usecols=(1,)).T,
+              "K04" : Vdisp_corr_k04()}
+    # Bands are parsed once here instead of in the first call of lector
+    lector.lick_indices(bands, cols=(0,8,2,3,4,5,6,7))
+    return tables
+
+def measure_spectrum(spec, tables, keeplog=False):
+    """ Measure the Lick indices of one spectrum and apply the corrections.
+
+    ===================
+    Input Parameters
+    ===================
+    spec : str
+        Name of the spectrum, with the pPXF results in the pkl file with
+        the same name in the working directory.
+    tables : dict
+        Tables of the measurement, as returned by load_tables.
+    keeplog : bool
+        Return the record of the measurement to make the logfile.
+
+    ==================
+    Output
+    ==================
+    lick, lick5 : np.array
+        Indices with the corrections using the averages over the templates
+        and the best fit templates, including the offsets.
+    record : dict
+        Record of the measurement, or None if keeplog is False.
+    timings : dict
+        Time in seconds spent in each stage of the measurement.
+    """
+    timings = {}
+    t0 = time.time()
+    bands, lick_types = tables["bands"], tables["lick_types"]
+    setupfile = os.path.join(home, "single1/{0}.setup".format(spec))
+    # Read the spectrum file and pPXF results
+    pp = pPXF(spec, velscale)
+    pp.calc_arrays_emission()
+    pp.sky_sub()
+    if pp.ncomp > 1:
+        v, s, h3, h4 = pp.sol[0]
+    else:
+        v, s, h3, h4 = pp.sol
+    print spec, v, s
+    goodindices = check_intervals(setupfile, bands, v)
+    t1 = time.time()
+    timings["ppxf"] = t1 - t0
+    ##########################################################################
+    # Check problem with broadening
+    bf = interp1d(pp.w_log, pp.bestfit, bounds_error=False,
+                  fill_value="extrapolate")
+    bestfit = bf(pp.w)
+    bfu = interp1d(pp.w_log, pp.bestfit_unbroad, bounds_error=False,
+                  fill_value="extrapolate")
+    bestfitunb = bfu(pp.w)
+    flux = pp.flux
+    ##########################################################################
+    # Broadening of the spectra to the Lick resolution
+    if tables["broad2lick"]:
+        pp.flux = lector.broad2lick(pp.w, pp.flux, 2.1, vel=v)
+        pp.bestfit = lector.broad2lick(pp.w_log, pp.bestfit, 2.54, vel=v)
+        pp.bestfit_unbroad = lector.broad2lick(pp.w_log, pp.bestfit_unbroad,
+                                               2.54, vel=v)
+        flux = lector.broad2lick2(pp.w, pp.flux, 2.1, vel=v)
+        bestfit = lector.broad2lick2(pp.w, bestfit, 2.54, vel=v)
+        bestfitunb = lector.broad2lick2(pp.w, bestfitunb, 2.54, vel=v)
+    noise = pp.flux / pp.noise[0]
+    t2 = time.time()
+    timings["broadening"] = t2 - t1
+    #########################################################################
+    # Make Lick indices measurements
+    #########################################################################
+    # Observed spectrum and best fits are measured together for each
+    # wavelength array
+    noise2 = pp.bestfit / pp.noise[0]
+    noise3 = pp.bestfit_unbroad / pp.noise[0]
+    l_log, tmp = lector.lector(pp.w_log,
+                     np.vstack((pp.bestfit - pp.em,
+                                pp.bestfit_unbroad - pp.em)),
+                     np.vstack((noise2, noise3)), bands, vel = v,
+                     cols=(0,8,2,3,4,5,6,7), keeplog=0, title=spec)
+    lick_bf, lick_bf_unb = l_log
+    ########################################################################
+    # Measure in new specs
+    lin = lector.lector(pp.w,
+                     np.vstack((pp.flux, flux, bestfit, bestfitunb)) -
+                     pp.em_linear, noise, bands, vel = v,
+                     cols=(0,8,2,3,4,5,6,7), title=spec, record=keeplog)
+    lick, lnew, lbf, lbfu = lin[0]
+    lickerrs = lin[1][0]
+    record = lin[2][0] if keeplog else None
+    t3 = time.time()
+    timings["lector"] = t3 - t2
+    ########################################################################
+    # Removing bad indices
+    lick *= goodindices
+    lickerrs *= goodindices
+    lick_bf *= goodindices
+    lick_bf_unb *= goodindices
+    ########################################################################
+    # LOSVD correction using averages over templates
+    lick2 = lick * tables["bcorr"](s, lick)
+    lickerrs2 = lickerrs * tables["bcorr"](s, lick)
+    ########################################################################
+    # LOSVD correction using best fit templates
+    ########################################################################
+    lick3, lickerrs3 = correct_indices(lick, lickerrs, lick_bf_unb, lick_bf,
+                                     lick_types)
+    ##########################################################################
+    # LOSVD correction for some indices using Kuntschner 2004.
+    ##########################################################################
+    lick4 = tables["K04"](lick, s, h3, h4)
+    ##########################################################################
+    # New correction
+    lick5, lickerrs5 = correct_indices(lnew, lickerrs, lbfu, lbf,
+                                     lick_types)
+    ##########################################################################
+    # Offset correction
+    offset = tables["offset"]
+    lick += offset
+    lick2 += offset
+    lick3 += offset
+    lick4 += offset
+    lick5 += offset
+    timings["corrections"] = time.time() - t3
+    return lick, lick5, record, timings
+
+_worker = {}
+
+def _init_worker(tables, keeplog):
+    """ Keep the tables in each process of the pool. With fork, the tables
+    are inherited from the parent and are not read again. """
+    _worker["tables"] = tables
+    _worker["keeplog"] = keeplog
+    return
+
+def _measure_worker(spec):
+    """ Measure one spectrum in a process of the pool.
+
+    Errors are returned instead of raised, so that one bad spectrum does not
+    stop the whole run. """
+    try:
+        out = measure_spectrum(spec, _worker["tables"], _worker["keeplog"])
+    except Exception:
+        return spec, None, traceback.format_exc()
+    return spec, out, None
+
+def run_calc_lick(specs, nprocs=1, broad2lick=False, keeplog=False,
+                  force=False):
+    """ Measure the Lick indices of a list of spectra using a pool of
+    processes.
+
+    ===================
+    Input Parameters
+    ===================
+    specs : list
+        Names of the spectra in the working directory.
+    nprocs : int
+        Number of processes. The spectra are measured in the current process
+        if nprocs is 1.
+    broad2lick : bool
+        Broaden the spectra to the Lick resolution before the measurements.
+    keeplog : bool
+        Make logfiles of the measurements in the logs directory.
+    force : bool
+        Measure all spectra. By default, spectra are skipped if the results
+        in the store were produced with the same inputs.
+
+    ==================
+    Output
+    ==================
+    The tables lick_vdcorr_{res} and lick_novdcorr_{res} are appended to the
+    store and exported, with the rows in the same order as specs regardless
+    of the order in which the processes finish. Returns the list of spectra
+    which could not be measured.
+    """
+    timings = {}
+    t0 = time.time()
+    tables = load_tables(broad2lick)
+    timings["tables"] = time.time() - t0
+    lick_indices = tables["lick_indices"]
     header = "# Spectra\t" + "\t".join(lick_indices)
-    # Initiating outputss
-    results, results_err = [header], [header]
-    results5, results5_err = [header], [header]
-    bcorr = BroadCorr(os.path.join(tables_dir, "lickcorr_m.txt"))
-    offset = np.loadtxt(os.path.join(tables_dir,"LICK_OFFSETS.dat"),
-                        usecols=(1,)).T
-    broad2lick = False
-    for i, spec in enumerate(specs):
+    res = "lickres" if broad2lick else "instres"
+    names = ["lick_vdcorr_{0}".format(res), "lick_novdcorr_{0}".format(res)]
+    ##########################################################################
+    # Spectra are only measured again if any of their inputs changed
+    store = ResultsStore()
+    done, todo, checksums = [], [], {}
+    for spec in specs:
         setupfile = os.path.join(home, "single1/{0}.setup".format(spec))
         if not os.path.exists(setupfile):
             print "Setup file not found: ", setupfile
             continue
-        # Read the spectrum file and pPXF results
-        pp = pPXF(spec, velscale)
-        pp.calc_arrays_emission()
-        pp.sky_sub()
-        if pp.ncomp > 1:
-            v, s, h3, h4 = pp.sol[0]
-        else:
-            v, s, h3, h4 = pp.sol
-        print spec, v, s
-        goodindices = check_intervals(setupfile, bands, v)
-        ######################################################################
-        # Check problem with broadening
-        bf = interp1d(pp.w_log, pp.bestfit, bounds_error=False,
-                      fill_value="extrapolate")
-        bestfit = bf(pp.w)
-        bfu = interp1d(pp.w_log, pp.bestfit_unbroad, bounds_error=False,
-                      fill_value="extrapolate")
-        bestfitunb = bfu(pp.w)
-        flux = pp.flux
-        ######################################################################
-        # Broadening of the spectra to the Lick resolution
-        if broad2lick:
-            pp.flux = lector.broad2lick(pp.w, pp.flux, 2.1, vel=v)
-            pp.bestfit = lector.broad2lick(pp.w_log, pp.bestfit, 2.54, vel=v)
-            pp.bestfit_unbroad = lector.broad2lick(pp.w_log, pp.bestfit_unbroad,
-                                                   2.54, vel=v)
-            flux = lector.broad2lick2(pp.w, pp.flux, 2.1, vel=v)
-            bestfit = lector.broad2lick2(pp.w, bestfit, 2.54, vel=v)
-            bestfitunb = lector.broad2lick2(pp.w, bestfitunb, 2.54, vel=v)
-        noise = pp.flux / pp.noise[0]
-        #####################################################################
-        # Make Lick indices measurements
-        #####################################################################
-        lick, lickerrs = lector.lector(pp.w, pp.flux-pp.em_linear, noise, bands,
-                         vel = v, cols=(0,8,2,3,4,5,6,7),
-                         keeplog=0, output="logs/lick_{0}".format(
-                         spec.replace(".fits", ".pdf")), title=spec)
-        # Measuring Lick indices in the templates
-        noise2 = pp.bestfit / pp.noise[0]
-        lick_bf, tmp = lector.lector(pp.w_log, pp.bestfit - pp.em, noise2, bands,
-                         vel = v, cols=(0,8,2,3,4,5,6,7),
-                         keeplog=0, output="a1.pdf", title=spec)
-        noise3 = pp.bestfit_unbroad / pp.noise[0]
-        lick_bf_unb, tmp = lector.lector(pp.w_log, pp.bestfit_unbroad - pp.em,
-                                         noise3,
-                                        bands, vel = v, cols=(0,8,2,3,4,5,6,7),
-                                        keeplog=0, title=spec)
-        ####################################################################
-        # Measure in new specs
-        noise2 = pp.bestfit / pp.noise[0]
-        lnew, tmp = lector.lector(pp.w, flux-pp.em_linear, noise, bands,
-                         vel = v, cols=(0,8,2,3,4,5,6,7),
-                         keeplog=0, output="logs/lick_{0}".format(
-                         spec.replace(".fits", ".pdf")), title=spec)
-        lbf, tmp = lector.lector(pp.w, bestfit-pp.em_linear, noise, bands,
-                         vel = v, cols=(0,8,2,3,4,5,6,7),
-                         keeplog=0, output="a1.pdf", title=spec)
-        noise3 = pp.bestfit_unbroad / pp.noise[0]
-        lbfu, tmp = lector.lector(pp.w, bestfitunb-pp.em_linear, noise,
-                                        bands, vel = v, cols=(0,8,2,3,4,5,6,7),
-                                        keeplog=0, title=spec)
-        ####################################################################
-        igood = np.array([12,13,16,17,18,19,20])
-        # Removing bad indices
-        lick *= goodindices
-        lickerrs *= goodindices
-        lick_bf *= goodindices
-        lick_bf_unb *= goodindices
-        ####################################################################
-        # LOSVD correction using averages over templates
-        lick2 = lick * bcorr(s, lick)
-        lickerrs2 = lickerrs * bcorr(s, lick)
-        ####################################################################
-        # LOSVD correction using best fit templates
-        ####################################################################
-        lick3, lickerrs3 = correct_indices(lick, lickerrs, lick_bf_unb, lick_bf,
-                                         lick_types)
-        ######################################################################
-        # LOSVD correction for some indices using Kuntschner 2004.
-        ######################################################################
-        lick4 = K04(lick, s, h3, h4)
-        ######################################################################
-        # New correction
-        lick5, lickerrs5 = correct_indices(lnew, lickerrs, lbfu, lbf,
-                                         lick_types)
-        ######################################################################
-        # Offset correction
-        lick += offset
-        lick2 += offset
-        lick3 += offset
-        lick4 += offset
-        lick5 += offset
-        ######################################################################
-        # Convert to string
-        ######################################################################
-        lick = "".join(["{0:14}".format("{0:.5f}".format(x)) for x in lick])
-        lick2 = "".join(["{0:14}".format("{0:.5f}".format(x)) for x in lick2])
-        lick5 = "".join(["{0:14}".format("{0:.5f}".format(x)) for x in lick5])
-        # Append to output
-        results.append("{0:28s}".format(spec) + lick)
-        results5.append("{0:28s}".format(spec) + lick5)
-    res = "lickres" if broad2lick else "instres"
-    save(results5, "lick_vdcorr_{0}.tsv".format(res))
-    save(results, "lick_novdcorr_{0}.tsv".format(res))
\ No newline at end of file
+        specfile = spec if os.path.exists(spec) else \
+                   os.path.join(data_dir, spec)
+        checksums[spec] = fingerprint([spec.replace(".fits", ".pkl"),
+                                      specfile, setupfile] + tables["files"],
+                                      velscale, broad2lick)
+        done.append(spec)
+        if force or not all([store.fingerprint(t, spec) == checksums[spec]
+                             for t in names]):
+            todo.append(spec)
+    ##########################################################################
+    # Logfiles of the measurements are made in the background
+    if keeplog:
+        renderer = lector.LogRenderer(nprocs=2)
+    if nprocs > 1 and len(todo) > 1:
+        pool = Pool(nprocs, _init_worker, (tables, keeplog))
+        outputs = pool.imap(_measure_worker, todo)
+    else:
+        pool = None
+        _init_worker(tables, keeplog)
+        outputs = (_measure_worker(spec) for spec in todo)
+    new, failed, results, results5 = [], [], [], []
+    try:
+        for spec, out, err in outputs:
+            if err is not None:
+                failed.append(spec)
+                done.remove(spec)
+                print "Failed {0}:\n{1}".format(spec, err)
+                continue
+            lick, lick5, record, times = out
+            for stage, t in times.items():
+                timings[stage] = timings.get(stage, 0.) + t
+            if keeplog:
+                renderer.submit(record, "logs/lick_{0}".format(
+                                spec.replace(".fits", ".pdf")), title=spec)
+            new.append(spec)
+            results.append(lick)
+            results5.append(lick5)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if keeplog:
+            renderer.close()
+    print "Measured {0} spectra, {1} unchanged, {2} failed.".format(len(new),
+                                len(done) - len(new), len(failed))
+    ##########################################################################
+    # Results go to the store, and the text tables are exported from it
+    t1 = time.time()
+    for name, table in zip(names, (results5, results)):
+        if new:
+            store.append(name, new, table, columns=lick_indices,
+                         fingerprints=[checksums[x] for x in new])
+        if name in store:
+            store.export(name, name + ".tsv", header=header, spectra=done)
+    timings["store"] = time.time() - t1
+    ##########################################################################
+    # Summary of the timings; the times of the measurements are summed over
+    # the processes
+    print "Timings (s) with {0} processes:".format(nprocs)
+    for stage in ["tables", "ppxf", "broadening", "lector", "corrections",
+                  "store"]:
+        if stage in timings:
+            print "    {0:12s}{1:10.3f}".format(stage, timings[stage])
+    print "    {0:12s}{1:10.3f}".format("total", time.time() - t0)
+    return failed
+
+if __name__ == "__main__":
+    workdir = os.path.join(home, "single2")
+    os.chdir(workdir)
+    if not os.path.exists(os.path.join(workdir, "logs")):
+        os.mkdir(os.path.join(workdir, "logs"))
+    kinfile = "ppxf_results.dat"
+    specs = read_table(kinfile, usecols=(1,))[0]
+    run_calc_lick(specs, nprocs=cpu_count(), broad2lick=False, keeplog=False)
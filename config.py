@@ -18,6 +18,7 @@ data_dir = home + "/data/1d/"
 tables_dir = home + "/tables"
 images_dir = home + "/images"
 figures_dir = home + "/figs"
+cache_dir = template_dir + "/cache" # Log-rebinned templates
 
 # Set some global constants0
 re = 8.4 # Effective radius in kpc, value from Arnaboldi
@@ -9,27 +9,295 @@ Lick indices measurement program.
 Last update: August 6, 2013
 """
 
+import os
+from collections import OrderedDict
+from multiprocessing import Pool
+
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from scipy.interpolate import interp1d
-from scipy.integrate import romb
-from scipy.ndimage.filters import gaussian_filter1d
 from scipy.constants import c
+from scipy import sparse
 
 c /= 1000. # Convert to km / s
 
+def band_matrix(wl, a, b, ncols=None, offset=0):
+    """ Sparse matrix with the weights for the exact integral of the linear 
+    interpolation of a spectrum over the bands [a, b]. 
+    
+    ================
+    Input parameters
+    ================
+    wl : array
+        Wavelenght array of the spectrum.
+    
+    a, b : array
+        Limits of the bands, one band for each row of the matrix. Bands 
+        outside of wl have empty rows.
+    
+    ncols : int
+        Number of columns of the matrix. Default is len(wl).
+    
+    offset : array
+        Column offset of each row, which allows to integrate each band in a 
+        different spectrum of a flattened stack of spectra.
+        
+    =================
+    Output parameters
+    =================
+    csr_matrix
+        Matrix W with shape (len(a), ncols), such that the integral of the 
+        interpolated spectrum f over the bands is W.dot(f).
+        
+    """
+    n = len(wl)
+    inside = (wl[0] <= a) & (b <= wl[-1])
+    k0 = np.searchsorted(wl, a, side="right").clip(1, n) - 1
+    k1 = np.searchsorted(wl, b, side="left").clip(0, n - 1)
+    cnt = np.where(inside, k1 - k0 + 1, 0)
+    rows, cols = _ragged(k0, cnt)
+    x = wl[cols]
+    ar, br = a[rows], b[rows]
+    weights = np.zeros_like(x)
+    # Contributions of the segments to the left and to the right of a pixel
+    for xs, side in ((wl[(cols - 1).clip(0)], 1), 
+                     (wl[(cols + 1).clip(0, n - 1)], -1)):
+        l = np.maximum(np.minimum(x, xs), ar)
+        r = np.minimum(np.maximum(x, xs), br)
+        ok = (r > l) & (xs != x)
+        h = np.where(ok, x - xs, 1.)
+        weights += np.where(ok, (r - l) * (0.5 * (l + r) - xs) / h, 0.)
+    ncols = n if ncols is None else ncols
+    cols = cols + np.broadcast_to(offset, a.shape)[rows]
+    indptr = np.append(0, np.cumsum(cnt))
+    return sparse.csr_matrix((weights, cols, indptr), shape=(len(a), ncols))
+
+def section_matrix(wl, a, b, ncols=None, offset=0):
+    """ Same as band_matrix, with ones for the pixels inside the open 
+    intervals (a, b). """
+    start = np.searchsorted(wl, a, side="right")
+    cnt = (np.searchsorted(wl, b, side="left") - start).clip(0)
+    rows, cols = _ragged(start, cnt)
+    ncols = len(wl) if ncols is None else ncols
+    cols = cols + np.broadcast_to(offset, a.shape)[rows]
+    indptr = np.append(0, np.cumsum(cnt))
+    return sparse.csr_matrix((np.ones(len(cols)), cols, indptr), 
+                             shape=(len(a), ncols))
+
+def _ragged(start, cnt):
+    """ Rows and columns of the cnt[i] consecutive columns starting at 
+    start[i] in each row i. """
+    rows = np.repeat(np.arange(len(cnt)), cnt)
+    cols = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt) \
+         + np.repeat(start, cnt)
+    return rows, cols
+
+def _row_sums(m):
+    """ Matrix which sums the entries of each row of the sparse matrix m, 
+    given as a vector with the same order as m.data. """
+    return sparse.csr_matrix((np.ones(m.nnz), np.arange(m.nnz), m.indptr),
+                             shape=(m.shape[0], m.nnz))
+
+class LickIndices(object):
+    """ Definitions of the indices in a bands file, read only once. 
+    
+    Calling the object measures all the indices in a spectrum, or in a 
+    stack of spectra with one spectrum per row, in the same way as lector:
+    
+        lick = LickIndices(infile, cols=(0,8,2,3,4,5,6,7))
+        results, errors = lick(wl, intens, noise, vel=vel)
+    
+    The integrals of the linear interpolation of the spectrum over the blue, 
+    red and central bands are exact, and their weights are sparse matrices 
+    computed only once for each wavelenght array and velocity, so that the 
+    measurement of all indices reduces to a few matrix products. If vel is 
+    an array with one velocity per spectrum, the matrices are built for the 
+    flattened stack of spectra.
+    
+    """
+    def __init__(self, infile, cols=(0,1,2,3,4,5,6,7)):
+        data = np.loadtxt(infile, usecols=cols, dtype=str, ndmin=2)
+        self.names = data[:,0]
+        self.types = data[:,1].astype(float)
+        self.bands = data[:,2:].astype(float)
+        self._weights = {}
+        
+    def __len__(self):
+        return len(self.names)
+    
+    def weights(self, wl, vel=0):
+        """ Integration weights for the wavelenght array wl and the 
+        velocity vel, which can also be an array with one velocity per 
+        spectrum. Arrays of the indices have shape (nvel, nindex), and only
+        the weights for a single velocity are kept for the next calls. """
+        wl = np.asarray(wl, dtype=float)
+        key = (hash(wl.tostring()), float(vel)) if np.isscalar(vel) else None
+        if key in self._weights:
+            return self._weights[key]
+        vel = np.atleast_1d(vel).astype(float)
+        nvel, npix = len(vel), len(wl)
+        disp = wl[1] - wl[0]
+        w = self.bands * np.sqrt((1 + vel/c)/(1 - vel/c))[:,None,None]
+        inside = (wl[0] <= w[...,0]) & (wl[-1] >= w[...,5])
+        # Each row is one index in one spectrum of the flattened stack
+        offset = np.repeat(np.arange(nvel) * npix, len(self)) if nvel > 1 \
+                 else 0
+        ncols = nvel * npix if nvel > 1 else npix
+        wr = w.reshape(-1, 6)
+        band = lambda a, b: band_matrix(wl, a, b, ncols=ncols, offset=offset)
+        x0 = (w[...,2] + w[...,3])/2.
+        x1 = (w[...,0] + w[...,1])/2.
+        x2 = (w[...,4] + w[...,5])/2.
+        wts = {"nvel" : nvel, "inside" : inside, "disp" : disp, "bands" : w}
+        wts["blue"] = band(wr[:,0], wr[:,1])
+        wts["blue"].data /= np.repeat(wr[:,1] - wr[:,0], 
+                                      np.diff(wts["blue"].indptr))
+        wts["red"] = band(wr[:,4], wr[:,5])
+        wts["red"].data /= np.repeat(wr[:,5] - wr[:,4], 
+                                     np.diff(wts["red"].indptr))
+        ind = band(wr[:,2], wr[:,3])
+        wts["ind"] = ind
+        wts["ind_sum"] = _row_sums(ind)
+        wts["ind_rows"] = np.repeat(np.arange(ind.shape[0]), np.diff(ind.indptr))
+        wts["width"] = wts["ind_sum"].dot(ind.data).reshape(inside.shape)
+        wts["slope"] = (wl[ind.indices % npix] - x1.ravel()[wts["ind_rows"]]) / \
+                       (x2 - x1).ravel()[wts["ind_rows"]]
+        # Pixels used by lector in the S/N of each index
+        sec = sum([section_matrix(wl, wr[:,i] - 2 * disp, 
+                   wr[:,i+1] + 2 * disp, ncols=ncols, offset=offset) 
+                   for i in (0, 2, 4)])
+        sec.data[:] = 1.
+        wts["sec"] = sec
+        wts["sec_sum"] = _row_sums(sec)
+        wts["sec_rows"] = np.repeat(np.arange(sec.shape[0]), np.diff(sec.indptr))
+        wts["nsec"] = np.diff(sec.indptr)
+        # Term C2 of Cardiel et al. 1998 of formula 44 for errors
+        wts["c2"] = np.sqrt( 1 / (w[...,3]- w[...,2]) +
+                  np.power((x1 - x0) / (x1 - x2), 2.) / (w[...,5] - w[...,4]) + 
+                  np.power((x0 - x2) / (x1 - x2), 2.) / (w[...,1] - w[...,0]))
+        if key is not None:
+            if len(self._weights) > 32:
+                self._weights.clear()
+            self._weights[key] = wts
+        return wts
+    
+    def measure(self, wl, intens, noise, vel=0):
+        """ Measure all the indices, returning a dictionary with the indices, 
+        errors, pseudo-continuum fluxes and S/N, with shape (nspec, nindex).
+        
+        intens and noise are arrays with shape (nspec, npix), or a single 
+        spectrum, and vel is either a scalar or an array with one velocity 
+        for each spectrum.
+        """
+        wts = self.weights(wl, vel)
+        intens = np.atleast_2d(intens).astype(float)
+        if wts["nvel"] > 1:
+            intens = np.broadcast_to(intens, (wts["nvel"], intens.shape[1]))
+        noise = np.broadcast_to(noise, intens.shape).astype(float)
+        nspec = len(intens)
+        if wts["nvel"] > 1:
+            intens = intens.reshape(1, -1)
+            noise = noise.reshape(1, -1)
+        dot = lambda m, x: m.dot(x.T).T
+        ind, sec = wts["ind"], wts["sec"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Mean fluxes in the pseudocontinuum and pseudocontinuum vector
+            fp1 = dot(wts["blue"], intens)
+            fp2 = dot(wts["red"], intens)
+            rows = wts["ind_rows"]
+            fc = fp1[:, rows] + (fp2 - fp1)[:, rows] * wts["slope"]
+            flux = dot(wts["ind_sum"], ind.data * intens[:, ind.indices] / fc)
+            # Calculating S/N using Cardiel et al. 1998 formula.
+            nsec = wts["nsec"]
+            mean = dot(sec, noise) / nsec
+            std = np.sqrt(dot(wts["sec_sum"], np.square(noise[:, sec.indices] - 
+                          mean[:, wts["sec_rows"]])) / nsec)
+            sn = dot(sec, intens) / std / (nsec * wts["disp"])
+            fp1, fp2, flux, sn = [a.reshape(nspec, len(self)) for a in 
+                                  (fp1, fp2, flux, sn)]
+            # Calculating index according to type: 0 and 2 in angstroms and
+            # 1 in mags, and respective errors
+            ew = wts["width"] - flux
+            c2 = wts["c2"]
+            c1 = (wts["bands"][...,3] - wts["bands"][...,2]) * c2
+            mag = -2.5 * np.log10(flux / wts["width"])
+            isew = (self.types == 0) | (self.types == 2)
+            results = np.where(isew, ew, 
+                               np.where(self.types == 1, mag, np.nan))
+            errors = np.where(isew, (c1 - c2 * ew) / sn, 
+                      np.where(self.types == 1, 2.5 * c2 * np.log10(np.e) / sn,
+                               np.nan))
+        out = {"results" : results, "errors" : errors, "fp1" : fp1, 
+               "fp2" : fp2, "sn" : sn}
+        for key in out:
+            out[key] = np.where(wts["inside"], out[key], np.nan)
+        return out
+    
+    def diagnostics(self, wl, intens, out, vel=0):
+        """ Diagnostic records of a measurement, one for each spectrum.
+        
+        out is the dictionary returned by measure for the same spectra and 
+        velocities. Each record is a dictionary with the names, types and 
+        observed bands of the indices, the pseudo-continuum fluxes fp1 and 
+        fp2, the S/N, the results and errors, and the segments of the 
+        spectrum (wave and flux) used for each index, which is all that 
+        render_log needs to make the logfile.
+        """
+        wts = self.weights(wl, vel)
+        intens = np.atleast_2d(intens)
+        sec = wts["sec"]
+        records = []
+        for j in range(len(out["results"])):
+            k = j if wts["nvel"] > 1 else 0
+            wave, flux = [], []
+            for i in range(len(self)):
+                r = k * len(self) + i
+                pix = sec.indices[sec.indptr[r]:sec.indptr[r+1]] - \
+                      k * len(wl) * (wts["nvel"] > 1)
+                if not wts["inside"][k,i] or len(pix) == 0:
+                    wave.append(None)
+                    flux.append(None)
+                    continue
+                wave.append(wl[pix[0]:pix[-1]])
+                flux.append(intens[min(j, len(intens) - 1)][pix[0]:pix[-1]])
+            rec = {"names" : self.names, "types" : self.types, 
+                   "bands" : wts["bands"][k], "inside" : wts["inside"][k],
+                   "wave" : wave, "flux" : flux}
+            for key in ("fp1", "fp2", "sn", "results", "errors"):
+                rec[key] = out[key][j]
+            records.append(rec)
+        return records
+    
+    def __call__(self, wl, intens, noise, vel=0):
+        out = self.measure(wl, intens, noise, vel=vel)
+        if np.ndim(intens) == 1 and np.isscalar(vel):
+            return out["results"][0], out["errors"][0]
+        return out["results"], out["errors"]
+
+_lick_indices = {}
+
+def lick_indices(infile, cols=(0,1,2,3,4,5,6,7)):
+    """ Return the LickIndices object for the file infile, which is read only
+    in the first call and shared by all the following ones. """
+    key = (os.path.abspath(infile), tuple(cols), os.path.getmtime(infile))
+    if key not in _lick_indices:
+        _lick_indices[key] = LickIndices(infile, cols=cols)
+    return _lick_indices[key]
+
 def lector(wl, intens, noise, infile, vel=0, cols=(0,1,2,3,4,5,6,7),
            keeplog=False, output="log_lector.pdf", 
            xlabel="Wavelenght [Angstroms]", ylabel="Flux [Counts]",
-           title=None):
+           title=None, record=False):
     """ Make the measurement of Lick indices from file infile in spectrum. 
     
     This function make a direct measurement of the Lick (or any other 
     absorption line feature defines as the Lick indices). The 
     input spectra has to be already broadened to the correct values for 
     the measurement previous to this task. The errors are calculated using 
-    the analytic expressions of Cardiel et al. 1998. 
+    the analytic expressions of Cardiel et al. 1998. The definitions in 
+    infile are read only once and the integrals are computed with the 
+    weights of LickIndices.
     
     ================
     Input parameters 
@@ -39,16 +307,19 @@ def lector(wl, intens, noise, infile, vel=0, cols=(0,1,2,3,4,5,6,7),
         wavelenght parameters.    
               
     intens : array
-        Intensity numpy array. Can be used in arbitrary units (au).
+        Intensity numpy array. Can be used in arbitrary units (au). A 2-D 
+        array with one spectrum per row measures all spectra at once.
         
     noise : array
-        Noise vector in the same units as the intensity vector.  
+        Noise vector in the same units as the intensity vector, or an array 
+        with the same shape as intens.
     
     infile : string
         Filename with definition of indices to be used. See cols.
     
-    vel : float
-        Relative velocity of the object, in km/s. 
+    vel : float or array
+        Relative velocity of the object, in km/s. An array gives one 
+        velocity for each spectrum in intens.
     
     cols : array
         Order of columns in the infile. The required fields are:
@@ -59,7 +330,8 @@ def lector(wl, intens, noise, infile, vel=0, cols=(0,1,2,3,4,5,6,7),
         6. 7. Red continuum (blue and red)
     
     keeplog : bool
-        Boolean mark for keeping a logfile for the measurement.
+        Boolean mark for keeping a logfile for the measurement. Only for a 
+        single spectrum.
     
     output : string
         If the logfile is used, gives the filename for it.
@@ -73,122 +345,123 @@ def lector(wl, intens, noise, infile, vel=0, cols=(0,1,2,3,4,5,6,7),
     title : string
         Title to be used for each plot.
     
+    record : bool
+        Also return the diagnostic records of the measurement (see 
+        LickIndices.diagnostics), which can be turned into logfiles later 
+        with render_log or LogRenderer, outside of the measurement.
+    
     =================
     Output parameters
     =================
     results : array
-        Numpy array with the measured indices. 
+        Numpy array with the measured indices, with shape (nspec, nindex) 
+        if intens is 2-D or vel is an array. 
     
     errors : array
         Numpy array with indice errors according to analytical expressions of 
         Cardiel et al. 1998.
+    
+    records : dict or list
+        Only if record is set, the diagnostic record of the spectrum, or a 
+        list with one record for each spectrum.
         
     """
-    k_order=10.
-    if keeplog:
-        pp = PdfPages(output)
-        plt.figure(1)
-    # Define number of points for integration
-    npoints = 2**k_order + 1
-    # Calculate dispersion
-    disp = wl[1] - wl[0]
-    # Read file for indices definitions
-    indnames = np.loadtxt(infile, usecols = (cols[0],), dtype='|S16')
-    indtype = np.loadtxt(infile, usecols = (cols[1],))
-    indices = np.loadtxt(infile, usecols = cols[2:])
-    # Correct for velocity recession
-    indices *= np.sqrt((1 + vel/c)/(1 - vel/c))
-    # Initiate array of index
-    results = np.empty((len(indnames)))
-    errors = np.empty((len(indnames)))
-    # Measure the indices
-    for i, w in enumerate(indices): 
-        # Test whether indice in defined in the wavelenght domain
-        if wl[0] > w[0] or wl[-1] < w[5]:
-            results[i] = np.nan
-            errors[i] = np.nan
-            continue
-        itype = indtype[i]
-        # Defining indices for each section
-        sec_blue = np.where(((wl > w[0] - 2 * disp) & (wl < w[1] + 2 * disp)))
-        sec_red = np.where(((wl > w[4] - 2 * disp) & (wl < w[5] + 2 * disp)))
-        sec_ind = np.where(((wl > w[2] - 2 * disp) & (wl < w[3] + 2 * disp)))
-        # Defining wavelenght samples
-        w_blue = wl[sec_blue]
-        w_red = wl[sec_red]
-        w_ind = wl[sec_ind]
-        # Defining intensity samples
-        int_blue = intens[sec_blue]
-        int_red = intens[sec_red]
-        int_ind = intens[sec_ind]
-        # Making interpolation functions
-        s_blue = interp1d(w_blue, int_blue, kind="linear")
-        s_red = interp1d(w_red, int_red, kind="linear")
-        # Make oversampled arrays of wavelenghts
-        xblue = np.linspace(w[0], w[1], npoints)
-        xred = np.linspace(w[4], w[5], npoints)
-        xind = np.linspace(w[2], w[3], npoints)
-        # Calculating the mean fluxes for the pseudocontinuum
-        fp1 = romb(s_blue(xblue), dx=xblue[1] - xblue[0])/ (w[1] - w[0])
-        fp2 = romb(s_red(xred), dx=xred[1] - xred[0]) / (w[5] - w[4])
-        # Making pseudocontinuum vector
-        x0 = (w[2] + w[3])/2.
-        x1 = (w[0] + w[1])/2.
-        x2 = (w[4] + w[5])/2.
-        fc = fp1 + (fp2 - fp1)/ (x2 - x1) * (w_ind - x1)
-        # Calculating term C2 of Cardiel et al. 1998 of formula 44 for errors
-        c2 = np.sqrt( 1 / (w[3]- w[2]) +
-                     np.power((x1 - x0) / (x1 - x2), 2.) / (w[5] - w[4]) + 
-                     np.power((x0 - x2) / (x1 - x2), 2.) / (w[1] - w[0]))
-        # Calculating S/N using Cardiel et al. 1998 formula. 
-        sec = np.concatenate((sec_blue[0], sec_ind[0], sec_red[0]))
-        sec = np.unique(sec)
-        SN = np.sum(intens[sec]) / np.std(noise[sec]) / (len(sec) * disp)
-        # Calculating index according to type: 0 and 2 in angstroms and 1 in 
-        # mags, and respective errors
-        if itype in [0,2]:
-            si = interp1d(w_ind, 1 - int_ind / fc, kind="linear")
-            c1 = (w[3] - w[2]) * c2
-            results[i] = romb(si(xind), dx = xind[1] - xind[0])
-            errors[i] = (c1 - c2 * results[i]) / SN
-        elif itype == 1:
-            si = interp1d(w_ind, int_ind / fc, kind="linear")
-
-            results[i] = -2.5 * np.log10(romb(si(xind), 
-                        dx = xind[1] - xind[0]) / (w[3] - w[2]))
-            errors[i] = 2.5 * c2 * np.log10(np.e) / SN
-        # Making the logfile 
-        if keeplog:
-            plt.plot(wl[sec[0]:sec[-1]], intens[sec[0]:sec[-1]], "-k")
-            plt.plot([w[0], w[1]], [fp1, fp1], "-r")
-            plt.plot([w[4], w[5]], [fp2, fp2], "-r")
-            plt.plot([x1, x2], [fp1, fp2], "-.k")
-            s_ind = interp1d(w_ind, int_ind, kind="linear")
-            plt.plot(xind, s_ind(xind), "-r")
-            plt.plot()
-            plt.axvline(x=w[2], ls = "--", c="k")
-            plt.axvline(x=w[3], ls = "--", c="k")
-            plt.ylabel(ylabel)
-            plt.xlabel(xlabel)
-            plt.title(title)
-            rs = np.round(results[i], 3)
-            rserr = np.round(errors[i], 3)
-            units = r"$\AA$" if itype == 0 else ""
-            plt.annotate("I$_{%s}$ = %s$\pm$%s %s\n S/N = %s" % (
-                         indnames[i], rs, rserr, units, np.round(SN, 1)), 
-                         xy = (0.14, 0.82),  xycoords="figure fraction", 
-                         size=14, bbox = dict(boxstyle="square", fc="w"))
-            pp.savefig()
-            plt.clf()
+    single = np.ndim(intens) == 1 and np.isscalar(vel)
+    if keeplog and not single:
+        raise ValueError("keeplog requires a single spectrum and velocity")
+    lick = lick_indices(infile, cols=cols)
+    out = lick.measure(wl, intens, noise, vel=vel)
+    results, errors = out["results"], out["errors"]
+    if single:
+        results, errors = results[0], errors[0]
+    # Making the logfile 
+    if keeplog or record:
+        records = lick.diagnostics(wl, intens, out, vel=vel)
+        if single:
+            records = records[0]
     if keeplog:
-        pp.close()
+        render_log(records, output, xlabel=xlabel, ylabel=ylabel, title=title)
     # Remove non-number results from both results and errors
 #    nans = np.isnan(results)
 #    results[nans]= 99.999
 #    errors[nans] = 99.999
 #    nanserrs = np.isnan(errors)
 #    errors[nanserrs] = 99.999
+    if record:
+        return results, errors, records
     return results, errors
+
+def render_log(record, output, xlabel="Wavelenght [Angstroms]", 
+               ylabel="Flux [Counts]", title=None):
+    """ Make the logfile of lector from a diagnostic record, with one page
+    for each index measured in the spectrum. """
+    fig = plt.figure()
+    pp = PdfPages(output)
+    for i, w in enumerate(record["bands"]):
+        if record["wave"][i] is None:
+            continue
+        wave, flux = record["wave"][i], record["flux"][i]
+        fp1, fp2 = record["fp1"][i], record["fp2"][i]
+        x1 = (w[0] + w[1])/2.
+        x2 = (w[4] + w[5])/2.
+        xind = np.linspace(w[2], w[3], 2**10 + 1)
+        plt.plot(wave, flux, "-k")
+        plt.plot([w[0], w[1]], [fp1, fp1], "-r")
+        plt.plot([w[4], w[5]], [fp2, fp2], "-r")
+        plt.plot([x1, x2], [fp1, fp2], "-.k")
+        plt.plot(xind, np.interp(xind, wave, flux), "-r")
+        plt.axvline(x=w[2], ls = "--", c="k")
+        plt.axvline(x=w[3], ls = "--", c="k")
+        plt.ylabel(ylabel)
+        plt.xlabel(xlabel)
+        plt.title(title)
+        rs = np.round(record["results"][i], 3)
+        rserr = np.round(record["errors"][i], 3)
+        units = r"$\AA$" if record["types"][i] == 0 else ""
+        plt.annotate("I$_{%s}$ = %s$\pm$%s %s\n S/N = %s" % (
+                     record["names"][i], rs, rserr, units, 
+                     np.round(record["sn"][i], 1)), 
+                     xy = (0.14, 0.82),  xycoords="figure fraction", 
+                     size=14, bbox = dict(boxstyle="square", fc="w"))
+        pp.savefig(fig)
+        plt.clf()
+    pp.close()
+    plt.close(fig)
+    return output
+
+class LogRenderer(object):
+    """ Render the logfiles of lector from diagnostic records in a pool of
+    background processes, so that the measurements do not wait for the 
+    plots:
+    
+        renderer = LogRenderer(nprocs=2)
+        l, err, rec = lector(wl, intens, noise, infile, record=True)
+        renderer.submit(rec, "log.pdf", title=spec)
+        ...
+        renderer.close()
+    
+    close waits for all logfiles and raises the first error found.
+    
+    """
+    def __init__(self, nprocs=1):
+        self.pool = Pool(nprocs, initializer=_init_renderer)
+        self.jobs = []
+    
+    def submit(self, record, output, **kwargs):
+        self.jobs.append(self.pool.apply_async(render_log, (record, output),
+                                               kwargs))
+    
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        return [job.get() for job in self.jobs]
+
+def _init_renderer():
+    """ Fonts already loaded by the main process can not be used after the 
+    fork, so each worker loads its own. """
+    from matplotlib import font_manager
+    if hasattr(font_manager, "_get_font"):
+        font_manager._get_font.cache_clear()
     
 def broad2lick(wl, intens, obsres, vel=0):
     """ Convolve spectra to Lick resolution. 
@@ -205,14 +478,16 @@ def broad2lick(wl, intens, obsres, vel=0):
     
     intens: array_like
         Intensity 1-D array of Intensity, in arbitrary units. The lenght has 
-        to be the same as wl. 
+        to be the same as wl. A 2-D array with one spectrum per row is 
+        broadened at once.
         
     obsres: float
         Value of the observed resolution Full Width at Half Maximum (FWHM) in 
         Angstroms.
 
     vel: float
-        Recession velocity of the measured spectrum.
+        Recession velocity of the measured spectrum. The broadening matrix 
+        is taken from broadening_cache, at the center of the velocity bin.
         
     =================
     Output parameters
@@ -221,16 +496,7 @@ def broad2lick(wl, intens, obsres, vel=0):
         The convolved intensity 1-D array.
     
     """
-    wlick = np.array([2000., 4000., 4400., 4900., 5400., 6000., 8000.]) * \
-            np.sqrt((1 + vel/c)/(1 - vel/c))
-    lickres = np.array([11.5, 11.5, 9.2, 8.4, 8.4, 9.8, 9.8])
-    sigma_b = np.sqrt(lickres * lickres - obsres * obsres) / 2.3548
-    sigmas = interp1d(wlick, sigma_b, kind="linear")(wl)
-    intens2D = np.diag(intens)
-    for i in range(len(sigmas)):
-        intens2D[i] = gaussian_filter1d(intens2D[i], sigmas[i], 
-                      mode="constant", cval=0.0)
-    return intens2D.sum(axis=0)
+    return broaden(intens, broadening_cache(wl, obsres, vel=vel))
 
 def broad2lick2(wl, intens, obsres, vel=0):
     """ Convolve spectra to Lick resolution.
@@ -247,14 +513,16 @@ def broad2lick2(wl, intens, obsres, vel=0):
 
     intens: array_like
         Intensity 1-D array of Intensity, in arbitrary units. The lenght has
-        to be the same as wl.
+        to be the same as wl. A 2-D array with one spectrum per row is
+        broadened at once.
 
     obsres: float
         Value of the observed resolution Full Width at Half Maximum (FWHM) in
         Angstroms.
 
     vel: float
-        Recession velocity of the measured spectrum.
+        Recession velocity of the measured spectrum. The broadening matrix
+        is taken from broadening_cache, at the center of the velocity bin.
 
     =================
     Output parameters
@@ -264,17 +532,92 @@ def broad2lick2(wl, intens, obsres, vel=0):
 
     """
     dw = wl[1] - wl[0]
+    return broaden(intens, broadening_cache(wl, obsres, vel=vel, dw=dw))
+
+def lick_sigmas(wl, obsres, vel=0, dw=1.):
+    """ Dispersion of the gaussians which broad a spectrum with resolution 
+    obsres (FWHM in Angstroms) to the Lick resolution, in units of dw. """
     wlick = np.array([2000., 4000., 4400., 4900., 5400., 6000., 8000.]) * \
             np.sqrt((1 + vel/c)/(1 - vel/c))
     lickres = np.array([11.5, 11.5, 9.2, 8.4, 8.4, 9.8, 9.8])
     sigma_b = np.sqrt(lickres * lickres - obsres * obsres) / 2.3548 / dw
-    sigmas = interp1d(wlick, sigma_b, kind="linear")(wl)
-    intens2D = np.diag(intens)
-    for i in range(len(sigmas)):
-        intens2D[i] = gaussian_filter1d(intens2D[i], sigmas[i],
-                      mode="constant", cval=0.0)
-    return intens2D.sum(axis=0)
+    return interp1d(wlick, sigma_b, kind="linear")(wl)
+
+def broadening_matrix(sigmas, truncate=4.0):
+    """ Sparse banded matrix for the broadening with a variable sigma. 
     
+    Column i of the matrix is the kernel of gaussian_filter1d for the 
+    dispersion sigmas[i] (in pixels), centered at pixel i and truncated at 
+    the borders of the spectrum, so that the product with a spectrum is 
+    the same as smoothing each pixel with its own gaussian and adding up 
+    the results. The cost is proportional to the number of pixels times 
+    the size of the kernels.
+    
+    """
+    sigmas = np.asarray(sigmas, dtype=float)
+    n = len(sigmas)
+    radius = (truncate * sigmas + 0.5).astype(int)
+    cnt = 2 * radius + 1
+    cols, rows = _ragged(np.arange(n) - radius, cnt)
+    x = rows - cols
+    kernel = np.exp(-0.5 / np.square(sigmas[cols]) * np.square(x))
+    kernel /= np.bincount(cols, weights=kernel, minlength=n)[cols]
+    good = (rows >= 0) & (rows < n)
+    return sparse.csr_matrix((kernel[good], (rows[good], cols[good])), 
+                             shape=(n, n))
+
+def broaden(intens, matrix):
+    """ Apply a broadening matrix to a spectrum or to a stack of spectra 
+    with one spectrum per row. """
+    return matrix.dot(np.asarray(intens, dtype=float).T).T
+
+class BroadeningCache(object):
+    """ Least recently used cache of the matrices for the broadening to the
+    Lick resolution, keyed on the wavelenght array, the observed resolution 
+    and the velocity.
+    
+    Velocities are rounded to multiples of vbin (in km/s) before building 
+    the matrix, so that spectra with similar velocities share the same 
+    operator. The cache is limited to maxbytes of sparse matrices, and the 
+    least recently used ones are removed first. Use vbin=0 for no rounding.
+    
+    """
+    def __init__(self, maxbytes=2**28, vbin=10.):
+        self.maxbytes = maxbytes
+        self.vbin = vbin
+        self.clear()
+    
+    def clear(self):
+        self._matrices = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def __call__(self, wl, obsres, vel=0, dw=1.):
+        wl = np.asarray(wl, dtype=float)
+        if self.vbin:
+            vel = self.vbin * np.round(vel / self.vbin)
+        key = (hash(wl.tostring()), len(wl), float(obsres), float(vel), 
+               float(dw))
+        if key in self._matrices:
+            self.hits += 1
+            matrix = self._matrices.pop(key)
+            self._matrices[key] = matrix
+            return matrix
+        self.misses += 1
+        matrix = broadening_matrix(lick_sigmas(wl, obsres, vel=vel, dw=dw))
+        self._matrices[key] = matrix
+        self.nbytes += _nbytes(matrix)
+        while self.nbytes > self.maxbytes and len(self._matrices) > 1:
+            key, old = self._matrices.popitem(last=False)
+            self.nbytes -= _nbytes(old)
+        return matrix
+
+def _nbytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+broadening_cache = BroadeningCache()
+
 if __name__ == "__main__":
     pass
     
@@ -9,6 +9,7 @@ Program to load templates from the MILES library for pPXF use.
 
 """
 import os
+import hashlib
 
 import numpy as np
 import pyfits as pf
@@ -33,8 +34,6 @@ def load_templates_regul(velscale):
     h2 = hdu[0].header
     lamRange2 = h2['CRVAL1'] + np.array([0.,h2['CDELT1']*(h2['NAXIS1']-1)])
 
-    sspNew, logLam2, velscale = util.log_rebin(lamRange2, ssp,
-                                               velscale=velscale)
     # Ordered array of metallicities
     Zs = set([x.split("Z")[1].split("T")[0] for x in miles])
     Zs = [float(x.replace("m", "-").replace("p", "")) for x in Zs]
@@ -53,7 +52,6 @@ def load_templates_regul(velscale):
     #
     nAges = len(Ts)
     nMetal = len(Zs)
-    templates = np.empty((sspNew.size,nAges,nMetal))
 
     # Here we make sure the spectra are sorted in both [M/H]
     # and Age along the two axes of the rectangular grid of templates.
@@ -63,17 +61,29 @@ def load_templates_regul(velscale):
     for k in range(nMetal):
         for j in range(nAges):
             filename = "Mun1.30Z{0}T{1}.fits".format(Zs[k], Ts[j])
-            ssp = pf.getdata(filename)
-            sspNew, logLam2, velscale = util.log_rebin(lamRange2, ssp,
-                                                       velscale=velscale)
-            templates[:,j,k] = sspNew # Templates are *not* normalized here
             miles.append(filename)
+    rebin = util.log_rebinner(lamRange2, ssp.size, velscale=velscale)
+    ssps = np.column_stack([pf.getdata(x) for x in miles])
+    templates, logLam2, velscale = rebin(ssps) # Templates are *not* normalized here
+    templates = templates.reshape(-1, nMetal, nAges).transpose(0, 2, 1)
     templates /= np.median(templates) # Normalizes templates by a scalar
     os.chdir(current_dir)
     return templates, logLam2, Ts, Z2, miles, h2['CDELT1']
 
-def stellar_templates(velscale):
-    """ Load files with stellar library used as templates. """
+def stellar_templates(velscale, cache=True):
+    """ Load files with stellar library used as templates.
+
+    The log-rebinned templates are stored in the cache directory and read
+    from there in the following calls, unless cache is False. """
+    files = [x for x in os.listdir(template_dir) if x.startswith("Mun") and
+             x.endswith(".fits")]
+    if not cache:
+        return _stellar_templates(velscale)
+    return cached_templates("stellar", files, velscale, FWHM_tem,
+                            _stellar_templates)
+
+def _stellar_templates(velscale):
+    """ Log-rebin the files of the stellar library. """
     current_dir = os.getcwd()
     # Template directory is also set in config.py
     os.chdir(template_dir)
@@ -108,20 +118,27 @@ def stellar_templates(velscale):
     ssp = hdu[0].data
     h2 = hdu[0].header
     lamRange2 = h2['CRVAL1'] + np.array([0.,h2['CDELT1']*(h2['NAXIS1']-1)])
-    sspNew, logLam2, velscale = util.log_rebin(lamRange2, ssp,
-                                               velscale=velscale)
-    templates = np.empty((sspNew.size,len(miles)))
-    for j in range(len(miles)):
-        hdu = pf.open(miles[j])
-        ssp = hdu[0].data
-        sspNew, logLam2, velscale = util.log_rebin(lamRange2, ssp,
-                                                   velscale=velscale)
-        templates[:,j] = sspNew
+    # All templates share the same grid: rebin them with one operator
+    rebin = util.log_rebinner(lamRange2, ssp.size, velscale=velscale)
+    ssps = np.column_stack([pf.getdata(x) for x in miles])
+    templates, logLam2, velscale = rebin(ssps)
     os.chdir(current_dir)
     return templates, logLam2, h2['CDELT1'], miles
 
-def emission_templates(velscale):
-    """ Load files with stellar library used as templates. """
+def emission_templates(velscale, cache=True):
+    """ Load files with emission lines used as templates.
+
+    The log-rebinned templates are stored in the cache directory and read
+    from there in the following calls, unless cache is False. """
+    files = [x for x in os.listdir(template_dir) if x.startswith("emission")
+             and x.endswith(".fits")]
+    if not cache:
+        return _emission_templates(velscale)
+    return cached_templates("emission", files, velscale, 2.1, # FWHM_tem below
+                            _emission_templates)
+
+def _emission_templates(velscale):
+    """ Log-rebin the files of the emission line templates. """
     current_dir = os.getcwd()
     # Template directory is also set in setyp.py
     os.chdir(template_dir)
@@ -138,19 +155,74 @@ def emission_templates(velscale):
     ssp = hdu[0].data
     h2 = hdu[0].header
     lamRange2 = h2['CRVAL1'] + np.array([0.,h2['CDELT1']*(h2['NAXIS1']-1)])
-    sspNew, logLam2, velscale = util.log_rebin(lamRange2, ssp,
-                                               velscale=velscale)
-    templates = np.empty((sspNew.size,len(emission)))
-    for j in range(len(emission)):
-        hdu = pf.open(emission[j])
-        ssp = hdu[0].data
-        sspNew, logLam2, velscale = util.log_rebin(lamRange2, ssp,
-                                                   velscale=velscale)
-        templates[:,j] = sspNew
+    # All templates share the same grid: rebin them with one operator
+    rebin = util.log_rebinner(lamRange2, ssp.size, velscale=velscale)
+    ssps = np.column_stack([pf.getdata(x) for x in emission])
+    templates, logLam2, velscale = rebin(ssps)
     # templates *= 1e5 # Normalize templates
     os.chdir(current_dir)
     return templates, logLam2, h2['CDELT1'], emission
 
+def cached_templates(name, files, velscale, fwhm, loader):
+    """ Read log-rebinned templates from the cache, or make and cache them.
+
+    ===================
+    Input Parameters
+    ===================
+    name : str
+        Prefix of the files in the cache directory.
+    files : list
+        Files of the library in the template directory.
+    velscale, fwhm : float
+        Velocity scale of the rebinning and resolution of the templates.
+    loader : function
+        Function of velscale returning the templates, logLam2, the
+        wavelength step and the names of the files, as stellar_templates.
+
+    ==================
+    Output
+    ==================
+    Same as loader, but the templates are a copy-on-write memory map of a
+    .npy file, both when they are read from the cache and when they are
+    made, so that they can be changed in place without changing the cache.
+    logLam2, the step and the names are stored in a .npz file. The key of
+    the cache changes with velscale and fwhm and with the name, size and
+    modification time of the files. Entries with the same name, velscale
+    and fwhm made from older versions of the files are removed, while
+    entries with other parameters are kept.
+
+    """
+    params = hashlib.md5("{0!r} {1!r}".format(float(velscale),
+                                              float(fwhm))).hexdigest()
+    md5 = hashlib.md5()
+    for f in sorted(files):
+        st = os.stat(os.path.join(template_dir, f))
+        md5.update("{0} {1} {2!r}\n".format(f, st.st_size, st.st_mtime))
+    prefix = "{0}_{1}_".format(name, params)
+    key = os.path.join(cache_dir, prefix + md5.hexdigest())
+    if os.path.exists(key + ".npy") and os.path.exists(key + ".npz"):
+        meta = np.load(key + ".npz")
+        return np.load(key + ".npy", mmap_mode="c"), meta["logLam2"], \
+               float(meta["delta"]), list(meta["names"])
+    templates, logLam2, delta, names = loader(velscale)
+    ##########################################################################
+    # Write to temporary files and rename them, so that an interrupted or a
+    # concurrent run never reads incomplete files.
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    for old in os.listdir(cache_dir):
+        if old.startswith(prefix) and \
+                not old.startswith(os.path.basename(key)):
+            os.remove(os.path.join(cache_dir, old))
+    tmp = "{0}.{1}.tmp".format(key, os.getpid())
+    with open(tmp, "wb") as f:
+        np.save(f, templates)
+    os.rename(tmp, key + ".npy")
+    with open(tmp, "wb") as f:
+        np.savez(f, logLam2=logLam2, delta=delta, names=names)
+    os.rename(tmp, key + ".npz")
+    return np.load(key + ".npy", mmap_mode="c"), logLam2, delta, names
+
 def emission_line_template(lines, velscale, res=2.54, intens=None, resamp=15,
                            return_log=True):
     lines = np.atleast_1d(lines)
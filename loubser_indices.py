@@ -10,14 +10,14 @@ parameters
 
 """
 import os
-import shutil
 
 import numpy as np
-import pymc
 import scipy.ndimage as ndimage
 
 from config import *
 from mcmc_model import SSP
+from ssp_sampler import run_sampler, hpd
+from results_store import MCStore
 from mcmc_analysis import Dist
 import canvas as cv
 from maps import polar2cart
@@ -116,48 +116,22 @@ def convert_model():
 def calc_populations(data, errs, overwrite=0):
     model_table = os.path.join(tables_dir, "models_thomas_2010_angstroms.dat")
     lims = [[0., 15.], [-2.25, 0.67], [-0.3, 0.5]]
+    ranges = np.array([[1., 14.5], [-2.25, 0.67], [-0.3, 0.5]])
+    indcols = np.arange(12, 19)
+    indcols = indcols[indcols != 14]
+    indcols = indcols[indcols != 15]
+    ssp = SSP(model_table, indcols)
+    names = ["r{0:.2f}".format(r) for r in radius]
+    store = run_sampler(ssp, names, data[:,indcols], errs[:,indcols], ranges,
+                        "loubser_chains", nsteps=600, burn=300, thin=3,
+                        force=overwrite)
     pops = []
-    for i in range(len(data)):
-        age_dist = pymc.Uniform(name="age_dist", lower=1., upper=14.5)
-        metal_dist = pymc.Uniform(name="metal_dist", lower=-2.25, upper=0.67)
-        alpha_dist = pymc.Uniform(name="alpha_dist", lower=-0.3, upper=0.5)
-        indcols = np.arange(12, 19)
-        indcols = indcols[indcols != 14]
-        indcols = indcols[indcols != 15]
-        ssp = SSP(model_table, indcols)
-        taus = 1 / errs[i]**2
-        obsdata = data[i]
-        obsdata = obsdata[indcols]
-        taus = taus[indcols]
-
-        @pymc.deterministic()
-        def ssp1(age=age_dist, metal=metal_dist, alpha=alpha_dist):
-            return ssp(age, metal, alpha)
-        y = pymc.Normal(name="y", mu=ssp1, tau=taus,
-                        value=obsdata, observed=True)
-        dbname = "r{0:.2f}.db".format(radius[i])
-        model = pymc.Model([y, age_dist, metal_dist, alpha_dist])
-        if overwrite:
-            shutil.rmtree(dbname)
-        if not os.path.exists(dbname):
-            mcmc = pymc.MCMC(model, db="txt", dbname=dbname)
-            mcmc.sample(10000, 1000, 3)
-            mcmc.db.close()
-            mcmc.summary()
-        db = pymc.database.txt.load(dbname)
-        mcmc = pymc.MCMC(model, db=db)
-        ages = mcmc.trace("age_dist")[:]
-        metals = mcmc.trace("metal_dist")[:]
-        alphas = mcmc.trace("alpha_dist")[:]
-        mcmc_results = mcmc.stats(alpha=0.3173105)
-        age_min, age_max = mcmc_results["age_dist"]['68% HPD interval']
-        metal_min, metal_max = mcmc_results["metal_dist"]['68% HPD interval']
-        alpha_min, alpha_max = mcmc_results["alpha_dist"]['68% HPD interval']
-        distage = Dist(ages, lims[0])
-        distmetal = Dist(metals, lims[1])
-        distalpha = Dist(alphas, lims[2])
-        s = [distage.MAPP, age_min, age_max, distmetal.MAPP, metal_min,
-             metal_max, distalpha.MAPP, alpha_min, alpha_max]
+    for name in names:
+        chain = np.array(store.read(name), dtype=float)
+        s = []
+        for i in range(3):
+            dist = Dist(chain[:,i], lims[i])
+            s += [dist.MAPP] + list(hpd(chain[:,i], alpha=0.3173105))
         pops.append(s)
     pops = np.column_stack((radius, np.array(pops), sb))
     with open(os.path.join(tables_dir, "loubser12_populations.dat"), "w") as f:
@@ -189,15 +163,14 @@ if __name__ == "__main__":
     # calc_populations(indices, errs, overwrite=1)
     #########################################################################
     # Analysis of Chains
+    store = MCStore("loubser_chains")
     results = []
     for r,s in zip(np.around(radius, 2), sb):
-        db = r"r{0}.db".format(r)
-        ages_data = np.loadtxt("{0}/Chain_0/age_dist.txt".format(db))
+        chain = np.array(store.read("r{0:.2f}".format(r)), dtype=float)
+        ages_data, metal_data, alpha_data = chain.T
         ages_data = np.log10(ages_data)
         ages = Dist(ages_data, [np.log10(1),np.log10(15)])
-        metal_data = np.loadtxt("{0}/Chain_0/metal_dist.txt".format(db))
         metal = Dist(metal_data, [-2.25, 0.67])
-        alpha_data = np.loadtxt("{0}/Chain_0/alpha_dist.txt".format(db))
         alpha = Dist(alpha_data, [-0.3, 0.5])
         line = [r, ages.MAPP, ages.MAPPmin, ages.MAPPmax, metal.MAPP,
                 metal.MAPPmin, metal.MAPPmax, alpha.MAPP, alpha.MAPPmin,
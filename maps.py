@@ -28,6 +28,7 @@ import brewer2mpl
 
 from config import *
 import newcolorbars as nc
+from results_store import read_table
 import canvas as cv
 import cap_loess_2d as ll
 from voronoi_polygons import voronoi_polygons
@@ -129,12 +130,14 @@ def merge_tables():
              "mc_lick_nsim400.txt",
              os.path.join(tables_dir, "sb_vband_single1.txt"),
              os.path.join(tables_dir, "sb_res_single1.txt")]
-    s1 = np.genfromtxt(files[0], usecols=(0,), dtype=None).tolist()
-    s2 = np.genfromtxt(files[1], usecols=(0,), dtype=None).tolist()
-    s3 = np.genfromtxt(files[2], usecols=(0,), dtype=None).tolist()
-    s4 = np.genfromtxt(files[3], usecols=(0,), dtype=None).tolist()
-    s5 = np.genfromtxt(files[4], usecols=(0,), dtype=None).tolist()
-    s6 = np.genfromtxt(files[5], usecols=(0,), dtype=None).tolist()
+    ##########################################################################
+    # Loading files, from the results store when the tables are there
+    s1, data1 = read_table(files[0], usecols=np.arange(1,11))
+    s2, data2 = read_table(files[1], usecols=np.arange(1,26))
+    s3, data3 = read_table(files[2], usecols=(1,2,3,5,6,7,9,10,11))
+    s4, data4 = read_table(files[3], usecols=np.arange(1,26))
+    s5, data5 = read_table(files[4], usecols=(1,))
+    s6, data6 = read_table(files[5], usecols=(1,))
     sref = list(set(s1) & set(s2) & set(s3) & set(s4) & set(s5) & set(s6))
     ignore = ["fin1_n3311{0}.fits".format(x) for x in ignore_slits]
     sref = [x for x in sref if x not in ignore]
@@ -156,7 +159,6 @@ def merge_tables():
 #         x, y = coords.T
     r = np.sqrt(x*x + y*y)
     pa = np.rad2deg(np.arctan2(x, y))      
-    data1 = np.loadtxt(files[0], usecols=np.arange(1,11))
     c = 299792.458
     ##########################################################################
     # Account for difference in resolution
@@ -164,13 +166,6 @@ def merge_tables():
     # fwhm_dif = (2.5 - 2.1) * c / 5500. / 2.3548
     # data1[:,2] = np.sqrt(data1[:,2]**2 - fwhm_dif**2)
     ##########################################################################
-    # Loading files
-    data2 = np.loadtxt(files[1], usecols=np.arange(1,26))
-    data3 = np.loadtxt(files[2], usecols=(1,2,3,5,6,7,9,10,11))
-    data4 = np.loadtxt(files[3], usecols=np.arange(1,26))
-    data5 = np.loadtxt(files[4], usecols=(1,))
-    data6 = np.loadtxt(files[5], usecols=(1,))
-    ##########################################################################
     # Homogenization of the data
     data1 = match_data(s1, sref, data1)
     data2 = match_data(s2, sref, data2)
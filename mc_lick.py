@@ -8,6 +8,9 @@ Make simulations to derive errors on Lick indices including both noise and the
 error on the determined velocity.
 """
 import os
+import time
+import Queue
+import traceback
 
 import numpy as np
 import multiprocessing as mp
@@ -16,16 +19,18 @@ from scipy.stats import nanmedian
 from config import *
 import lector
 from calc_lick import BroadCorr
-from run_ppxf import pPXF, speclist
-
-def run_mc(spec, i):
-    """ Run MC routine in single spectrum. """
-    outname = "mc_logs/{0}_nsim{1}.txt".format(spec.replace(".fits", ""),
-                                               Nsim)
-    output = os.path.join(wdir, outname)
-    if os.path.exists(output):
-        return
-    print "{0} ({1}/{2})".format(spec, i+1, len(specs))
+from run_ppxf import pPXF, speclist, fingerprint
+from results_store import ResultsStore, MCStore, mc_converged
+
+# Columns of the indices H_beta, Fe5015, Mg_b, Fe5270, Fe5335, Fe5406 and
+# Fe5709, used in the models
+mc_cols = np.array([12, 13, 16, 17, 18, 19, 20])
+
+def load_mc_spectrum(spec):
+    """ Read the pPXF results of a spectrum used in the simulations.
+
+    Returns the pPXF object, the emission line spectrum and the solution and
+    errors of the first component. """
     pp = pPXF(spec, velscale)
     sn = pp.calc_sn()
     #####################################################################
@@ -45,48 +50,247 @@ def run_mc(spec, i):
     else:
         sol = pp.sol
         error = pp.error
-    ##########################################################################
+    return pp, em, sol, error
+
+def run_mc(spectrum, nsim, bands, bcorr, seed=None):
+    """ Run MC routine in single spectrum.
+
+    ===================
+    Input Parameters
+    ===================
+    spectrum : tuple
+        Output of load_mc_spectrum.
+    nsim : int
+        Number of simulations.
+    bands : str
+        BANDS file with the definition of the indices.
+    bcorr : BroadCorr
+        Correction of the indices for the velocity dispersion.
+    seed : int
+        Seed of the random numbers of the simulations.
+
+    ==================
+    Output
+    ==================
+    Array (nsim, 25) with the indices of the simulations, or None if the
+    velocity dispersion of the spectrum is unconstrained.
+    """
+    pp, em, sol, error = spectrum
     if error[1] == 0.0:
-        print "Skiped galaxy: unconstrained sigma."
-        return
-    ##########################################################################
-    lick_sim = np.zeros((Nsim, 25))
-    vpert = np.random.normal(sol[0], error[0], Nsim)
-    sigpert = np.random.normal(sol[1], error[1], Nsim)
-    for j in np.arange(Nsim):
-        noise_sim = np.random.normal(0, pp.noise, len(pp.bestfit))
-        obs_sim = lector.broad2lick(pp.w, pp.bestfit + noise_sim - em,
-                                    2.54, vel=vpert[j])
-        l, err = lector.lector(pp.w, obs_sim, noise_sim, bands, vel = vpert[j],
-                               cols=(0,8,2,3,4,5,6,7), keeplog=0)
-        lick_sim[j] = l * bcorr(sigpert[j], l)
-    with open(output, "w") as f:
-        np.savetxt(f, lick_sim)
-    print "Finished MC for {0}.".format(spec)
+        return None
+    rng = np.random.RandomState(seed)
+    vpert = rng.normal(sol[0], error[0], nsim)
+    sigpert = rng.normal(sol[1], error[1], nsim)
+    noise_sim = rng.normal(0, pp.noise, (nsim, len(pp.bestfit)))
+    obs_sim = np.zeros_like(noise_sim)
+    for j in np.arange(nsim):
+        obs_sim[j] = lector.broad2lick(pp.w, pp.bestfit + noise_sim[j] - em,
+                                       2.54, vel=vpert[j])
+    l, err = lector.lector(pp.w, obs_sim, noise_sim, bands, vel = vpert,
+                           cols=(0,8,2,3,4,5,6,7), keeplog=0)
+    lick_sim = l * bcorr(sigpert, l)
+    return lick_sim
+
+def mc_store(Nsim, outdir="mc_logs"):
+    """ Store of the simulations of all spectra with Nsim simulations. """
+    return MCStore(os.path.join(outdir, "lick_nsim{0}".format(Nsim)), Nsim)
+
+def chunk_seed(spec, k, seed=0):
+    """ Seed of the k-th chunk of simulations of a spectrum.
+
+    The seed depends only on the spectrum, the chunk and the global seed, so
+    that the simulations do not depend on the number of processes or on the
+    order in which the chunks are run. """
+    return int(fingerprint([], spec, k, seed)[:8], 16)
+
+_worker = {}
+
+def _init_worker(bands, bcorr):
+    """ Keep the tables in each process of the pool. """
+    _worker["bands"] = bands
+    _worker["bcorr"] = bcorr
     return
 
+def _mc_worker(task):
+    """ Run one chunk of simulations in a process of the pool.
+
+    The pPXF results of the last spectrum are kept in the process, so that
+    consecutive chunks of the same spectrum read the pkl file only once.
+    Errors are returned instead of raised, so that one bad spectrum does not
+    stop the whole run. """
+    spec, k, start, nsim, seed, basename, Nsim = task
+    t0 = time.time()
+    try:
+        if _worker.get("spec") != spec:
+            _worker["spectrum"] = load_mc_spectrum(spec)
+            _worker["spec"] = spec
+        lick_sim = run_mc(_worker["spectrum"], nsim, _worker["bands"],
+                          _worker["bcorr"], seed=seed)
+        if lick_sim is None:
+            return spec, k, "Skiped galaxy: unconstrained sigma.", \
+                   time.time() - t0
+        MCStore(basename, Nsim).write(spec, start, lick_sim)
+    except Exception:
+        return spec, k, traceback.format_exc(), time.time() - t0
+    return spec, k, None, time.time() - t0
+
+def _next_chunks(store, spec, chunk, rtol, cols, nmin=None):
+    """ Chunks of simulations of a spectrum to be run next.
+
+    All missing chunks are returned if rtol is None. Otherwise, chunks are
+    run one at a time and the spectrum is finished as soon as the MADs of
+    the columns cols converge (see mc_converged). """
+    filled = store.filled(spec)
+    missing = [k for k in range(int(np.ceil(store.nsim / float(chunk))))
+               if not filled[k*chunk:(k+1)*chunk].all()]
+    if rtol is None or not missing:
+        return missing
+    n = np.argmin(filled)
+    if mc_converged(store.read(spec)[:n,cols], rtol, nmin):
+        store.finish(spec, n)
+        return []
+    return missing[:1]
+
+def run_mc_pool(specs, Nsim, bands, bcorr, chunk=25, nprocs=None, seed=0,
+                outdir="mc_logs", rtol=None, cols=mc_cols, nmin=None):
+    """ Run the simulations of a list of spectra using a pool of processes.
+
+    ===================
+    Input Parameters
+    ===================
+    specs : list
+        Names of the spectra in the working directory.
+    Nsim : int
+        Number of simulations of each spectrum (maximum number if rtol is
+        set).
+    bands, bcorr :
+        Same as in run_mc.
+    chunk : int
+        Number of simulations in each task, so that the work of spectra with
+        many pixels is shared between the processes.
+    nprocs : int
+        Number of processes. Default is the number of CPUs.
+    seed : int
+        Global seed of the simulations, see chunk_seed.
+    outdir : str
+        Directory of the outputs.
+    rtol : float
+        Stop the simulations of a spectrum when the bootstrap standard
+        errors of the MADs of all indices in cols are smaller than rtol
+        times the MADs (see mc_converged). The chunks of each spectrum are
+        then run one after the other, and different spectra are run in
+        parallel. For normal errors, the standard error of the MAD is about
+        1.17 MAD / sqrt(n), so that the simulations never stop before Nsim
+        if rtol is below 1.17 / sqrt(Nsim), e.g. 0.12 for Nsim=100.
+    cols : array
+        Columns of the indices used to check the convergence.
+    nmin : int
+        Minimum number of simulations of each spectrum if rtol is set.
+        Default is the number needed by normal errors, (1.17 / rtol)**2.
+
+    ==================
+    Output
+    ==================
+    Each chunk is written to the store of the simulations (see mc_store) as
+    soon as it is done, and only the missing chunks are run again in the
+    next call. The number of simulations of each spectrum is kept in the
+    store (see MCStore.achieved), and the running MADs of the columns cols
+    after each chunk are saved in {outdir}/lick_nsim{Nsim}_trace.npz, with
+    one array (nchunks, 1 + len(cols)) for each spectrum, where the first
+    column is the number of simulations. Returns the list of spectra with
+    failed chunks.
+    """
+    store = mc_store(Nsim, outdir)
+    store.add(specs)
+    done = store.done()
+    pool = mp.Pool(nprocs, _init_worker, (bands, bcorr))
+    results = Queue.Queue()
+    def submit(spec, k):
+        start = k * chunk
+        task = (spec, k, start, min(chunk, Nsim - start),
+                chunk_seed(spec, k, seed), store.basename, Nsim)
+        pool.apply_async(_mc_worker, (task,), callback=results.put)
+    ##########################################################################
+    failed, skipped, times = [], [], []
+    t0 = time.time()
+    pending = 0
+    try:
+        for spec in specs:
+            if spec in done:
+                continue
+            for k in _next_chunks(store, spec, chunk, rtol, cols, nmin):
+                submit(spec, k)
+                pending += 1
+        print "MC of {0} spectra in chunks of {1} simulations".format(
+              len([x for x in specs if x not in done]), chunk)
+        while pending:
+            spec, k, err, dt = results.get()
+            pending -= 1
+            times.append(dt)
+            if err is None:
+                print "Done {0} chunk {1} in {2:.2f} s".format(spec, k, dt)
+                # In the adaptive mode, the next chunk of the spectrum is
+                # only submitted after the check of convergence
+                if rtol is not None:
+                    for k in _next_chunks(store, spec, chunk, rtol, cols,
+                                          nmin):
+                        submit(spec, k)
+                        pending += 1
+            elif err.startswith("Skiped"):
+                if spec not in skipped:
+                    skipped.append(spec)
+                    print "{0}: {1}".format(spec, err)
+            else:
+                if spec not in failed:
+                    failed.append(spec)
+                print "Failed {0} chunk {1}:\n{2}".format(spec, k, err)
+    finally:
+        pool.close()
+        pool.join()
+    if times:
+        print "Ran {0} chunks in {1:.1f} s, {2:.2f} s per chunk " \
+              "(max {3:.2f} s)".format(len(times), time.time() - t0,
+                                       np.mean(times), np.max(times))
+    if skipped:
+        print "Skipped {0} spectra: unconstrained sigma.".format(len(skipped))
+    ##########################################################################
+    # Record the convergence of the simulations
+    tracefile = os.path.join(outdir, "lick_nsim{0}_trace.npz".format(Nsim))
+    traces = {}
+    if os.path.exists(tracefile):
+        with np.load(tracefile) as f:
+            traces.update(f)
+    for spec in specs:
+        ns, trace = store.running_mad(spec, chunk, cols)
+        if len(ns):
+            traces[spec] = np.column_stack((ns, trace))
+    np.savez(tracefile, **traces)
+    names = store.spectra
+    nsims = store.achieved()[[names.index(x) for x in specs]]
+    if np.any(nsims > 0):
+        print "MC complete for {0} of {1} spectra, with {2}-{3} simulations " \
+              "(median {4:.0f})".format(np.sum(nsims > 0), len(specs),
+              nsims[nsims > 0].min(), nsims[nsims > 0].max(),
+              np.median(nsims[nsims > 0]))
+    return failed
+
 def table_header():
      return "# Spectra\tHd_A\tHd_F\tCN_1\tCN_2\tCa4227\tG4300\tHg_A\tHg_F" \
            "\tFe4383\tCa4455\tFe4531\tCe4668\tH_beta\tFe5015\tMg_1\tMg_2\t" \
             "Mg_b\tFe5270\t	Fe5335\tFe5406\tFe5709\tFe5782\tNa_D\t" \
              "TiO_1\tTiO_2\n"
 
-def write_table(specs, Nsim):
-    results = []
-    for i, spec in enumerate(specs):
-        outname = "mc_logs/{0}_nsim{1}.txt".format(spec.replace(".fits", ""),
-                                                   Nsim)
-        output = os.path.join(wdir, outname)
-        if not os.path.exists(output):
-            continue
-        data = np.loadtxt(output)
-        median =np.median(data, axis=0)
-        mad = 1.4826 * np.median(np.abs(data - median), axis=0)
-        line = "{0:26s}".format(spec) + \
-               "".join(["{0:10s}".format("{0:.5f}".format(x)) for x in mad])
-        results.append(line)
-    with open("mc_lick_nsim{0}.txt".format(Nsim), "w") as f:
-        f.write("\n".join(results))
+def write_table(specs, Nsim, bands, outdir="mc_logs"):
+    """ Store the MAD of the simulations of each spectrum in the results 
+    store and export the table as text, with the names of the indices in
+    the BANDS file bands as columns. """
+    lick_indices = np.genfromtxt(bands, usecols=(0,), dtype=None).tolist()
+    done, results = mc_store(Nsim, outdir).mad(specs)
+    table = "mc_lick_nsim{0}".format(Nsim)
+    store = ResultsStore()
+    store.append(table, done, results, columns=lick_indices)
+    store.export(table, table + ".txt", namefmt="{0:26s}", fmt="{0:<10.5f}",
+                 spectra=done)
     return
 
 if __name__ == "__main__":
@@ -102,13 +306,5 @@ if __name__ == "__main__":
     lick_indices = np.genfromtxt(bands, usecols=(0,), dtype=None).tolist()
     Nsim = 100
     header = table_header()
-    if True:
-        pool = mp.Pool()
-        for i, spec in enumerate(specs):
-            pool.apply_async(run_mc, args=(spec, i))
-            # print spec
-            # run_mc(spec, i)
-            # break
-        pool.close()
-        pool.join()
-    write_table(specs, Nsim)
+    run_mc_pool(specs, Nsim, bands, bcorr, chunk=25, rtol=0.2)
+    write_table(specs, Nsim, bands)
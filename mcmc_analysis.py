@@ -23,6 +23,7 @@ from sklearn.mixture import GMM
 
 from config import *
 from run_ppxf import speclist
+from results_store import MCStore
 
 class Dist():
     """ Simple class to handle the distribution data of MCMC. """
@@ -177,23 +178,36 @@ if __name__ == "__main__":
     plt.minorticks_on()
     table_summary, table_results = [], []
     sndata = dict(np.loadtxt("ppxf_results.dat", usecols=(0,10), dtype=str))
+    # Chains of the ssp_sampler runs, and pymc databases of older runs
+    basename = os.path.join(working_dir, "ssp_chains{0}".format(db))
+    if os.path.exists(basename + ".shape"):
+        store = MCStore(basename)
+        done = store.done()
+    else:
+        done = []
     for spec in specs:
         print spec
         # continue
         folder = spec.replace(".fits", "_db{0}".format(db))
-        if not os.path.exists(os.path.join(working_dir, folder)):
+        if spec in done:
+            ages_data, metal_data, alpha_data = np.array(store.read(spec),
+                                                         dtype=float).T
+            if not os.path.exists(os.path.join(working_dir, folder)):
+                os.mkdir(os.path.join(working_dir, folder))
+        elif os.path.exists(os.path.join(working_dir, folder)):
+            os.chdir(os.path.join(working_dir, folder))
+            ages_data = np.loadtxt("Chain_0/age_dist.txt")
+            metal_data = np.loadtxt("Chain_0/metal_dist.txt")
+            alpha_data = np.loadtxt("Chain_0/alpha_dist.txt")
+        else:
             continue
-        os.chdir(os.path.join(working_dir, folder))
         name = spec.replace(".fits", '').replace("n3311", "").split("_")
         name = name[1] + name[2]
         name = r"{0}".format(name)
         sn = float(sndata[spec])
-        ages_data = np.loadtxt("Chain_0/age_dist.txt")
         ages_data = 9. + np.log10(ages_data)
         ages = Dist(ages_data, [9 + np.log10(1), 9 + np.log10(15)])
-        metal_data = np.loadtxt("Chain_0/metal_dist.txt")
         metal = Dist(metal_data, [-2.25, 0.90])
-        alpha_data = np.loadtxt("Chain_0/alpha_dist.txt")
         alpha = Dist(alpha_data, [-0.3, 0.5])
         dists = [ages, metal, alpha]
         log, summary = [r"{0:28s}".format(spec)], []
@@ -8,30 +8,150 @@ Created on Fri Sep 13 11:35:13 2013
 
 import os
 import shutil
+import bisect
+from multiprocessing import cpu_count
 
 import numpy as np
 from scipy import stats
 from scipy.interpolate import NearestNDInterpolator, LinearNDInterpolator
-import pymc
 
 from config import *
+from results_store import read_table
+from ssp_sampler import run_sampler, hpd
+
+class GridInterpolator(object):
+    """ Multilinear interpolation of values tabulated in a regular grid.
+
+    The coefficients of the multilinear polynomial in each cell of the grid
+    are computed once, so that an evaluation only needs to locate the cell
+    in each axis and to sum 2**ndim terms. Points outside the grid are set
+    to NaN, as in LinearNDInterpolator.
+    """
+    def __init__(self, axes, values):
+        """ axes are the sorted coordinates of the grid in each dimension,
+        and values is an array (n1, ..., nd, ncols). """
+        self.axes = [np.asarray(x, dtype=float) for x in axes]
+        self.ndim = len(self.axes)
+        values = np.asarray(values, dtype=float)
+        shape = tuple(len(x) for x in self.axes)
+        if values.shape[:self.ndim] != shape:
+            raise ValueError("Values must have shape {0} plus the columns"
+                             .format(shape))
+        if min(shape) < 2:
+            raise ValueError("Grid must have at least two points in each "
+                             "dimension")
+        ncols = values.shape[self.ndim]
+        self.cells = tuple(n - 1 for n in shape)
+        # Values in the corners of each cell, with one axis of length 2 for
+        # each dimension, and differences along these axes, which give the
+        # coefficients of the products of the local coordinates
+        corners = values
+        for d in range(self.ndim):
+            lo = np.take(corners, np.arange(shape[d] - 1), axis=d)
+            hi = np.take(corners, np.arange(1, shape[d]), axis=d)
+            corners = np.stack((lo, hi - lo), axis=-2)
+        self.coeffs = corners.reshape(int(np.prod(self.cells)),
+                                      2**self.ndim, ncols)
+        self.lists = [x.tolist() for x in self.axes]
+
+    @staticmethod
+    def detect(points):
+        """ Return the axes of the grid of an array of points (npoints, ndim)
+        and the indices of each point in the grid, or None if the points
+        do not form a complete regular grid. """
+        points = np.asarray(points, dtype=float)
+        axes = [np.unique(x) for x in points.T]
+        shape = tuple(len(x) for x in axes)
+        if np.prod(shape) != len(points) or min(shape) < 2:
+            return None
+        idx = tuple(np.searchsorted(x, p) for x, p in zip(axes, points.T))
+        flat = np.ravel_multi_index(idx, shape)
+        if len(np.unique(flat)) != len(points):
+            return None
+        return axes, idx
+
+    @classmethod
+    def from_points(cls, points, values):
+        """ Interpolator of values (npoints, ncols) at scattered points which
+        form a regular grid, or None if they do not. """
+        grid = cls.detect(points)
+        if grid is None:
+            return None
+        axes, idx = grid
+        values = np.asarray(values, dtype=float)
+        data = np.zeros(tuple(len(x) for x in axes) + values.shape[1:])
+        data[idx] = values
+        return cls(axes, data)
+
+    def __call__(self, *args):
+        """ Values at the points given by one coordinate for each dimension,
+        either scalars or arrays with the same shape. """
+        if all([np.ndim(a) == 0 for a in args]):
+            return self._point(*args)
+        x = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in args])
+        shape = x[0].shape
+        x = [np.ravel(a) for a in x]
+        out = np.zeros(len(x[0]), dtype=bool)
+        cell = np.zeros(len(x[0]), dtype=int)
+        terms = np.ones((len(x[0]), 1))
+        for axis, xd, n in zip(self.axes, x, self.cells):
+            i = np.clip(np.searchsorted(axis, xd, side="right") - 1, 0, n - 1)
+            t = (xd - axis[i]) / (axis[i+1] - axis[i])
+            out |= ~((xd >= axis[0]) & (xd <= axis[-1]))
+            cell = cell * n + i
+            # Products of the local coordinates for each coefficient
+            terms = np.column_stack((terms, terms * t[:,np.newaxis]))
+            terms = terms.reshape(len(t), 2, -1).transpose(0, 2, 1).reshape(
+                                                                  len(t), -1)
+        result = np.einsum("pk,pkc->pc", terms, self.coeffs[cell])
+        result[out] = np.nan
+        return result.reshape(shape + (result.shape[1],))
+
+    def _point(self, *args):
+        """ Values at a single point, avoiding the overhead of arrays in the
+        evaluations of the MCMC. """
+        cell, terms = 0, [1.]
+        for axis, xd, n in zip(self.lists, args, self.cells):
+            xd = float(xd)
+            if not axis[0] <= xd <= axis[-1]:
+                return np.nan * np.ones(self.coeffs.shape[2])
+            i = min(bisect.bisect_right(axis, xd) - 1, n - 1)
+            t = (xd - axis[i]) / (axis[i+1] - axis[i])
+            cell = cell * n + i
+            terms = [w * u for w in terms for u in (1., t)]
+        return np.dot(terms, self.coeffs[cell])
 
 class SSP:
-    """ Wrapper for the interpolated model."""
-    def __init__(self, model_table, indices=np.arange(25), itype="nearest"):
+    """ Wrapper for the interpolated model.
+
+    With itype="linear", the model is interpolated with a GridInterpolator
+    of only the columns indices if the models are in a regular grid, and
+    with a LinearNDInterpolator otherwise or if grid is False. """
+    def __init__(self, model_table, indices=np.arange(25), itype="nearest",
+                 grid=True):
         self.itype = itype
+        self.grid = grid
+        self.indices = indices
         self.interpolate(model_table)
-        self.indices = indices 
     
     def interpolate(self, model_table):
         modeldata = np.loadtxt(model_table, dtype=np.double)
+        self.model = None
         if self.itype == "nearest":
             self.model = NearestNDInterpolator(modeldata[:,:3], modeldata[:,3:])
         elif self.itype == "linear":
+            if self.grid:
+                self.model = GridInterpolator.from_points(modeldata[:,:3],
+                                        modeldata[:,3:][:,self.indices])
+            if self.model is not None:
+                return
             self.model = LinearNDInterpolator(modeldata[:,:3], modeldata[:,3:])
         
     def fn(self, age, metallicity, alpha): 
-        return self.model(age, metallicity, alpha)[self.indices]
+        """ Indices of the models at one or many points. """
+        if isinstance(self.model, GridInterpolator):
+            return self.model(age, metallicity, alpha)
+        return self.model(age, metallicity, alpha)[...,self.indices]
         
     def __call__(self, *args): 
         return self.fn(*args)
@@ -52,12 +172,10 @@ def get_coefficients(map_):
     return [{str(variable): variable.value} for variable in map_.variables]
 
 def read_data(tab1, tab2):
-    s1 = np.genfromtxt(tab1, usecols=(0,), dtype=None).tolist()
-    s2 = np.genfromtxt(tab2, usecols=(0,), dtype=None).tolist()
+    s1, data = read_table(tab1, usecols=np.arange(1,25))
+    s2, errs = read_table(tab2, usecols=np.arange(1,26))
     sref = [x for x in s1 if x in s2]
     sref.sort()
-    data = np.loadtxt(tab1, usecols=np.arange(1,25))
-    errs = np.loadtxt(tab2, usecols=np.arange(1,26))
     idx1 = np.array([s1.index(x) for x in sref])
     idx2 = np.array([s2.index(x) for x in sref])
     data = data[idx1]
@@ -80,92 +198,46 @@ def get_model_lims(table, factor=0.5):
     return lims, ranges
 
 if __name__ == "__main__":
-    lims = [[0.1, 15.], [-2.25, 0.9], [-0.3, 0.5]]
+    plims = [[0.1, 15.], [-2.25, 0.9], [-0.3, 0.5]]
     model_table = os.path.join(tables_dir, "models_thomas_2010_metal_extrapolated.dat")
     db = "2" if model_table.endswith("MILESII.txt") else ""
     lims, ranges = get_model_lims(model_table)
     # model_table_err = os.path.join(tables_dir, "tmj_errors.dat")
-    age_dist = pymc.Uniform(name="age_dist", lower=ranges[0,0],
-                            upper=ranges[0,1])
-    metal_dist = pymc.Uniform(name="metal_dist", lower=ranges[1,0],
-                              upper=ranges[1,1])
-    alpha_dist = pymc.Uniform(name="alpha_dist", lower=ranges[2,0],
-                              upper=ranges[2,1])
     working_dir = os.path.join(home, "single2")
     os.chdir(working_dir)
     spectra, data, errs = read_data("lick_corr.tsv",
                                     "mc_lick_nsim400.txt")
     outtable = "ages_Z_alpha.tsv"
-    for i, (spec, obsdata, obserr) in enumerate(zip(spectra, data, errs)):
-        ######################################################################
-        # Get valid indices
-        nans = np.where(~np.isnan(obsdata))[0]
-        indcols = np.where(~np.isnan(obsdata))[0]
-        ######################################################################
-        # Clip indices with unnexpected values according to model
-        for idx in indcols:
-             if obsdata[idx] <= lims[idx,0] or  obsdata[idx] > lims[idx,1]:
-                 obsdata[idx] = np.nan
-        ######################################################################
-        print obsdata
-        print obserr
-        raw_input()
-        dbname = spec.replace(".fits", "_db{0}".format(db))
-        dbfolder = os.path.join(working_dir, dbname)
-        if os.path.exists(dbfolder):
-            continue
-        print "Working with spectra {2} ({0} / {1})".format(i+1, len(spectra),
-                                                            spec)
-        if i == 0:
-            with open(outtable, "w") as f:
-                f.write("# Spectra\tAge(Gyr)\tAge-\tAge+\t[Z/H]\t[Z/H]"
-                        "-\t[Z/H]+\t[alpha/Fe]\t[alpha/Fe]-\t[alpha/Fe]+\n")
-        csvfile = dbname + ".csv"
-        if len(indcols) == 0:
+    ##########################################################################
+    # Clip indices with unnexpected values according to model
+    ncols = data.shape[1]
+    data[(data <= lims[:ncols,0]) | (data > lims[:ncols,1])] = np.nan
+    # Removing Mg1 and Mg2
+    indcols = np.arange(12, ncols)
+    indcols = indcols[indcols != 14]
+    indcols = indcols[indcols != 15]
+    obsdata = data[:,indcols]
+    obserr = errs[:,indcols]
+    good = np.isfinite(obsdata).any(axis=1)
+    # ssperr = SSP(model_table_err, indcols, itype="nearest")
+    ssp = SSP(model_table, indcols, itype="linear")
+    ##########################################################################
+    # All spectra are sampled together, with the chains in one store
+    store = run_sampler(ssp, spectra[good].tolist(), obsdata[good],
+                        obserr[good], ranges, "ssp_chains{0}".format(db),
+                        nprocs=cpu_count())
+    with open(outtable, "w") as f:
+        f.write("# Spectra\tAge(Gyr)\tAge-\tAge+\t[Z/H]\t[Z/H]"
+                "-\t[Z/H]+\t[alpha/Fe]\t[alpha/Fe]-\t[alpha/Fe]+\n")
+    done = store.done()
+    for spec in spectra[good]:
+        if spec not in done:
             continue
-        # Removing Mg1 and Mg2
-        indcols = indcols[indcols != 14]
-        indcols = indcols[indcols != 15]
-        indcols = indcols[indcols>11] 
-        obsdata = obsdata[indcols]
-        obserr = obserr[indcols]
-        # taus = 1 / obserr**2
-        # ssperr = SSP(model_table_err, indcols, itype="nearest")
-        ssp = SSP(model_table, indcols, itype="linear")
-
-        @pymc.deterministic()
-        def ssp1(age=age_dist, metal=metal_dist, alpha=alpha_dist):
-            return ssp(age, metal, alpha)
-
-        @pymc.deterministic()
-        def ssp1err(age=age_dist, metal=metal_dist, alpha=alpha_dist):
-            # return 1 / (obserr**2 + ssperr(age, metal, alpha))
-            return 1 / (obserr**2)
-
-        y = pymc.Normal(name="y", mu=ssp1, tau=ssp1err,
-                        value=obsdata, observed=True)
-
-        model = pymc.Model([y, age_dist, metal_dist, alpha_dist]) 
-        mcmc = pymc.MCMC(model, db="txt", dbname=dbname)
-        mcmc.sample(20000, 1000, 4)
-        mcmc.db.close()
-        mcmc.summary()
-        db = pymc.database.txt.load(dbname)
-        mcmc = pymc.MCMC(model, db=db)
-        ages = mcmc.trace("age_dist")[:]
-        metals = mcmc.trace("metal_dist")[:]
-        alphas = mcmc.trace("alpha_dist")[:]
-        results = mcmc.stats(alpha=0.3173105)
-        age_min, age_max = results["age_dist"]['68% HPD interval']
-        metal_min, metal_max = results["metal_dist"]['68% HPD interval']
-        alpha_min, alpha_max = results["alpha_dist"]['68% HPD interval']
-        distage = Dist(ages, lims[0])
-        distmetal = Dist(metals, lims[1])
-        distalpha = Dist(alphas, lims[2])
-        s = [distage.MAPP, age_min, age_max, distmetal.MAPP, metal_min, 
-             metal_max, distalpha.MAPP, alpha_min, alpha_max]
-#        pymc.raftery_lewis(mcmc, q=0.01, r=0.01)
+        chain = np.array(store.read(spec), dtype=float)
+        s = []
+        for i in range(3):
+            dist = Dist(chain[:,i], plims[i])
+            s += [dist.MAPP] + list(hpd(chain[:,i], alpha=0.3173105))
         with open(outtable, "a") as f:
-            f.write(spectra[i] + "\t" + 
+            f.write(spec + "\t" +
                     "\t".join([str(round(x,5)) for x in s]) + "\n")
-        break
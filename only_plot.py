@@ -18,6 +18,7 @@ from scipy.interpolate import interp1d
 
 from config import *
 from run_ppxf import pPXF, speclist
+from load_templates import stellar_templates
 import ppxf_util as util
 
 def get_ranges(spec):
@@ -30,23 +31,7 @@ def get_ranges(spec):
     
 def w_temp(velscale):
     """ Make templates array"""
-    current_dir = os.getcwd()
-    os.chdir(template_dir)
-    miles = [x for x in os.listdir(".") if x.endswith(".fits")]
-    miles.sort()
-    c = 299792.458
-    FWHM_tem = 2.54 # MILES library spectra have a resolution FWHM of 2.54A.
-    # Extract the wavelength range and logarithmically rebin one spectrum
-    # to the same velocity scale of the SAURON galaxy spectrum, to determine
-    # the size needed for the array which will contain the template spectra.
-    #
-    hdu = pf.open(miles[0])
-    ssp = hdu[0].data
-    h2 = hdu[0].header
-    lamRange2 = h2['CRVAL1'] + np.array([0.,h2['CDELT1']*(h2['NAXIS1']-1)])
-    sspNew, logLam2, velscale = util.log_rebin(lamRange2, ssp, 
-                                               velscale=velscale)
-    os.chdir(current_dir)
+    logLam2 = stellar_templates(velscale)[1] # Read from the templates cache
     return np.exp(logLam2)
 
 def get_lick_regions():
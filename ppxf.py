@@ -56,7 +56,9 @@
 #                      bias=None, clean=False, degree=4, goodpixels=None, 
 #                      mdegree=0, moments=2, oversample=False, plot=False, 
 #                      quiet=False, sky=None, vsyst=0, regul=0, lam=None, 
-#                      reddening=None, component=0, reg_dim=None)
+#                      reddening=None, component=0, reg_dim=None,
+#                      batch_convolve=False, analytic_losvd=False,
+#                      jacobian=False, workspace=None)
 #
 #  NOTE:
 #  The documentation below is taken from the IDL version, which is functionally
@@ -128,6 +130,20 @@
 #   BESTFIT: a named variable to receive a vector with the best fitting
 #       template: this is a linear combination of the templates, convolved with
 #       the best fitting LOSVD, with added polynomial continuum terms.
+#   /BATCH_CONVOLVE: set this keyword to compute the Fourier transform of all
+#       the TEMPLATES only once, at the start of the fit, and cache it for all
+#       the following iterations. At every iteration all the templates are then
+#       convolved with the LOSVD with a single vectorized multiplication and
+#       inverse FFT for every kinematic component, instead of calling FFTCONVOLVE
+#       separately for every template. The result is the same, within numerical
+#       rounding, but much faster when many templates are fitted.
+#   /ANALYTIC_LOSVD: set this keyword to evaluate the Gauss-Hermite LOSVD
+#       analytically in Fourier space, instead of sampling it on a grid of pixels
+#       and then taking its FFT. The Fourier transform of the LOSVD is exact even
+#       when sigma is smaller than one pixel, so one does not need the /OVERSAMPLE
+#       keyword, which is ignored in this case. The velocity shift becomes a phase
+#       factor, so that the cost of computing the LOSVD does not depend on VSYST
+#       or on the fitted velocity. This keyword implies /BATCH_CONVOLVE.
 #   BIAS: This parameter biases the (h3,h4,...) measurements towards zero
 #       (Gaussian LOSVD) unless their inclusion significantly decreses the
 #       error in the fit. Set this to BIAS=0.0 not to bias the fit: the
@@ -166,6 +182,13 @@
 #       the fit. If the /CLEAN keyword is set, in output this vector will be updated
 #       to contain the indices of the pixels that were actually used in the fit.
 #     - IMPORTANT: in all likely situations this keyword *has* to be specified.
+#   /JACOBIAN: set this keyword to compute analytically the derivatives of the
+#       fit residuals with respect to the LOSVD parameters [V,sigma,h3,...,h6],
+#       the multiplicative polynomials and the reddening. These are passed to
+#       MPFIT (AUTODERIVATIVE=0) instead of letting it compute them with finite
+#       differences, which require one extra full linear fit per free parameter.
+#       The derivatives are computed at fixed WEIGHTS of the linear fit. This
+#       keyword implies /ANALYTIC_LOSVD and cannot be used for two-sided fitting.
 #   LAMBDA: When the keyword REDDENING is used, the user has to pass in this
 #       keyword a vector with the same dimensions of GALAXY, giving the restframe
 #       wavelength in Angstrom of every pixel in the input galaxy spectrum.
@@ -277,6 +300,11 @@
 #       with the SKY keyword, the sky weights are allowed to be different for the
 #       left and right spectrum. In that case the output sky weights alternate
 #       between the first (left) spectrum and the second (right) spectrum.
+#   WORKSPACE: an initially empty dictionary, to be passed unchanged to 
+#       successive calls with the same TEMPLATES (e.g. to fit many spectra).
+#       The Fourier transform of the templates (with /BATCH_CONVOLVE) and the
+#       invariant part of the design matrix are computed in the first call
+#       and reused by the following ones. See PPXF_BATCH below.
 #
 # OUTPUT PARAMETER:
 #   SOL: seven elements vector containing in output the values of
@@ -427,6 +455,8 @@
 #-
 #----------------------------------------------------------------------------
 
+import warnings
+
 import numpy as np    
 import matplotlib.pyplot as plt
 from numpy import polynomial
@@ -437,20 +467,101 @@ eps = np.MachAr().eps
 
 #----------------------------------------------------------------------------
 
-def nnls_flags(A,b,flags):
+def nnls_flags(A,b,flags,x0=None):
     """
     Solves min||A*x - b|| with 
     x[j] >= 0 for flags[j] == 1
     x[j] free for flags[j] == 0
     where A[m,n], b[m], x[n], flags[n]
     
+    The optional X0[n] is a previous solution of a similar problem, 
+    whose nonzero elements are used as starting active set.
+    
     """    
+    x, niter = _nnls_active_set(A, b, flags == 0, x0)
+    return x
+
+#----------------------------------------------------------------------------
+
+def _nnls_active_set(A, b, free, x0=None):
+    """
+    Lawson & Hanson (1974, Solving Least Squares Problems, Chapter 23)
+    active set algorithm, with the FREE variables always in the passive 
+    set. If X0 is given, the passive set is initialized with its positive 
+    elements, following Bro & de Jong (1997, J. Chemometrics, 11, 393), and
+    only the elements that changed need to be moved in or out of it.
+    Returns the solution and the number of iterations (moves of one 
+    variable into or out of the passive set).
+    
+    The subproblems are solved by least squares on the passive columns of 
+    A, not through the normal equations, which would square the condition
+    number of A. All tolerances are relative, so that the solution does 
+    not depend on the units of A and b.
+    
+    """
     m, n = A.shape
-    mask = flags == 0
-    AA = np.hstack([A, -A[:,mask]])
-    x, err = optimize.nnls(AA, b)
-    x[mask] -= x[n:]
-    return x[:n]
+    # Tolerance of the gradient, which scales as A*b
+    tol = 10*eps*np.abs(A).sum(0).max()*max(m, n)*np.abs(b).max()
+    passive = free.copy()
+    if x0 is not None:
+        passive |= x0 > 0
+    x = np.zeros(n)
+    niter = 0
+    
+    # Make the starting point feasible by removing the variables that 
+    # become negative, when solving for the initial passive set
+    #
+    while True:
+        z = np.zeros(n)
+        z[passive] = linalg.lstsq(A[:,passive], b)[0]
+        neg = passive & ~free & (z <= 0)
+        if not neg.any():
+            x = z
+            break
+        passive &= ~neg
+        niter += neg.sum()
+
+    blocked = np.zeros(n, dtype=bool)
+    converged = False
+    while niter < 3*n:
+        w = A.T.dot(b - A.dot(x)) # Minus the gradient of 0.5*||A*x - b||^2
+        w[passive | blocked] = -np.inf
+        j = np.argmax(w)
+        if w[j] <= tol:
+            converged = True
+            break
+        passive[j] = True
+        niter += 1
+        first = True
+        while True:
+            z = np.zeros(n)
+            z[passive] = linalg.lstsq(A[:,passive], b)[0]
+            neg = passive & ~free & (z <= 0)
+            if not neg.any():
+                x = z
+                blocked[:] = False
+                break
+            if first and z[j] <= 0: # Variable j cannot enter: try the next
+                passive[j] = False
+                blocked[j] = True
+                niter -= 1
+                break
+            first = False
+            ratio = x[neg]/(x[neg] - z[neg])
+            alpha = np.min(ratio)
+            x += alpha*(z - x)
+            # The variable which limits the step is exactly at its bound, 
+            # and others are removed only if zero to rounding of the weights
+            x[np.flatnonzero(neg)[np.argmin(ratio)]] = 0
+            out = passive & ~free & (x <= 10*eps*np.abs(x).max())
+            x[out] = 0
+            niter += out.sum()
+            passive &= ~out
+
+    if not converged:
+        warnings.warn("NNLS stopped after the maximum of {0} iterations"
+                      .format(3*n))
+    return x, niter
         
 #----------------------------------------------------------------------------
 
@@ -464,6 +575,16 @@ def rebin(x,factor):
 
 #----------------------------------------------------------------------------
 
+def _fft_size(n):
+    """
+    Smallest power of two >= n, used as padded length of the 
+    cached Fourier transforms of the templates
+    
+    """
+    return int(2**np.ceil(np.log2(n)))
+
+#----------------------------------------------------------------------------
+
 def robust_sigma(y, zero=False):
     """
     Biweight estimate of the scale (standard deviation).
@@ -516,22 +637,26 @@ def reddening_curve(lam, ebv):
 
 #----------------------------------------------------------------------------
 
-def _bvls_solve(A, b, npoly):
+def _bvls_solve(A, b, npoly, x0=None):
 
     # No need to enforce positivity constraints if fitting one single template:
     # use faster linear least-squares solution instead of NNLS.
+    # X0 is the solution of the previous call, used as warm start of the NNLS.
     #
     m, n = A.shape
+    niter = 0
     if m == 1: # A is a vector, not an array
         soluz = A.dot(b)/A.dot(A)
+    elif n == 1: # Single template and no polynomials
+        soluz = A.T.dot(b)/np.sum(A**2)
     elif n == npoly + 1: # Fitting a single template
         soluz = linalg.lstsq(A,b)[0]
     else:               # Fitting multiple templates
-        flags = np.ones(n) 
-        flags[:npoly] = 0 # flag = 0 on Legendre polynomials
-        soluz = nnls_flags(A, b, flags)
+        free = np.zeros(n, dtype=bool) 
+        free[:npoly] = True # Legendre polynomials are unconstrained
+        soluz, niter = _nnls_active_set(A, b, free, x0)
     
-    return soluz
+    return soluz, niter
 
 #----------------------------------------------------------------------------,.
 
@@ -540,7 +665,9 @@ class ppxf(object):
     def __init__(self, templates, galaxy, noise, velScale, start, 
          bias=None, clean=False, degree=4, goodpixels=None, mdegree=0, 
          moments=2, oversample=False, plot=False, quiet=False, sky=None, 
-         vsyst=0, regul=0, lam=None, reddening=None, component=0, reg_dim=None):
+         vsyst=0, regul=0, lam=None, reddening=None, component=0, reg_dim=None,
+         batch_convolve=False, analytic_losvd=False, jacobian=False,
+         workspace=None):
 
         # Do extensive checking of possible input errors
         #
@@ -558,6 +685,9 @@ class ppxf(object):
         self.lam = lam
         self.reddening = reddening
         self.reg_dim = np.asarray(reg_dim)
+        self.jacobian = jacobian
+        self.analytic_losvd = analytic_losvd or jacobian
+        self.batch_convolve = batch_convolve or self.analytic_losvd
                 
         s1 = templates.shape
         if len(s1) == 1: # Single template
@@ -617,6 +747,9 @@ class ppxf(object):
             
         if (s1[0] < s2[0]):
             raise ValueError('STAR length cannot be smaller than GALAXY')
+
+        if jacobian and len(s2) == 2:
+            raise ValueError('JACOBIAN cannot be used for two-sided fitting')
             
         if reddening is not None:
             if not np.equal(self.lam.shape,s2):
@@ -632,7 +765,7 @@ class ppxf(object):
         self.degree = max(degree, -1)
         self.mdegree = max(mdegree, 0)
         
-        if oversample:
+        if oversample and not self.analytic_losvd:
             self.factor = 30
         else:
             self.factor = 1    
@@ -707,19 +840,49 @@ class ppxf(object):
         elif self.reddening is not None:
             parinfo[ngh]['value'] = self.reddening
             parinfo[ngh]['limits'] = [0.,10.] # force positive E(B-V) < 10 mag
+
+        # Compute once the Fourier transform of all templates, padded enough to
+        # contain the largest LOSVD allowed by the limits on V and sigma.
+        #
+        if self.batch_convolve:
+            dx = 0
+            p = 0
+            for j in range(self.ncomp):
+                vmax = np.max(np.abs(parinfo[0+p]['limits']))
+                tmp = np.ceil(abs(self.vsyst) + vmax + 5.*parinfo[1+p]['limits'][1])
+                dx = max(dx, tmp)
+                p += int(self.moments[j])
+            nfft = _fft_size(self.star.shape[0]*self.factor + 2*dx*self.factor)
+            if (workspace is not None and workspace.get('factor') == self.factor
+                    and workspace.get('nfft', 0) >= nfft):
+                self._nfft = workspace['nfft'] # Padding is already enough
+                self._star_rfft = workspace['star_rfft']
+            else:
+                if self.factor == 1:
+                    st = self.star
+                else:
+                    st = ndimage.interpolation.zoom(self.star, [self.factor,1], order=1)
+                self._nfft = nfft
+                self._star_rfft = np.fft.rfft(st, self._nfft, axis=0)
+                if workspace is not None:
+                    workspace.update(factor=self.factor, nfft=self._nfft,
+                                     star_rfft=self._star_rfft)
     
         # Here the actual calculation starts.
         # If required, once the minimum is found, clean the pixels deviating
         # more than 3*sigma from the best fit and repeat the minimization
         # until the set of cleaned pixels does not change any more.
         #
+        self._init_workspace(workspace)
         good = self.goodpixels.copy()
         self.parinfo = parinfo
         for j in range(4): # Do at most five cleaning iterations
             self.clean = False # No cleaning during chi2 optimization
-            mp = mpfit.mpfit(self._fitfunc, parinfo=parinfo, quiet=1, ftol=1e-4)
+            mp = mpfit.mpfit(self._fitfunc, parinfo=parinfo, quiet=1, ftol=1e-4,
+                             autoderivative=int(not self.jacobian))
             self.pfit = mp.params
             ncalls = mp.nfev
+            self.nfev = ncalls
             if clean is False:
                 break
             goodOld = self.goodpixels.copy()
@@ -733,6 +896,7 @@ class ppxf(object):
         # and also get the output bestfit and weights.
         #
         self.bias = 0
+        self._unbroadened = True # Only needed at the best fit
         status, err = self._fitfunc(mp.params)
         self.chi2 = robust_sigma(err, zero=True)**2       # Robust computation of Chi**2/DOF.
         
@@ -767,6 +931,8 @@ class ppxf(object):
                 print 'Templates weights:'
                 print "".join("%8.3g" % f for f in self.weights)
 
+        self._free_workspace(workspace)
+
         if self.ncomp ==1:
             self.sol = self.sol[0]
             self.error = self.error[0]
@@ -810,42 +976,45 @@ class ppxf(object):
         
         # pars = [vel,sigma,h3,h4,...,m1,m2,...]    # Velocities are in pixels
         #
-        dx = 0
-        p = 0
-        for j in range(self.ncomp): # loop over kinematic components
-            tmp = np.ceil(abs(self.vsyst) + abs(pars[0+p]) + 5.*pars[1+p]) # Sample the Gaussian and GH at least to vsyst+vel+5*sigma
-            dx = max(dx, tmp)
-            p += self.moments[j]
-
-        n = 2*dx*self.factor + 1
-        x = np.linspace(-dx,dx,n)   # Evaluate the Gaussian using steps of 1/factor pixel
-        losvd = np.empty((int(n),self.ncomp,nspec))
-        losvd2 = losvd.copy()
-        p = 0
-        for j in range(self.ncomp): # loop over kinematic components
-            for k in range(nspec):    # nspec=2 for two-sided fitting, otherwise nspec=1
-                if k ==0:
-                    s = 1   # s=+1 for left spectrum, s=-1 for right one
-                else:
-                    s = -1
-                vel = self.vsyst + s*pars[0+p]
-                w = (x - vel)/pars[1+p]
-                w_un = (x - vel)/1.
-                w2 = w**2
-                w2_un = w_un**2
-                losvd[:,j,k] = np.exp(-0.5*w2)/(np.sqrt(2.*np.pi)*pars[1+p]) # Normalized total(Gaussian)=1
-                losvd2[:,j,k] = np.exp(-0.5*w2_un)/(np.sqrt(2.*np.pi)) # Normalized total(Gaussian)=1
-                # Hermite polynomials normalized as in Appendix A of van der Marel & Franx (1993).
-                # Coefficients for h5, h6 are given e.g. in Appendix C of Cappellari et al. (2002)
-                #
-                if self.moments[j] > 2:        # h_3 h_4
-                    poly = 1 + s*pars[2+p]/np.sqrt(3)*(w*(2*w2-3)) \
-                             + pars[3+p]/np.sqrt(24)*(w2*(4*w2-12)+3)
-                    if self.moments[j] == 6:  # h_5 h_6
-                        poly = poly + s*pars[4+p]/np.sqrt(60)*(w*(w2*(4*w2-20)+15)) \
-                                    + pars[5+p]/np.sqrt(720)*(w2*(w2*(8*w2-60)+90)-15) 
-                    losvd[:,j,k] = losvd[:,j,k]*poly
+        if self.analytic_losvd: # LOSVD evaluated directly in Fourier space
+            losvd, losvd2 = self._losvd_rfft(pars, nspec)
+        else:
+            dx = 0
+            p = 0
+            for j in range(self.ncomp): # loop over kinematic components
+                tmp = np.ceil(abs(self.vsyst) + abs(pars[0+p]) + 5.*pars[1+p]) # Sample the Gaussian and GH at least to vsyst+vel+5*sigma
+                dx = max(dx, tmp)
                 p += self.moments[j]
+
+            n = 2*dx*self.factor + 1
+            x = np.linspace(-dx,dx,n)   # Evaluate the Gaussian using steps of 1/factor pixel
+            losvd = np.empty((int(n),self.ncomp,nspec))
+            losvd2 = losvd.copy()
+            p = 0
+            for j in range(self.ncomp): # loop over kinematic components
+                for k in range(nspec):    # nspec=2 for two-sided fitting, otherwise nspec=1
+                    if k ==0:
+                        s = 1   # s=+1 for left spectrum, s=-1 for right one
+                    else:
+                        s = -1
+                    vel = self.vsyst + s*pars[0+p]
+                    w = (x - vel)/pars[1+p]
+                    w_un = (x - vel)/1.
+                    w2 = w**2
+                    w2_un = w_un**2
+                    losvd[:,j,k] = np.exp(-0.5*w2)/(np.sqrt(2.*np.pi)*pars[1+p]) # Normalized total(Gaussian)=1
+                    losvd2[:,j,k] = np.exp(-0.5*w2_un)/(np.sqrt(2.*np.pi)) # Normalized total(Gaussian)=1
+                    # Hermite polynomials normalized as in Appendix A of van der Marel & Franx (1993).
+                    # Coefficients for h5, h6 are given e.g. in Appendix C of Cappellari et al. (2002)
+                    #
+                    if self.moments[j] > 2:        # h_3 h_4
+                        poly = 1 + s*pars[2+p]/np.sqrt(3)*(w*(2*w2-3)) \
+                                 + pars[3+p]/np.sqrt(24)*(w2*(4*w2-12)+3)
+                        if self.moments[j] == 6:  # h_5 h_6
+                            poly = poly + s*pars[4+p]/np.sqrt(60)*(w*(w2*(4*w2-20)+15)) \
+                                        + pars[5+p]/np.sqrt(720)*(w2*(w2*(8*w2-60)+90)-15) 
+                        losvd[:,j,k] = losvd[:,j,k]*poly
+                    p += self.moments[j]
         
         # The zeroth order multiplicative term is already included in the
         # linear fit of the templates. The polynomial below has mean of 1.
@@ -866,8 +1035,155 @@ class ppxf(object):
         if self.lam != 0: 
             mpoly = reddening_curve(self.lam, pars[npars])
         
-        # Fill the columns of the design matrix of the least-squares problem
+        # Fill the columns of the convolved templates in the design matrix of
+        # the least-squares problem. All the other columns, which do not change
+        # during the fit, were filled once by _init_workspace()
         #
+        c, a = self._c, self._a
+        ntemp = self.star.shape[1] # Number of template spectra
+        ncols = c.shape[0]
+        npoly = (self.degree+1)*nspec # Number of additive polynomials in the fit
+        nreg = ncols - npix*nspec
+        
+        # Accounts for difference between IDL's CONVOL and signal.fftconvolve
+        # CONVOLVE(a,b,/EDGE_ZERO) = signal.fftconvolve(a,b[::-1],'same')
+        
+        if self.batch_convolve:
+            if self.analytic_losvd:
+                start = 0
+            else: # Offset of the output of the mode='same' convolution
+                start = (losvd.shape[0] - 1)//2
+                losvd = np.fft.rfft(losvd, self._nfft, axis=0)
+                if self._unbroadened:
+                    losvd2 = np.fft.rfft(losvd2, self._nfft, axis=0)
+            mcol = np.reshape(mpoly, (-1,1))
+            tmp = self._convolve_templates(losvd, npix, start)
+            c[:npix*nspec,npoly:npoly+ntemp] = mcol*tmp.reshape(npix*nspec,ntemp)
+            if self._unbroadened:
+                d = self._unbroadened_matrix()
+                tmp2 = self._convolve_templates(losvd2, npix, start)
+                d[:npix*nspec,npoly:npoly+ntemp] = mcol*tmp2.reshape(npix*nspec,ntemp)
+        else:
+            tmp = np.empty((self.star.shape[0],nspec))
+            tmp2 = tmp.copy()
+            if self._unbroadened:
+                d = self._unbroadened_matrix()
+            for j in range(ntemp):
+                if self.factor == 1: # No oversampling of the template spectrum
+                    for k in range(nspec):
+                        tmp[:,k] = signal.fftconvolve(self.star[:,j],losvd[:,int(self.component[j]),k],mode='same')
+                        if self._unbroadened:
+                            tmp2[:,k] = signal.fftconvolve(self.star[:,j],losvd2[:,int(self.component[j]),k],mode='same')
+                else:             # Oversample the template spectrum before convolution
+                    st = ndimage.interpolation.zoom(self.star[:,j],self.factor,order=1)
+                    for k in range(nspec):
+                        tmp[:,k] = rebin(signal.fftconvolve(st,losvd[:,self.component[j],k],mode='same'),self.factor)
+                        if self._unbroadened:
+                            tmp2[:,k] = rebin(signal.fftconvolve(st,losvd2[:,self.component[j],k],mode='same'),self.factor)
+                c[:npix*nspec,npoly+j] = mpoly*tmp[:npix,:].ravel() # reform into a vector
+                if self._unbroadened:
+                    d[:npix*nspec,npoly+j] = mpoly*tmp2[:npix,:].ravel() # reform into a vector
+        
+        # Select the spectral region to fit and solve the overconditioned system
+        # using SVD/BVLS. Use unweighted array for estimating bestfit predictions.
+        # Iterate to exclude pixels deviating more than 3*sigma if /CLEAN keyword is set.
+        # Only the template columns of the weighted array need to be updated.
+        #
+        a[:npix*nspec,npoly:npoly+ntemp] = c[:npix*nspec,npoly:npoly+ntemp] / self.noise[:,np.newaxis] # Weight all columns with errors
+        b = self.galaxy / self.noise
+                
+        m = 1
+        while m != 0:
+            if self.regul > 0:
+                aa = a[np.hstack([self.goodpixels, np.arange(npix*nspec,ncols)]), :]
+                bb = np.hstack([b[self.goodpixels], np.zeros(nreg)])
+            else:
+                aa = a[self.goodpixels,:]
+                bb = b[self.goodpixels]
+            self.weights, niter = _bvls_solve(aa,bb,npoly,self._weights0)
+            self._weights0 = self.weights
+            self.nnls_iter += niter
+            # Starting from zero, each positive weight needs at least one iteration
+            self.nnls_saved += max(0, np.sum(self.weights[npoly:] > 0) - niter)
+            self.matrix = c[:npix*nspec,:]
+            self.bestfit = c[:npix*nspec,:].dot(self.weights)
+            err = (self.galaxy[self.goodpixels] - self.bestfit[self.goodpixels]) \
+                /  self.noise[self.goodpixels]
+            if self.clean is True:
+                w = np.where(np.abs(err) < 3) # select residuals smaller than 3*sigma
+                m = np.size(err) - np.size(w)
+                if m != 0:
+                    self.goodpixels = self.goodpixels[w]
+                    if self.quiet != 1: 
+                        print 'Outliers:', m
+            else: 
+                break
+
+        # The unbroadened products only depend on the final weights,
+        # so they are computed once, at the best fit.
+        #
+        if self._unbroadened:
+            self.matrix_unbroad = d[:npix*nspec,:]
+            self.bestfit_unbroad = d[:npix*nspec,:].dot(self.weights)
+        
+        # Penalize the solution towards (h3,h4,...)=0 if the inclusion of
+        # these additional terms does not significantly decrease the error.
+        #
+        penalty = np.any(self.moments > 2) and self.bias != 0
+        if penalty:
+            p = 0
+            tmp = 0.
+            for j in range(self.ncomp): # loop over kinematic components
+                if self.moments[j] > 2:
+                    tmp += np.sum(pars[2+p:int(self.moments[j])+p]**2)
+                p += self.moments[j]
+            pen = self.bias*robust_sigma(err, zero=True)
+            err += pen*np.sqrt(tmp)
+
+        status = 0
+
+        if fjac is None:
+            return (status, err)
+
+        # MPFIT wants the derivatives of the model, which are minus the
+        # derivatives of the residuals. As the linear WEIGHTS are solved for
+        # at every call, use the Kaufman (1975, BIT, 15, 49) approximation 
+        # to the Jacobian of the variable projection functional: the
+        # derivatives at fixed WEIGHTS are projected on the complement of 
+        # the space spanned by the columns of the active linear parameters.
+        # The penalty is differentiated keeping its robust_sigma() fixed.
+        #
+        deriv = self._model_deriv(pars, mpoly, npars)
+        deriv = deriv[self.goodpixels,:]/self.noise[self.goodpixels,np.newaxis]
+        active = self.weights != 0
+        active[:npoly] = True # Polynomials are always free
+        q = linalg.qr(aa[:self.goodpixels.size,active], mode='economic')[0]
+        deriv -= q.dot(q.T.dot(deriv))
+        if penalty and tmp > 0:
+            p = 0
+            for j in range(self.ncomp):
+                for m in range(2, int(self.moments[j])):
+                    deriv[:,m+p] -= pen*pars[m+p]/np.sqrt(tmp)
+                p += int(self.moments[j])
+        
+        return (status, err, deriv)
+
+    #------------------------------------------------------------------
+
+    def _init_workspace(self, workspace=None):
+        """
+        Allocate once the arrays of the design matrix used by _fitfunc and
+        fill the columns (and rows) which do not change during the fit:
+        the additive Legendre polynomials, the regularization and the sky.
+        _fitfunc only has to update the columns of the convolved templates.
+        The design matrix is kept in the optional WORKSPACE dictionary, to be
+        reused by the next fit.
+        
+        """
+        nspec = len(self.galaxy.shape)
+        npix = self.galaxy.shape[0]
+        x = np.linspace(-1,1,npix) # X needs to be within [-1,1] for Legendre Polynomials
+        
         skydim = len(np.shape(self.sky))
         if skydim == 0:
             nsky = 0
@@ -895,141 +1211,306 @@ class ppxf(object):
                 nreg = 3*np.prod(reg2) + 4*np.sum(reg2) 
                 + 4*( np.prod(reg2[[0,1]]) + np.prod(reg2[[0,2]]) + np.prod(reg2[[1,2]]) )
             ncols = ncols + nreg
-        c = np.zeros((ncols,nrows))  # This array is used for estimating predictions
-        ######################################################################
-        # Make copy of c for unconvolved template
-        d = c.copy()
-        ######################################################################
-        
-        for j in range(self.degree+1): # Fill first columns of the Design Matrix
-            coeff = np.zeros(j+1)
-            coeff[j] = 1.0
-            leg = polynomial.legendre.legval(x, coeff)
-            if nspec == 2:
-                c[:npix*nspec,2*j] = np.hstack([leg,leg*0])   # Additive polynomials for left spectrum
-                c[:npix*nspec,2*j+1] = np.hstack([leg*0,leg]) # Additive polynomials for right spectrum
-            else: 
-                c[:npix,j] = leg
-
 
-        # Accounts for difference between IDL's CONVOL and signal.fftconvolve
-        # CONVOLVE(a,b,/EDGE_ZERO) = signal.fftconvolve(a,b[::-1],'same')
-        
-        tmp = np.empty((self.star.shape[0],nspec))
-        tmp2 = tmp.copy()
-        for j in range(ntemp):
-            if self.factor == 1: # No oversampling of the template spectrum
-                for k in range(nspec):
-                    tmp[:,k] = signal.fftconvolve(self.star[:,j],losvd[:,int(self.component[j]),k],mode='same')
-                    tmp2[:,k] = signal.fftconvolve(self.star[:,j],losvd2[:,int(self.component[j]),k],mode='same')
-            else:             # Oversample the template spectrum before convolution
-                st = ndimage.interpolation.zoom(self.star[:,j],self.factor,order=1)
-                for k in range(nspec):
-                    tmp[:,k] = rebin(signal.fftconvolve(st,losvd[:,self.component[j],k],mode='same'),self.factor)
-                    tmp2[:,k] = rebin(signal.fftconvolve(st,losvd2[:,self.component[j],k],mode='same'),self.factor)
-            c[:npix*nspec,(self.degree+1)*nspec+j] = mpoly*tmp[:npix,:].ravel() # reform into a vector
-            d[:npix*nspec,(self.degree+1)*nspec+j] = mpoly*tmp2[:npix,:].ravel() # reform into a vector
-        
-        # Add second-degree 1D, 2D or 3D linear regularization
-        # Press W.H., et al., 1992, Numerical Recipes, 2nd ed. equation (18.5.10)
+        # With the same WORKSPACE of a previous fit of a spectrum of equal size,
+        # the polynomials and regularization are already in place. Only the
+        # sky and the templates columns are different. The final weights of
+        # the previous fit are also used as warm start of the NNLS.
         #
-        if self.regul > 0:
-            if dim == 1:
-                i = np.arange(self.reg_dim)
-            else:
-                i = np.arange(np.prod(self.reg_dim)).reshape(self.reg_dim)
-            i += (self.degree+1)*nspec
-            p = npix*nspec
-            diff = np.array([-1,2,-1])*self.regul
-            ind = np.array([-1,0,1])
-            if dim == 1:
-                for j in range(1,self.reg_dim-1): 
-                    c[p,i[j+ind]] = diff
-                    p += 1
-            elif dim == 2:
-                for k in range(self.reg_dim[1]):
-                    for j in range(self.reg_dim[0]):
-                        if j != 0 and j != self.reg_dim[0]-1:
-                            c[p,i[j+ind,k]] = diff
-                            p += 1
-                        if k != 0 and k != self.reg_dim[1]-1:
-                            c[p,i[j,k+ind]] = diff
-                            p += 1
-            elif dim == 3:
-                for q in range(self.reg_dim[2]):
+        key = (ncols, nrows, self.degree, self.regul, np.ravel(self.reg_dim).tolist())
+        weights0 = None
+        if workspace is not None and workspace.get('key') == key:
+            c = workspace['c']
+            weights0 = workspace.get('weights')
+        else:
+            c = np.zeros((ncols,nrows))  # This array is used for estimating predictions
+        
+            for j in range(self.degree+1): # Fill first columns of the Design Matrix
+                coeff = np.zeros(j+1)
+                coeff[j] = 1.0
+                leg = polynomial.legendre.legval(x, coeff)
+                if nspec == 2:
+                    c[:npix*nspec,2*j] = np.hstack([leg,leg*0])   # Additive polynomials for left spectrum
+                    c[:npix*nspec,2*j+1] = np.hstack([leg*0,leg]) # Additive polynomials for right spectrum
+                else: 
+                    c[:npix,j] = leg
+
+            # Add second-degree 1D, 2D or 3D linear regularization
+            # Press W.H., et al., 1992, Numerical Recipes, 2nd ed. equation (18.5.10)
+            #
+            if self.regul > 0:
+                if dim == 1:
+                    i = np.arange(self.reg_dim)
+                else:
+                    i = np.arange(np.prod(self.reg_dim)).reshape(self.reg_dim)
+                i += (self.degree+1)*nspec
+                p = npix*nspec
+                diff = np.array([-1,2,-1])*self.regul
+                ind = np.array([-1,0,1])
+                if dim == 1:
+                    for j in range(1,self.reg_dim-1): 
+                        c[p,i[j+ind]] = diff
+                        p += 1
+                elif dim == 2:
                     for k in range(self.reg_dim[1]):
                         for j in range(self.reg_dim[0]):
                             if j != 0 and j != self.reg_dim[0]-1:
-                                c[p,i[j+ind,k,q]] = diff
+                                c[p,i[j+ind,k]] = diff
                                 p += 1
                             if k != 0 and k != self.reg_dim[1]-1:
-                                c[p,i[j,k+ind,q]] = diff
-                                p += 1
-                            if q != 0 and q != self.reg_dim[2]-1:
-                                c[p,i[j,k,q+ind]] = diff
+                                c[p,i[j,k+ind]] = diff
                                 p += 1
-        
+                elif dim == 3:
+                    for q in range(self.reg_dim[2]):
+                        for k in range(self.reg_dim[1]):
+                            for j in range(self.reg_dim[0]):
+                                if j != 0 and j != self.reg_dim[0]-1:
+                                    c[p,i[j+ind,k,q]] = diff
+                                    p += 1
+                                if k != 0 and k != self.reg_dim[1]-1:
+                                    c[p,i[j,k+ind,q]] = diff
+                                    p += 1
+                                if q != 0 and q != self.reg_dim[2]-1:
+                                    c[p,i[j,k,q+ind]] = diff
+                                    p += 1
+            if workspace is not None:
+                workspace['key'], workspace['c'] = key, c
+
         for j in range(nsky):
             skyj = self.sky[:,j]
             k = (self.degree+1)*nspec + ntemp
             if nspec == 2:
                 c[:npix*nspec,k+2*j] = [skyj,skyj*0]   # Sky for left spectrum
                 c[:npix*nspec,k+2*j+1] = [skyj*0,skyj] # Sky for right spectrum
-                d[:npix*nspec,k+2*j] = [skyj,skyj*0]   # Sky for left spectrum
-                d[:npix*nspec,k+2*j+1] = [skyj*0,skyj] # Sky for right spectrum
             else: 
                 c[:npix,k+j] = skyj
-                d[:npix,k+j] = skyj
 
-        npoly = (self.degree+1)*nspec # Number of additive polynomials in the fit
-        
-        # Select the spectral region to fit and solve the overconditioned system
-        # using SVD/BVLS. Use unweighted array for estimating bestfit predictions.
-        # Iterate to exclude pixels deviating more than 3*sigma if /CLEAN keyword is set.
-        #
-        a = c.copy() # This array is used for the actual solution of the system
+        # This array is used for the actual solution of the system
+        a = c.copy()
         a[:npix*nspec,:] = c[:npix*nspec,:] / self.noise[:,np.newaxis] # Weight all columns with errors
-        b = self.galaxy / self.noise
+
+        self._c, self._a = c, a
+        self._unbroadened = False
+        self._weights0 = weights0 # Warm start of the NNLS
+        self.nnls_iter = 0
+        self.nnls_saved = 0
+
+    #------------------------------------------------------------------
+
+    def _unbroadened_matrix(self):
+        """
+        Return a new design matrix for the unbroadened templates. Only the
+        sky columns are filled: there are no polynomials or regularization.
+        
+        """
+        c = self._c
+        nspec = len(self.galaxy.shape)
+        npix = self.galaxy.shape[0]
+        k = (self.degree+1)*nspec + self.star.shape[1] # First sky column
+        d = np.zeros_like(c)
+        d[:npix*nspec,k:] = c[:npix*nspec,k:]
+
+        return d
+
+    #------------------------------------------------------------------
+
+    def _free_workspace(self, workspace=None):
+        """
+        Drop the work arrays and caches at the end of the fit, so that they
+        are not kept (or pickled) with the output, and make sure the output
+        matrices do not share memory with them.
+        
+        """
+        if workspace is not None:
+            workspace['weights'] = self._weights0
+        self.matrix = self.matrix.copy()
+        self.matrix_unbroad = self.matrix_unbroad.copy()
+        del self._c, self._a, self._unbroadened, self._weights0
+        if self.batch_convolve:
+            del self._star_rfft, self._nfft
+
+    #------------------------------------------------------------------
+
+    def _convolve_templates(self, losvd_rfft, npix, start=0):
+        """
+        Convolve all templates with the LOSVD of their kinematic component,
+        using the Fourier transform of the templates cached by __init__.
+        LOSVD_RFFT[nl,ncomp,nspec] is the real FFT of the LOSVD, with the same 
+        padded length of the templates, and START the pixel offset of the 
+        LOSVD centre. This gives the same result as signal.fftconvolve(...,mode='same')
+        in the loop of _fitfunc, but with a single multiplication and 
+        inverse FFT for each kinematic component.
+        Returns an array [npix,nspec,ntemp].
+        
+        """
+        ncomp, nspec = losvd_rfft.shape[1:]
+        conv = np.empty((npix, nspec, self.star.shape[1]))
+        for j in range(ncomp):
+            w = self.component == j
+            for k in range(nspec):
+                lft = losvd_rfft[:,j,k]
+                tmp = np.fft.irfft(self._star_rfft[:,w]*lft[:,np.newaxis], self._nfft, axis=0)
+                tmp = tmp[start:start+npix*self.factor,:]
+                if self.factor > 1:
+                    tmp = tmp.reshape(npix,self.factor,-1).mean(axis=1)
+                conv[:,k,w] = tmp
                 
-        m = 1
-        while m != 0:
-            if self.regul > 0:
-                aa = a[np.hstack([self.goodpixels, np.arange(npix*nspec,ncols)]), :]
-                bb = np.hstack([b[self.goodpixels], np.zeros(nreg)])
-            else:
-                aa = a[self.goodpixels,:]
-                bb = b[self.goodpixels]
-            self.weights = _bvls_solve(aa,bb,npoly)
-            self.matrix = c[:npix*nspec,:]
-            self.matrix_unbroad = d[:npix*nspec,:]
-            self.bestfit = c[:npix*nspec,:].dot(self.weights)
-            self.bestfit_unbroad = d[:npix*nspec,:].dot(self.weights)
-            err = (self.galaxy[self.goodpixels] - self.bestfit[self.goodpixels]) \
-                /  self.noise[self.goodpixels]
-            if self.clean is True:
-                w = np.where(np.abs(err) < 3) # select residuals smaller than 3*sigma
-                m = np.size(err) - np.size(w)
-                if m != 0:
-                    self.goodpixels = self.goodpixels[w]
-                    if self.quiet != 1: 
-                        print 'Outliers:', m
-            else: 
-                break
+        return conv
+
+    #------------------------------------------------------------------
+
+    def _losvd_rfft(self, pars, nspec, deriv=False):
+        """
+        Analytic Fourier transform of the Gauss-Hermite LOSVD, evaluated at
+        the frequencies of the real FFT of the padded templates.
+        The Hermite functions are eigenfunctions of the Fourier transform,
+        so that the transform of exp(-y^2/2)*H_m(y) is (-i)^m*exp(-w^2/2)*H_m(w),
+        with w = omega*sigma. The velocity shift is a phase factor.
+        Returns the transforms [nl,ncomp,nspec] of the broadened LOSVD and
+        of the unbroadened one (a Gaussian with sigma of one pixel).
+        If DERIV is set, it also returns the transforms [nl,npars,nspec] of 
+        the derivatives of the LOSVD with respect to each of its parameters.
         
-        # Penalize the solution towards (h3,h4,...)=0 if the inclusion of
-        # these additional terms does not significantly decrease the error.
-        #
-        if np.any(self.moments > 2) and self.bias != 0:
-            p = 0
-            tmp = 0.
-            for j in range(self.ncomp): # loop over kinematic components
+        """
+        omega = np.linspace(0, np.pi, self._nfft//2 + 1) # Angular frequency in rad/pixel
+        losvd = np.empty((omega.size,self.ncomp,nspec), dtype=complex)
+        losvd2 = losvd.copy()
+        if deriv:
+            dlosvd = np.zeros((omega.size,int(self.moments.sum()),nspec), dtype=complex)
+        p = 0
+        for j in range(self.ncomp): # loop over kinematic components
+            for k in range(nspec):    # nspec=2 for two-sided fitting, otherwise nspec=1
+                if k == 0:
+                    s = 1   # s=+1 for left spectrum, s=-1 for right one
+                else:
+                    s = -1
+                vel = self.vsyst + s*pars[0+p]
+                w = omega*pars[1+p]
+                shift = np.exp(-1j*omega*vel)
+                losvd[:,j,k] = shift*np.exp(-0.5*w**2) # Normalized total(Gaussian)=1
+                losvd2[:,j,k] = shift*np.exp(-0.5*omega**2)
+                # Hermite polynomials normalized as in Appendix A of van der Marel & Franx (1993).
+                # These are the physicists' Hermite polynomials divided by sqrt(m!*2^m)
+                #
+                coeff = np.zeros(max(int(self.moments[j]), 2) + 1, dtype=complex)
+                coeff[0] = 1
+                for m in range(3, coeff.size):
+                    norm = np.sqrt(np.prod(np.arange(1., m + 1))*2.**m)
+                    coeff[m] = (-1j*s)**m/norm
+                    if deriv: # d/dh_m
+                        dlosvd[:,m-1+p,k] = losvd[:,j,k]*coeff[m] \
+                            *polynomial.hermite.hermval(w, np.identity(m+1)[m])
+                    coeff[m] *= pars[m-1+p]
+                if deriv: # d/dV and d/dsigma
+                    poly = polynomial.hermite.hermval(w, coeff)
+                    dpoly = polynomial.hermite.hermval(w, polynomial.hermite.hermder(coeff))
+                    dlosvd[:,0+p,k] = -1j*s*omega*losvd[:,j,k]*poly
+                    dlosvd[:,1+p,k] = omega*losvd[:,j,k]*(dpoly - w*poly)
                 if self.moments[j] > 2:
-                    tmp += np.sum(pars[2+p:int(self.moments[j])+p]**2)
-                p += self.moments[j]
-            err += self.bias*robust_sigma(err, zero=True)*np.sqrt(tmp)
+                    losvd[:,j,k] *= polynomial.hermite.hermval(w, coeff)
+            p += int(self.moments[j])
 
-        status = 0
+        if deriv:
+            return losvd, losvd2, dlosvd
+        else:
+            return losvd, losvd2
+
+    #------------------------------------------------------------------
+
+    def _model_deriv(self, pars, mpoly, npars):
+        """
+        Derivatives [npix,npars] of the best fitting model (only one-sided fit)
+        with respect to all the nonlinear parameters, keeping fixed the WEIGHTS
+        computed by the last linear fit. For every kinematic component, the 
+        templates weighted by their WEIGHTS are convolved with the analytic 
+        derivatives of the LOSVD in Fourier space.
+        
+        """
+        npix = self.galaxy.shape[0]
+        ntemp = self.star.shape[1]
+        losvd, losvd2, dlosvd = self._losvd_rfft(pars, 1, deriv=True)
+        npoly = self.degree + 1
+        weights = self.weights[npoly:npoly+ntemp] # Templates weights
+        deriv = np.zeros((npix, pars.size))
+        conv = 0.
+        p = 0
+        for j in range(self.ncomp):
+            w = self.component == j
+            m = int(self.moments[j])
+            tft = self._star_rfft[:,w].dot(weights[w]) # Optimal template of this component
+            tmp = np.fft.irfft(tft[:,np.newaxis]*dlosvd[:,p:p+m,0], self._nfft, axis=0)
+            deriv[:,p:p+m] = np.reshape(mpoly, (-1,1))*tmp[:npix,:]
+            conv += np.fft.irfft(tft*losvd[:,j,0], self._nfft)[:npix]
+            p += m
+
+        x = np.linspace(-1,1,npix)
+        for j in range(1, self.mdegree+1): # d/d(mpoly coefficients)
+            coeff = np.zeros(j+1)
+            coeff[j] = 1.0
+            deriv[:,npars+j-1] = polynomial.legendre.legval(x, coeff)*conv
+        if self.lam != 0: # d/dE(B-V)
+            deriv[:,npars] = mpoly*conv*np.log(reddening_curve(self.lam, 1.))
+        
+        return deriv
+
+#----------------------------------------------------------------------------
+
+class ppxf_batch(object):
+    """
+    Fit with PPXF a stack of spectra sampled on the same logarithmic 
+    wavelength grid and with the same TEMPLATES. The Fourier transform of
+    the templates and the invariant blocks of the design matrix are computed
+    only once and shared by all the fits (see the WORKSPACE keyword of PPXF).
+
+    - GALAXY, NOISE: arrays [nspec, npix] with one spectrum per row.
+    - START: list with the START of PPXF for each spectrum.
+    - GOODPIXELS: list with the GOODPIXELS of each spectrum (default all).
+    All other keywords are passed to PPXF and are the same for all spectra.
+    /BATCH_CONVOLVE is set by default.
+
+    In output:
+    - FITS: list with the PPXF object of each spectrum.
+    - SOL, ERROR: arrays [nspec, nparams] with the solutions and formal 
+      errors of each spectrum. With multiple kinematic components these 
+      are concatenated in order.
+    - CHI2: vector [nspec] with the Chi^2/DOF of each spectrum.
+
+    """
+    def __init__(self, templates, galaxy, noise, velScale, start,
+                 goodpixels=None, **kwargs):
+
+        galaxy = np.atleast_2d(galaxy)
+        noise = np.atleast_2d(noise)
+        nspec = galaxy.shape[0]
+        if noise.shape != galaxy.shape:
+            raise ValueError('GALAXY and NOISE must have the same size/type')
+        if len(start) != nspec:
+            raise ValueError('START must have one element per spectrum')
+        if goodpixels is None:
+            goodpixels = [None]*nspec
+        elif len(goodpixels) != nspec:
+            raise ValueError('GOODPIXELS must have one element per spectrum')
+        kwargs.setdefault('batch_convolve', True)
+
+        # Start from the spectrum with the largest velocity guess: the padding
+        # of its templates Fourier transform is enough for all other spectra,
+        # which therefore use exactly the same transform.
+        #
+        vmax = []
+        for st in start:
+            if np.ndim(st[0]) == 0: # Single kinematic component
+                st = [st]
+            vmax.append(max(abs(s[0]) for s in st))
         
-        return (status, err)
+        workspace = {}
+        self.fits = [None]*nspec
+        for j in np.argsort(vmax)[::-1]:
+            self.fits[j] = ppxf(templates, galaxy[j], noise[j], velScale, 
+                                start[j], goodpixels=goodpixels[j], 
+                                workspace=workspace, **kwargs)
+
+        self.sol = np.array([np.hstack(pp.sol) for pp in self.fits])
+        self.error = np.array([np.hstack(pp.error) for pp in self.fits])
+        self.chi2 = np.array([pp.chi2 for pp in self.fits])
 
 #----------------------------------------------------------------------------
@@ -94,6 +94,7 @@
 #----------------------------------------------------------------------
 
 import numpy as np    
+from scipy import sparse
 
 def log_rebin(lamRange, spec, oversample=False, velscale=None, flux=False):
     """
@@ -144,6 +145,94 @@ def log_rebin(lamRange, spec, oversample=False, velscale=None, flux=False):
 
     return specNew, logLam, velscale
 
+#----------------------------------------------------------------------
+
+class LogRebinner(object):
+    """
+    Same as LOG_REBIN, for any number of spectra with N pixels sampled on 
+    the same linear grid LAMRANGE. The rebinning is precomputed as a sparse
+    matrix, so each call is a single matrix product:
+
+        rebin = LogRebinner(lamRange, n, velscale=velscale)
+        specNew, logLam, velscale = rebin(spec)
+
+    SPEC can be a vector [N] or an array [N, nspec] with one spectrum per 
+    column. Use LOG_REBINNER to share the same object between calls.
+    
+    """
+    def __init__(self, lamRange, n, oversample=False, velscale=None, flux=False):
+
+        lamRange = np.asarray(lamRange, dtype=float)
+        if len(lamRange) != 2:
+            raise ValueError('lamRange must contain two elements')
+        if lamRange[0] >= lamRange[1]:
+            raise ValueError('It must be lamRange[0] < lamRange[1]')
+        if oversample:
+            m = int(n*oversample)
+        else:
+            m = int(n)
+
+        dLam = np.diff(lamRange)/(n - 1.)        # Assume constant dLam
+        lim = lamRange/dLam + [-0.5, 0.5]        # All in units of dLam
+        borders = np.linspace(*lim, num=n+1)     # Linearly
+        logLim = np.log(lim)
+
+        c = 299792.458                           # Speed of light in km/s
+        if velscale is None:                     # Velocity scale is set by user
+            velscale = np.diff(logLim)/m*c       # Only for output
+        else:
+            logScale = velscale/c
+            m = int(np.diff(logLim)/logScale)    # Number of output pixels
+            logLim[1] = logLim[0] + m*logScale
+
+        newBorders = np.exp(np.linspace(*logLim, num=m+1)) # Logarithmically
+        k = (newBorders - lim[0]).clip(0, n-1).astype(int)
+
+        # Row i integrates the input pixels k[i] <= j < k[i+1] and adds the
+        # fractions of the pixels k[i+1] and k[i] at the borders, like the 
+        # np.add.reduceat() implementation of LOG_REBIN.
+        #
+        cnt = np.diff(k)
+        rows = np.repeat(np.arange(m), cnt)
+        cols = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt) \
+             + np.repeat(k[:-1], cnt)
+        frac = newBorders - borders[k]
+        rows = np.hstack([rows, np.arange(m), np.arange(m)])
+        cols = np.hstack([cols, k[1:], k[:-1]])
+        vals = np.hstack([np.ones(cnt.sum()), frac[1:], -frac[:-1]])
+        if not flux:
+            vals /= np.diff(newBorders)[rows]
+        self.matrix = sparse.csr_matrix((vals, (rows, cols)), shape=(m, n))
+
+        self.n = n
+        self.velscale = velscale
+        # Output log(wavelength): log of geometric mean
+        self.logLam = np.log(np.sqrt(newBorders[1:]*newBorders[:-1])*dLam)
+
+    def __call__(self, spec):
+
+        if spec.shape[0] != self.n:
+            raise ValueError('input spectrum must have %d pixels' % self.n)
+
+        return self.matrix.dot(spec), self.logLam, self.velscale
+
+#----------------------------------------------------------------------
+
+_rebinners = {}
+
+def log_rebinner(lamRange, n, oversample=False, velscale=None, flux=False):
+    """
+    Return the LogRebinner for the given grid and options, which is built 
+    only in the first call and shared by all the following ones.
+    
+    """
+    key = (tuple(np.asarray(lamRange, dtype=float)), int(n), oversample, 
+           velscale, flux)
+    if key not in _rebinners:
+        _rebinners[key] = LogRebinner(lamRange, n, oversample=oversample, 
+                                      velscale=velscale, flux=flux)
+    return _rebinners[key]
+
 #----------------------------------------------------------------------
 #
 # PPXF_DETERMINE_GOODPIXELS: Example routine to generate the vector of goodPixels 
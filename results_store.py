@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 18/10/26
+
+@author: cbarbosa
+
+Columnar store for the results of the pipeline.
+
+Each stage (pPXF tables, Lick indices, MC errors) appends its results to
+one .npz file in the working directory, as tables of floats with one row
+per spectrum, and the following stages read them back from there. The
+fixed-width text tables are only exports of the store.
+
+The realizations of the MC simulations of the Lick indices are kept in a
+separate MCStore, a float32 array (nspec, nsim, nindex) mapped from disk.
+"""
+import os
+
+import numpy as np
+
+store_file = "results.npz"
+
+class ResultsStore(object):
+    """ Tables of results keyed by the name of the spectrum.
+
+    Tables are named after the text file they are exported to, without the
+    extension, e.g. "lick_vdcorr_instres" for lick_vdcorr_instres.tsv:
+
+        store = ResultsStore()
+        store.append("lick_vdcorr_instres", specs, lick, columns=names)
+        specs, lick = store.read("lick_vdcorr_instres")
+        store.export("lick_vdcorr_instres", "lick_vdcorr_instres.tsv")
+
+    """
+    def __init__(self, filename=store_file):
+        self.filename = filename
+        self.load()
+
+    def load(self):
+        """ Read all tables from disk. """
+        self.tables = {}
+        if not os.path.exists(self.filename):
+            return
+        arrays = np.load(self.filename)
+        for key in arrays.files:
+            table, field = key.rsplit("/", 1)
+            self.tables.setdefault(table, {})[field] = arrays[key]
+        arrays.close()
+
+    def save(self):
+        """ Write all tables to disk, replacing the file only at the end. """
+        arrays = {}
+        for table in self.tables:
+            for field, value in self.tables[table].items():
+                arrays["{0}/{1}".format(table, field)] = value
+        tmp = "{0}.tmp{1}".format(self.filename, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.rename(tmp, self.filename)
+
+    def __contains__(self, table):
+        return table in self.tables
+
+    def append(self, table, spectra, data, columns=None, comments=None,
+               fingerprints=None):
+        """ Add the rows of data for the given spectra to a table.
+
+        Rows of spectra already in the table are replaced and new spectra
+        are added at the end. comments marks rows which are kept in the
+        store but are commented out in the exports and skipped by read.
+        fingerprints are the checksums of the inputs of each row (see
+        run_ppxf.fingerprint), which allow to skip spectra whose inputs did
+        not change in the next run. The store is reloaded before and saved
+        after the update, so that tables written by other stages are kept.
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=float))
+        spectra = np.array(spectra, dtype=str)
+        if len(spectra) != len(data):
+            raise ValueError("There must be one row of data for each spectrum")
+        if comments is None:
+            comments = np.zeros(len(spectra), dtype=bool)
+        if fingerprints is None:
+            fingerprints = [""] * len(spectra)
+        self.load()
+        if table in self.tables:
+            t = self.tables[table]
+            if t["data"].shape[1] != data.shape[1]:
+                raise ValueError("Table {0} has {1} columns".format(table,
+                                 t["data"].shape[1]))
+            old = t["spectra"].tolist()
+            new = [s for s in spectra.tolist() if s not in old]
+            names = np.array(old + new, dtype=str)
+            values = np.vstack((t["data"], np.zeros((len(new),
+                                                     data.shape[1]))))
+            flags = np.hstack((t["comments"], np.zeros(len(new), dtype=bool)))
+            checksums = t.get("fingerprints", np.array([""] * len(old))).tolist() \
+                        + [""] * len(new)
+            idx = np.array([(old + new).index(s) for s in spectra.tolist()],
+                           dtype=int)
+            values[idx] = data
+            flags[idx] = comments
+            for j, fp in zip(idx, fingerprints):
+                checksums[j] = fp
+            t.update({"spectra" : names, "data" : values, "comments" : flags,
+                      "fingerprints" : np.array(checksums, dtype=str)})
+            if columns is not None:
+                t["columns"] = np.array(columns, dtype=str)
+        else:
+            if columns is None:
+                columns = ["col{0}".format(i+1) for i in range(data.shape[1])]
+            self.tables[table] = {"spectra" : spectra, "data" : data,
+                                  "comments" : np.array(comments, dtype=bool),
+                                  "columns" : np.array(columns, dtype=str),
+                                  "fingerprints" : np.array(fingerprints,
+                                                            dtype=str)}
+        self.save()
+
+    def fingerprint(self, table, spec):
+        """ Fingerprint stored with the row of spec in a table, or None if
+        the spectrum is not in the table. """
+        if table not in self.tables:
+            return None
+        t = self.tables[table]
+        names = t["spectra"].tolist()
+        if spec not in names or "fingerprints" not in t:
+            return None
+        return t["fingerprints"][names.index(spec)]
+
+    def read(self, table, usecols=None, comments=False):
+        """ Return the list of spectra and the array of data of a table.
+
+        usecols are the indices of the columns of the data, and commented
+        rows are only returned if comments is True.
+        """
+        if table not in self.tables:
+            raise KeyError("Table {0} not found in {1}".format(table,
+                           self.filename))
+        t = self.tables[table]
+        rows = np.ones(len(t["spectra"]), dtype=bool) if comments else \
+               ~t["comments"]
+        data = t["data"][rows]
+        if usecols is not None:
+            data = data[:, usecols]
+        return t["spectra"][rows].tolist(), data
+
+    def export(self, table, output, header=None, namefmt="{0:28s}",
+               fmt="{0:<14.5f}", spectra=None):
+        """ Write a table as fixed-width text.
+
+        fmt is the format of the values, either a string or a list with one
+        format for each column, and header is the first line of the file.
+        Only the rows of spectra are written if they are given, in the same
+        order.
+        """
+        t = self.tables[table]
+        ncols = t["data"].shape[1]
+        fmts = [fmt] * ncols if isinstance(fmt, basestring) else fmt
+        lines = [] if header is None else [header.rstrip("\n")]
+        idx = np.arange(len(t["spectra"]))
+        if spectra is not None:
+            names = t["spectra"].tolist()
+            idx = np.array([names.index(x) for x in spectra if x in names],
+                           dtype=int)
+        for spec, row, comment in zip(t["spectra"][idx], t["data"][idx],
+                                      t["comments"][idx]):
+            name = "#" + spec if comment else spec
+            lines.append(namefmt.format(name) +
+                         "".join([f.format(x) for f, x in zip(fmts, row)]))
+        with open(output, "w") as f:
+            f.write("\n".join(lines))
+
+class MCStore(object):
+    """ Realizations of the MC simulations of a list of spectra.
+
+    The simulations are kept in files with the same basename, e.g.
+    mc_logs/lick_nsim400:
+
+        .shape    nsim and nindex, written when the store is made
+        .f32      float32 array (nspec, nsim, nindex) in C order
+        .mask     uint8 array (nspec, nsim), set for the simulations done
+        .nsim     int32 array (nspec,), number of simulations of the
+                  spectra finished before nsim (see finish)
+        .spectra  names of the spectra, one per line
+
+    New spectra are appended at the end of the files, and the simulations
+    are written in place, so that chunks of simulations of different
+    spectra can be written by different processes. An existing store can
+    be opened without nsim and nindex, which are read from the .shape file,
+    and a ValueError is raised if the values given do not match it.
+
+        store = MCStore("mc_logs/lick_nsim400", 400)
+        store.add(specs)
+        store.write(spec, 0, lick_sim)
+        specs, mad = MCStore("mc_logs/lick_nsim400").mad()
+
+    """
+    def __init__(self, basename, nsim=None, nindex=None):
+        self.basename = basename
+        self.shapefile = basename + ".shape"
+        self.datafile = basename + ".f32"
+        self.maskfile = basename + ".mask"
+        self.nsimfile = basename + ".nsim"
+        self.namesfile = basename + ".spectra"
+        if os.path.exists(self.shapefile):
+            with open(self.shapefile) as f:
+                shape = [int(x) for x in f.read().split()]
+            if nsim not in (None, shape[0]) or nindex not in (None, shape[1]):
+                raise ValueError("Store {0} has simulations ({1}, {2}), not "
+                                 "({3}, {4})".format(basename, shape[0],
+                                 shape[1], nsim, nindex))
+            nsim, nindex = shape
+        elif nsim is None:
+            raise ValueError("Store {0} does not exist, nsim is needed to "
+                             "make it".format(basename))
+        self.nsim = nsim
+        self.nindex = 25 if nindex is None else nindex
+
+    @property
+    def spectra(self):
+        """ Names of the spectra in the store. """
+        if not os.path.exists(self.namesfile):
+            return []
+        with open(self.namesfile) as f:
+            return [x.strip() for x in f if x.strip()]
+
+    def add(self, spectra):
+        """ Allocate the simulations of spectra not yet in the store. """
+        old = self.spectra
+        new = []
+        for spec in spectra:
+            if spec not in old and spec not in new:
+                new.append(spec)
+        nspec = len(old) + len(new)
+        if not os.path.exists(self.shapefile):
+            with open(self.shapefile, "w") as f:
+                f.write("{0} {1}\n".format(self.nsim, self.nindex))
+        # The files are extended with zeros before the names are written,
+        # so that all spectra in the list always have their space on disk
+        for filename, size in [(self.datafile,
+                                nspec * self.nsim * self.nindex * 4),
+                               (self.maskfile, nspec * self.nsim),
+                               (self.nsimfile, nspec * 4)]:
+            if os.path.exists(filename) and os.path.getsize(filename) >= size:
+                continue
+            with open(filename, "ab") as f:
+                f.truncate(size)
+        if not new:
+            return
+        with open(self.namesfile, "a") as f:
+            f.write("".join([x + "\n" for x in new]))
+
+    def arrays(self, mode="r"):
+        """ Memory maps of the simulations and of the mask. """
+        nspec = len(self.spectra)
+        if nspec == 0:
+            return np.zeros((0, self.nsim, self.nindex), dtype=np.float32), \
+                   np.zeros((0, self.nsim), dtype=np.uint8)
+        data = np.memmap(self.datafile, dtype=np.float32, mode=mode,
+                         shape=(nspec, self.nsim, self.nindex))
+        mask = np.memmap(self.maskfile, dtype=np.uint8, mode=mode,
+                         shape=(nspec, self.nsim))
+        return data, mask
+
+    def write(self, spec, start, values):
+        """ Write the simulations start:start+len(values) of a spectrum. """
+        values = np.atleast_2d(values)
+        if values.shape[1] != self.nindex or \
+           start + len(values) > self.nsim:
+            raise ValueError("Simulations must fit in an array ({0}, {1})"
+                             .format(self.nsim, self.nindex))
+        i = self.spectra.index(spec)
+        data, mask = self.arrays("r+")
+        data[i, start:start+len(values)] = values
+        data.flush()
+        # The mask is only set after the data is on disk
+        mask[i, start:start+len(values)] = 1
+        mask.flush()
+        del data, mask
+
+    def finish(self, spec, n):
+        """ Record that the simulations of a spectrum stop at the first n,
+        e.g. because the errors converged before nsim simulations. """
+        i = self.spectra.index(spec)
+        nsims = np.memmap(self.nsimfile, dtype=np.int32, mode="r+",
+                          shape=(len(self.spectra),))
+        nsims[i] = n
+        nsims.flush()
+        del nsims
+
+    def achieved(self):
+        """ Number of simulations of each spectrum, either the number set
+        by finish or nsim if all simulations are done, and zero for the
+        spectra which are not finished. """
+        mask = self.arrays()[1]
+        if len(mask) == 0:
+            return np.zeros(0, dtype=int)
+        nsims = np.array(np.memmap(self.nsimfile, dtype=np.int32, mode="r",
+                                   shape=(len(mask),)), dtype=int)
+        return np.where(mask.all(axis=1), self.nsim, nsims)
+
+    def filled(self, spec):
+        """ Mask of the simulations of a spectrum which are done. """
+        if spec not in self.spectra:
+            return np.zeros(self.nsim, dtype=bool)
+        mask = self.arrays()[1]
+        return np.array(mask[self.spectra.index(spec)], dtype=bool)
+
+    def done(self):
+        """ Spectra with all simulations done or finished early. """
+        return [x for x, n in zip(self.spectra, self.achieved()) if n > 0]
+
+    def read(self, spec):
+        """ Array (nsim, nindex) with the simulations of a spectrum. """
+        data = self.arrays()[0]
+        return np.array(data[self.spectra.index(spec)])
+
+    def running_mad(self, spec, step, cols=None):
+        """ MAD of the first n simulations of a spectrum, for n multiple of
+        step up to the first simulation not done.
+
+        Returns the array of n and the array (len(n), ncols) of MADs of the
+        columns cols, or of all columns if cols is None. """
+        filled = self.filled(spec)
+        nfilled = len(filled) if filled.all() else np.argmin(filled)
+        ns = np.arange(step, nfilled + 1, step)
+        if nfilled % step:
+            ns = np.append(ns, nfilled)
+        data = self.read(spec)
+        if cols is not None:
+            data = data[:,cols]
+        trace = np.zeros((len(ns), data.shape[1]))
+        for j, n in enumerate(ns):
+            trace[j] = mad(data[:n])
+        return ns, trace
+
+    def mad(self, spectra=None):
+        """ Median absolute deviation of the simulations of each spectrum.
+
+        Only finished spectra are used (see achieved), in the order of
+        spectra if they are given. Returns the list of spectra and the array
+        (nspec, nindex) of MADs, scaled to the standard deviation.
+        """
+        names = self.spectra
+        nsims = self.achieved()
+        if spectra is None:
+            spectra = names
+        spectra = [x for x in spectra if x in names and
+                   nsims[names.index(x)] > 0]
+        idx = np.array([names.index(x) for x in spectra], dtype=int)
+        data = self.arrays()[0]
+        mads = np.zeros((len(spectra), self.nindex))
+        # Spectra with the same number of simulations are reduced together
+        for n in np.unique(nsims[idx]):
+            sel = np.flatnonzero(nsims[idx] == n)
+            mads[sel] = mad(np.asarray(data[idx[sel], :n], dtype=float),
+                            axis=1)
+        return spectra, mads
+
+def mad(data, axis=0):
+    """ Median absolute deviation along an axis, scaled to the standard
+    deviation of a normal distribution. """
+    median = np.expand_dims(np.median(data, axis=axis), axis)
+    return 1.4826 * np.median(np.abs(data - median), axis=axis)
+
+def mad_stderr(data, nboot=200, seed=0):
+    """ Bootstrap standard error of the MAD of each column of data. """
+    rng = np.random.RandomState(seed)
+    idx = rng.randint(len(data), size=(nboot, len(data)))
+    return np.std(mad(data[idx], axis=1), axis=0)
+
+def mc_converged(data, rtol, nmin=None, nboot=200):
+    """ Check if the MADs of the simulations data, an array (n, ncols), are
+    known with a relative precision rtol, i.e., if the bootstrap standard
+    errors of the MADs are smaller than rtol times the MADs for all columns.
+
+    At least nmin simulations are required. For normal errors, the standard
+    error of the MAD is about 1.17 MAD / sqrt(n), so that by default nmin
+    is (1.17 / rtol)**2, and a bootstrap of a few lucky simulations cannot
+    stop them earlier. Columns with undefined values, e.g. of indices
+    outside the spectrum, are ignored. """
+    if nmin is None:
+        nmin = int(np.ceil((1.17 / rtol)**2))
+    if len(data) < max(nmin, 2):
+        return False
+    data = data[:,np.all(np.isfinite(data), axis=0)]
+    # The seed only depends on n, so that the check is reproducible
+    return bool(np.all(mad_stderr(data, nboot, seed=len(data)) <=
+                       rtol * mad(data)))
+
+def read_table(filename, usecols, store=None):
+    """ Read the names of the spectra and the columns usecols of a text table,
+    from the store in the same directory if the table is there.
+
+    The columns are numbered as in the text file, where the first column
+    is the name of the spectrum, so that this function replaces
+
+        specs = np.genfromtxt(filename, usecols=(0,), dtype=None).tolist()
+        data = np.loadtxt(filename, usecols=usecols)
+    """
+    table = os.path.splitext(os.path.basename(filename))[0]
+    if store is None:
+        store = ResultsStore(os.path.join(os.path.dirname(filename),
+                                          store_file))
+    if table in store:
+        return store.read(table, usecols=np.array(usecols) - 1)
+    specs = np.genfromtxt(filename, usecols=(0,), dtype=None).tolist()
+    data = np.loadtxt(filename, usecols=usecols)
+    return specs, data
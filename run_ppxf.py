@@ -8,6 +8,9 @@ Program to run pPXF on hydra I data
 """
 import os
 import pickle
+import hashlib
+import traceback
+from multiprocessing import Pool
 
 import numpy as np
 import pyfits as pf
@@ -15,21 +18,19 @@ from scipy import ndimage
 from scipy.signal import medfilt
 from scipy.interpolate import interp1d
 
-from ppxf import ppxf
+from ppxf import ppxf, ppxf_batch
 import ppxf_util as util
 from config import *
 from load_templates import stellar_templates, emission_templates, \
                             wavelength_array
+from results_store import ResultsStore, mc_converged
  
-def run_ppxf(spectra, velscale, ncomp=2, has_emission=True, mdegree=-1,
-             degree=20, pkls=None, plot=False, data_sky=None):
-    """ Run pPXF in a list of spectra"""
-    if isinstance(spectra, str):
-        spectra = [spectra]
-    if isinstance(pkls, str):
-        pkls = [pkls]
-    if pkls == None:
-        pkls = [x.replace(".fits", ".pkl") for x in spectra]
+def load_fit_templates(velscale, ncomp=2, has_emission=True):
+    """ Load the stellar and gas templates and set the kinematic components.
+
+    Returns the templates, the kinematic components and moments, the names
+    of the templates, the log-wavelength of the templates and their
+    wavelength step (in Angstrom). """
     ##########################################################################
     # Load templates for both stars and gas
     star_templates, logLam2, delta, miles= stellar_templates(velscale)
@@ -53,77 +54,219 @@ def run_ppxf(spectra, velscale, ncomp=2, has_emission=True, mdegree=-1,
 
     else:
         raise Exception("ncomp has to be 1 or 2.")
+    return templates, components, moments, templates_names, logLam2, delta
+
+def fit_spectrum(spec, pkl, velscale, templates, components, moments,
+                 logLam2, delta, ncomp=2, mdegree=-1, degree=20, plot=False,
+                 sky_file=None):
+    """ Run pPXF in one spectrum and save the result in a pkl file. """
+    ######################################################################
+    # Read one galaxy spectrum and define the wavelength range
+    specfile = os.path.join(data_dir, spec)
+    hdu = pf.open(specfile)
+    spec_lin = hdu[0].data
+    h1 = pf.getheader(specfile)
+    lamRange1 = h1['CRVAL1'] + np.array([0.,h1['CDELT1']*(h1['NAXIS1']-1)])
+    ######################################################################
+    # Degrade observed spectra to match template resolution
+    FWHM_dif = np.sqrt(FWHM_tem**2 - FWHM_spec**2)
+    sigma = FWHM_dif/2.355/delta # Sigma difference in pixels
+    spec_lin = ndimage.gaussian_filter1d(spec_lin,sigma)
+    ######################################################################
+    # Rebin to log scale, with the operator shared by spectra and sky
+    rebin = util.log_rebinner(lamRange1, spec_lin.size, velscale=velscale)
+    galaxy, logLam1, velscale = rebin(spec_lin)
+    ######################################################################
+    # First guess for the noise
+    noise = np.ones_like(galaxy) * np.std(galaxy - medfilt(galaxy, 5))
+    ######################################################################
+    # Calculate difference of velocity between spectrum and templates
+    # due to different initial wavelength
+    dv = (logLam2[0]-logLam1[0])*c
+    ######################################################################
+    # Set first guess from setup files
+    start, goodPixels = read_setup_file(spec, logLam1, mask_emline=False)
+    ######################################################################
+    # Expand start variable to include multiple components
+    if ncomp > 1:
+        start = [start, [start[0], 30]]
+    ######################################################################
+    # Read sky in needed
+    if sky_file == None:
+        sky = None
+    else:
+        sky_lin = pf.getdata(sky_file)
+        sky_lin = ndimage.gaussian_filter1d(sky_lin,sigma)
+        sky, logLam1, velscale = rebin(sky_lin)
+        sky = sky.reshape(-1,1)
+    ######################################################################
+    # First pPXF interaction. The noise of a previous fit is read directly
+    # from its pkl file, without loading the templates again.
+    if os.path.exists(spec.replace(".fits", ".pkl")):
+        with open(spec.replace(".fits", ".pkl")) as f:
+            noise0 = pickle.load(f).noise
+    else:
+        pp0 = ppxf(templates, galaxy, noise, velscale, start,
+                   goodpixels=goodPixels, plot=False, moments=moments,
+                   degree=12, mdegree=-1, vsyst=dv, component=components,
+                   sky=sky)
+        rms0 = galaxy[goodPixels] - pp0.bestfit[goodPixels]
+        noise0 = 1.4826 * np.median(np.abs(rms0 - np.median(rms0)))
+        noise0 = np.zeros_like(galaxy) + noise0
+    # Second pPXF interaction, realistic noise estimation
+    pp = ppxf(templates, galaxy, noise0, velscale, start,
+              goodpixels=goodPixels, plot=plot, moments=moments,
+              degree=degree, mdegree=mdegree, vsyst=dv,
+              component=components, sky=sky)
+    # pp.template_files = templates_names
+    # pp.has_emission = has_emission
+    ######################################################################
+    # Save to output file to keep session
+    save_atomic(pkl, pickle.dumps(pp))
+    return
+
+def save_atomic(filename, data):
+    """ Write a string to a file without leaving partial files behind.
+
+    The data is written to a temporary file in the same directory, which is
+    then renamed, so an interrupted run never corrupts a previous result. """
+    tmp = "{0}.{1}.tmp".format(filename, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.rename(tmp, filename)
+    return
+
+def run_ppxf(spectra, velscale, ncomp=2, has_emission=True, mdegree=-1,
+             degree=20, pkls=None, plot=False, data_sky=None):
+    """ Run pPXF in a list of spectra"""
+    if isinstance(spectra, str):
+        spectra = [spectra]
+    if isinstance(pkls, str):
+        pkls = [pkls]
+    if pkls == None:
+        pkls = [x.replace(".fits", ".pkl") for x in spectra]
+    templates, components, moments, templates_names, logLam2, delta = \
+                         load_fit_templates(velscale, ncomp, has_emission)
     for i, spec in enumerate(spectra):
         print "pPXF run of spectrum {0} ({1} of {2})".format(spec, i+1,
               len(spectra))
-        pkl = pkls[i]
-        ######################################################################
-        # Read one galaxy spectrum and define the wavelength range
-        specfile = os.path.join(data_dir, spec)
-        hdu = pf.open(specfile)
-        spec_lin = hdu[0].data
-        h1 = pf.getheader(specfile)
-        lamRange1 = h1['CRVAL1'] + np.array([0.,h1['CDELT1']*(h1['NAXIS1']-1)])
-        ######################################################################
-        # Degrade observed spectra to match template resolution
-        FWHM_dif = np.sqrt(FWHM_tem**2 - FWHM_spec**2)
-        sigma = FWHM_dif/2.355/delta # Sigma difference in pixels
-        spec_lin = ndimage.gaussian_filter1d(spec_lin,sigma)
-        ######################################################################
-        # Rebin to log scale
-        galaxy, logLam1, velscale = util.log_rebin(lamRange1, spec_lin, 
-                                                   velscale=velscale)
-        ######################################################################
-        # First guess for the noise
-        noise = np.ones_like(galaxy) * np.std(galaxy - medfilt(galaxy, 5))
-        ######################################################################
-        # Calculate difference of velocity between spectrum and templates
-        # due to different initial wavelength
-        dv = (logLam2[0]-logLam1[0])*c
-        ######################################################################
-        # Set first guess from setup files
-        start, goodPixels = read_setup_file(spec, logLam1, mask_emline=False)
-        ######################################################################
-        # Expand start variable to include multiple components
-        if ncomp > 1:
-            start = [start, [start[0], 30]]
-        ######################################################################
-        # Read sky in needed
-        if data_sky == None:
-            sky = None
-        else:
-            sky_lin = pf.getdata(data_sky[i])
-            sky_lin = ndimage.gaussian_filter1d(sky_lin,sigma)
-            sky, logLam1, velscale = util.log_rebin(lamRange1, sky_lin,
-                                                    velscale=velscale)
-            sky = sky.reshape(-1,1)
-        ######################################################################
-        # First pPXF interaction
-        if os.path.exists(spec.replace(".fits", ".pkl")):
-            pp0 = pPXF(spec, velscale, pklfile=spec.replace(".fits", ".pkl"))
-            noise0 = pp0.noise
+        sky_file = None if data_sky == None else data_sky[i]
+        fit_spectrum(spec, pkls[i], velscale, templates, components, moments,
+                     logLam2, delta, ncomp=ncomp, mdegree=mdegree,
+                     degree=degree, plot=plot, sky_file=sky_file)
+    return
+
+def fingerprint(filenames, *args):
+    """ MD5 checksum of the contents of files and of other inputs.
+
+    Filenames set to None are ignored. Arrays are hashed by their data, and
+    any other argument by its representation. """
+    md5 = hashlib.md5()
+    for filename in filenames:
+        if filename is None:
+            continue
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                md5.update(block)
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            md5.update(np.ascontiguousarray(arg).data)
         else:
-            pp0 = ppxf(templates, galaxy, noise, velscale, start,
-                       goodpixels=goodPixels, plot=False, moments=moments,
-                       degree=12, mdegree=-1, vsyst=dv, component=components,
-                       sky=sky)
-            rms0 = galaxy[goodPixels] - pp0.bestfit[goodPixels]
-            noise0 = 1.4826 * np.median(np.abs(rms0 - np.median(rms0)))
-            noise0 = np.zeros_like(galaxy) + noise0
-        # Second pPXF interaction, realistic noise estimation
-        pp = ppxf(templates, galaxy, noise0, velscale, start,
-                  goodpixels=goodPixels, plot=plot, moments=moments,
-                  degree=degree, mdegree=mdegree, vsyst=dv,
-                  component=components, sky=sky)
-        # pp.template_files = templates_names
-        # pp.has_emission = has_emission
-        ######################################################################
-        # Save to output file to keep session
-        with open(pkl, "w") as f:
-            pickle.dump(pp, f)
-        ######################################################################
+            md5.update(repr(arg))
+    return md5.hexdigest()
+
+_worker = {}
+
+def _init_worker(velscale, ncomp, has_emission):
+    """ Load the templates only once in each process of the pool. """
+    _worker["templates"] = load_fit_templates(velscale, ncomp, has_emission)
     return
 
+def _fit_worker(task):
+    """ Fit one spectrum in a process of the pool.
+
+    Errors are returned instead of raised, so that one bad spectrum does not
+    stop the whole run. """
+    spec, pkl, velscale, ncomp, mdegree, degree, sky_file = task
+    templates, components, moments, templates_names, logLam2, delta = \
+                                                        _worker["templates"]
+    try:
+        fit_spectrum(spec, pkl, velscale, templates, components, moments,
+                     logLam2, delta, ncomp=ncomp, mdegree=mdegree,
+                     degree=degree, sky_file=sky_file)
+    except Exception:
+        return spec, pkl, traceback.format_exc()
+    return spec, pkl, None
+
+def run_ppxf_pool(spectra, velscale, ncomp=2, has_emission=True, mdegree=-1,
+                  degree=20, pkls=None, data_sky=None, nprocs=None,
+                  force=False):
+    """ Run pPXF in a list of spectra using a pool of processes.
+
+    ===================
+    Input Parameters
+    ===================
+    spectra, velscale, ncomp, has_emission, mdegree, degree, pkls, data_sky :
+        Same as in run_ppxf.
+    nprocs : int
+        Number of processes. Default is the number of CPUs.
+    force : bool
+        Fit all spectra. By default, spectra are skipped if their pkl file
+        was produced with the same FITS, setup and sky files, templates and
+        fitting options.
+
+    ==================
+    Output
+    ==================
+    Each pkl file is written atomically as soon as its fit is done, followed
+    by a file with the same name plus ".md5", containing the checksum of
+    the inputs. Returns the list of spectra which could not be fitted.
+
+    """
+    if isinstance(spectra, str):
+        spectra = [spectra]
+    if isinstance(pkls, str):
+        pkls = [pkls]
+    if pkls == None:
+        pkls = [x.replace(".fits", ".pkl") for x in spectra]
+    templates = load_fit_templates(velscale, ncomp, has_emission)[0]
+    options = fingerprint([], templates, velscale, ncomp, has_emission,
+                          mdegree, degree)
+    ##########################################################################
+    # Select spectra whose inputs changed since the last run
+    tasks, md5s = [], {}
+    for i, (spec, pkl) in enumerate(zip(spectra, pkls)):
+        sky_file = None if data_sky == None else data_sky[i]
+        setup = os.path.join(home, "single1", spec + ".setup")
+        md5s[pkl] = fingerprint([os.path.join(data_dir, spec), setup,
+                                 sky_file], options)
+        md5file = pkl + ".md5"
+        if not force and os.path.exists(pkl) and os.path.exists(md5file):
+            with open(md5file) as f:
+                if f.read().strip() == md5s[pkl]:
+                    continue
+        tasks.append((spec, pkl, velscale, ncomp, mdegree, degree, sky_file))
+    print "pPXF run of {0} spectra ({1} unchanged)".format(len(tasks),
+                                                  len(spectra) - len(tasks))
+    if not tasks:
+        return []
+    ##########################################################################
+    pool = Pool(nprocs, _init_worker, (velscale, ncomp, has_emission))
+    failed = []
+    try:
+        for i, (spec, pkl, err) in enumerate(pool.imap_unordered(_fit_worker,
+                                                                 tasks)):
+            if err is None:
+                save_atomic(pkl + ".md5", md5s[pkl] + "\n")
+                print "Done {0} ({1} of {2})".format(spec, i+1, len(tasks))
+            else:
+                failed.append(spec)
+                print "Failed {0}:\n{1}".format(spec, err)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
 def read_setup_file(gal, logw, mask_emline=True):
     """ Read setup file to set first guess and regions to be avoided. """
     w = np.exp(logw)
@@ -183,7 +326,9 @@ def make_table(spectra, output, mc=False, nsim=200, clean=True, pkls=None):
     Output file
     ==================
     In case mc is False, the function produces a file called ppxf_results.dat.
-    Otherwise, the name of the file is named ppfx_results_mc_nsim.dat.
+    Otherwise, the name of the file is named ppfx_results_mc_nsim.dat. The
+    results are stored in the table of the results store with the same name
+    as the output, and the file is an export of that table.
 
     """
     print "Producing summary table..."
@@ -191,12 +336,11 @@ def make_table(spectra, output, mc=False, nsim=200, clean=True, pkls=None):
              "{8:<14}{9:<14}{10:<14}{11:<14}{12:<14}{13:<14}\n".format("# FILE",
              "V", "dV", "S", "dS", "h3", "dh3", "h4", "dh4", "chi/DOF",
              "S/N", "ADEGREE", "MDEGREE", "100*S/N/sigma"))
-    results = []
-    ##########################################################################
-    # Initiate the output file
-    ##########################################################################
-    with open(output, "w") as f:
-        f.write(head)
+    columns = ["V", "dV", "S", "dS", "h3", "dh3", "h4", "dh4", "chi/DOF",
+               "S/N", "ADEGREE", "MDEGREE", "100*S/N/sigma"]
+    table = os.path.splitext(os.path.basename(output))[0]
+    store = ResultsStore()
+    done, rows, comments = [], [], []
     ##########################################################################
     if pkls== None:
         pkls = [x.replace(".fits", ".pkl") for x in spectra]
@@ -216,18 +360,21 @@ def make_table(spectra, output, mc=False, nsim=200, clean=True, pkls=None):
             pp.error = pp.error[0]
         data = [pp.sol[0], pp.error[0],
                 pp.sol[1], pp.error[1], pp.sol[2], pp.error[2], pp.sol[3],
-                pp.error[3], pp.chi2, sn]
-        data = ["{0:12.3f} ".format(x) for x in data]
-        if clean and pp.sol[1] == 1000.:
-            comment = "#"
-        else:
-            comment = ""
-        line = ["{0}{1}".format(comment, spec)] + data + \
-               ["{0:12}".format(pp.degree), "{0:12}".format(pp.mdegree),
-                "{0:12.3f}".format(100 * sn / pp.sol[1])]
-        # Append results to outfile
-        with open(output, "a") as f:
-            f.write("".join(line) + "\n")
+                pp.error[3], pp.chi2, sn, pp.degree, pp.mdegree,
+                100 * sn / pp.sol[1]]
+        comments.append(clean and pp.sol[1] == 1000.)
+        rows.append(data)
+        done.append(spec)
+    ##########################################################################
+    # Results go to the store in a single update, and the table is exported
+    # as text from it
+    ##########################################################################
+    if done:
+        store.append(table, done, rows, columns=columns, comments=comments)
+    if table in store:
+        fmt = ["{0:12.3f} "] * 10 + ["{0:12.0f}"] * 2 + ["{0:12.3f}"]
+        store.export(table, output, header=head, namefmt="{0}", fmt=fmt,
+                     spectra=done)
 
 class pPXF():
     """ Class to read pPXF pkl files """
@@ -245,8 +392,9 @@ class pPXF():
         self.velscale = velscale
         self.w = wavelength_array(os.path.join(data_dir, spec))
         self.flux = pf.getdata(self.spec)
-        self.flux_log, self.logw, velscale = util.log_rebin(
-                        [self.w[0], self.w[-1]], self.flux, velscale=velscale)
+        self.flux_log, self.logw, velscale = util.log_rebinner(
+                        [self.w[0], self.w[-1]], self.flux.size,
+                        velscale=velscale)(self.flux)
         self.w_log = np.exp(self.logw)
         self.header = pf.getheader(os.path.join(data_dir, spec))
         self.lam = self.header['CRVAL1'] + np.array([0.,
@@ -263,8 +411,8 @@ class pPXF():
         ######################################################################
         spec_lin = ndimage.gaussian_filter1d(self.flux,sigma)
         # Rebin to logarithm scale
-        galaxy, self.logLam1, velscale = util.log_rebin(self.lam, spec_lin,
-                                                   velscale=velscale)
+        galaxy, self.logLam1, velscale = util.log_rebinner(self.lam,
+                                spec_lin.size, velscale=velscale)(spec_lin)
         self.dv = (self.logLam2[0]-self.logLam1[0])*c
         # if self.sky != None:
         #     sky = self.weights[-1] * self.sky.T[0]
@@ -285,8 +433,39 @@ class pPXF():
         self.sn = self.signal / self.noise
         return
 
-    def mc_errors(self, nsim=200):
-        """ Calculate the errors using MC simulations"""
+    def mc_errors(self, nsim=200, fast=False, seed=None, nprocs=1, chunk=50,
+                  rtol=None, nmin=None):
+        """ Calculate the errors using MC simulations
+
+        ===================
+        Input Parameters
+        ===================
+        nsim : int
+            Number of simulations (maximum number if rtol is set).
+        fast : bool
+            Fit the simulations in batches with ppxf_batch, which computes
+            only once the Fourier transform of the template. The options
+            below are only used in this mode.
+        seed : int
+            Seed of the random noise, for reproducible results.
+        nprocs : int
+            Number of processes used to fit each batch.
+        chunk : int
+            Number of simulations in each batch.
+        rtol : float
+            Stop the simulations when the bootstrap standard errors of all
+            the errors are smaller than rtol times the errors, i.e., when
+            the errors are known with a relative precision rtol (see
+            results_store.mc_converged). The number of simulations actually
+            done is stored in the attribute mc_nsim.
+        nmin : int
+            Minimum number of simulations if rtol is set. Default is the
+            number needed by normal errors, (1.17 / rtol)**2.
+
+        """
+        if fast:
+            return self._mc_errors_fast(nsim, seed, nprocs, chunk, rtol,
+                                        nmin)
         errs = np.zeros((nsim, len(self.error)))
         for i in range(nsim):
             y = self.bestfit + np.random.normal(0, self.noise,
@@ -306,6 +485,44 @@ class pPXF():
         self.error = np.maximum(error, self.error)
         return
 
+    def _mc_errors_fast(self, nsim, seed=None, nprocs=1, chunk=50, rtol=None,
+                        nmin=None):
+        """ Batch version of mc_errors, see its documentation. """
+        rng = np.random.RandomState(seed)
+        noise = np.ones_like(self.galaxy) * self.noise
+        start = [0, self.sol[1]]
+        pool = Pool(nprocs) if nprocs > 1 else None
+        errs = np.zeros((0, len(self.error)))
+        try:
+            while len(errs) < nsim:
+                n = min(chunk, nsim - len(errs))
+                # Noise is drawn in the main process, so that the results
+                # only depend on the seed and not on the number of processes
+                y = self.bestfit + rng.normal(0, self.noise,
+                                              (n, len(self.galaxy)))
+                tasks = [(self.bestfit_unbroad, ys, noise, start,
+                          self.goodpixels, self.vsyst)
+                         for ys in np.array_split(y, max(nprocs, 1))
+                         if len(ys)]
+                if pool is None:
+                    sols = [_mc_batch(task) for task in tasks]
+                else:
+                    sols = pool.map(_mc_batch, tasks)
+                errs = np.vstack([errs] + sols)
+                if rtol is not None and mc_converged(errs, rtol, nmin):
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.mc_nsim = len(errs)
+        median = np.median(errs, axis=0)
+        error = 1.4826 * np.median(np.abs(errs - median), axis=0)
+        # Here I am using always the maximum error between the simulated
+        # and the values given by pPXF.
+        self.error = np.maximum(error, self.error)
+        return
+
     def calc_arrays_emission(self):
         """ Calculate arrays correcting for emission lines. """
         if self.has_emission:
@@ -342,6 +559,15 @@ class pPXF():
             print "Warning: No sky templates for this run."
 
 
+def _mc_batch(task):
+    """ Fit a batch of MC simulations of the same spectrum with ppxf_batch. """
+    template, ys, noise, start, goodpixels, vsyst = task
+    n = len(ys)
+    sim = ppxf_batch(template, ys, [noise] * n, velscale, [start] * n,
+                     goodpixels=[goodpixels] * n, plot=False, moments=4,
+                     degree=-1, mdegree=-1, vsyst=vsyst, quiet=True, bias=0.)
+    return sim.sol
+
 def speclist():
     """ Defines a sorted list of all spectra in FORS2 dataset.
 
@@ -15,14 +15,18 @@ from pandas import expanding_std
 import matplotlib.pyplot as plt
 
 from config import *
+from results_store import MCStore
 
 if __name__ == "__main__":
     os.chdir(os.path.join(home, "single2/mc_logs"))
     cols = np.array([12, 13,16,17,18,19,20])
-    logs = os.listdir(".")
+    Nsim = 400
+    store = MCStore("lick_nsim{0}".format(Nsim), Nsim)
     fig = plt.figure(1, figsize=(5,15))
-    for log in logs:
-        data = np.loadtxt(log).T[cols]
+    for spec, n in zip(store.spectra, store.achieved()):
+        if n == 0:
+            continue
+        data = store.read(spec)[:n].T[cols]
         for i,d in enumerate(data):
             ax = plt.subplot(7,1,i+1)
             ax.plot(expanding_std(d, min_periods=1) / d.std(), "-k")
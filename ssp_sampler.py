@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 18/10/26
+
+@author: cbarbosa
+
+Affine-invariant ensemble sampler for the posterior of the stellar
+population parameters (age, [Z/H], [alpha/Fe]) of many spectra.
+
+The walkers of all spectra in a batch are moved together, so that each
+step needs a single vectorized evaluation of the SSP models (see
+mcmc_model.SSP). Batches of spectra are run in a pool of processes, and the
+chains are kept in one MCStore with an array (nsamples, 3) per spectrum.
+"""
+import copy
+import time
+import hashlib
+import traceback
+from multiprocessing import Pool
+
+import numpy as np
+
+from results_store import MCStore
+
+class SSPPosterior(object):
+    """ Log posterior of the SSP parameters of many spectra, with uniform
+    priors and independent Gaussian errors of the indices. """
+    def __init__(self, ssp, data, errs, ranges):
+        """ ssp returns the indices for arrays of parameters, e.g. an
+        instance of mcmc_model.SSP; data and errs are arrays (nspec, ncols)
+        with the observed indices in the same columns, where NaNs mark the
+        indices not used; ranges is an array (ndim, 2) with the limits of
+        the priors. """
+        self.ssp = ssp
+        data = np.atleast_2d(np.asarray(data, dtype=float))
+        errs = np.atleast_2d(np.asarray(errs, dtype=float))
+        if data.shape != errs.shape:
+            raise ValueError("Data and errors must have the same shape")
+        good = np.isfinite(data) & np.isfinite(errs) & (errs > 0)
+        self.data = np.where(good, data, 0.)
+        self.taus = np.where(good, 1. / np.where(good, errs, 1.)**2, 0.)
+        self.ranges = np.asarray(ranges, dtype=float)
+        self.ndim = len(self.ranges)
+
+    def __call__(self, theta):
+        """ Log posterior of the walkers theta (nspec, nwalkers, ndim), up to
+        a constant for each spectrum. """
+        lp = -np.inf * np.ones(theta.shape[:2])
+        inside = np.all((theta >= self.ranges[:,0]) &
+                        (theta <= self.ranges[:,1]), axis=-1)
+        if not inside.any():
+            return lp
+        spec = np.nonzero(inside)[0]
+        models = self.ssp(*[theta[...,d][inside] for d in range(self.ndim)])
+        taus = self.taus[spec]
+        chi2 = np.sum(np.where(taus > 0, taus * (self.data[spec] -
+                               models)**2, 0.), axis=1)
+        # Models outside the interpolation domain are rejected
+        lp[inside] = np.where(np.isfinite(chi2), -0.5 * chi2, -np.inf)
+        return lp
+
+    def subset(self, idx):
+        """ Posterior of the spectra idx only. """
+        sub = copy.copy(self)
+        sub.data = self.data[idx]
+        sub.taus = self.taus[idx]
+        return sub
+
+class EnsembleSampler(object):
+    """ Affine-invariant ensemble sampler with the stretch move of Goodman &
+    Weare (2010), for independent ensembles of walkers which are moved
+    together, one for each spectrum. """
+    def __init__(self, logp, a=2.):
+        self.logp = logp
+        self.a = a
+
+    def run(self, p0, nsteps, burn=0, thin=1, rng=None):
+        """ Run the ensembles from the initial positions p0, an array
+        (nspec, nwalkers, ndim) with an even number of walkers.
+
+        Returns an array (nspec, nsamples, ndim) with the positions of all
+        walkers after the burn-in, every thin steps, and sets the
+        acceptance fraction of each walker in the attribute acceptance. """
+        rng = np.random.RandomState() if rng is None else rng
+        p = np.array(p0, dtype=float)
+        nspec, nwalkers, ndim = p.shape
+        if nwalkers % 2 or nwalkers < 2 * ndim:
+            raise ValueError("Number of walkers must be even and at least "
+                             "twice the number of dimensions")
+        lp = self.logp(p)
+        halves = [np.arange(nwalkers / 2), np.arange(nwalkers / 2, nwalkers)]
+        rows = np.arange(nspec)[:,np.newaxis]
+        keep = range(burn, nsteps, thin)
+        chain = np.zeros((nspec, len(keep), nwalkers, ndim), dtype=np.float32)
+        accepted = np.zeros((nspec, nwalkers))
+        for step in range(nsteps):
+            # Walkers of each half move with partners from the other half
+            for active, other in (halves, halves[::-1]):
+                n = len(active)
+                z = ((self.a - 1.) * rng.uniform(size=(nspec, n)) + 1)**2 / \
+                    self.a
+                partners = p[:,other][rows, rng.randint(len(other),
+                                                         size=(nspec, n))]
+                q = partners + z[...,np.newaxis] * (p[:,active] - partners)
+                lq = self.logp(q)
+                with np.errstate(invalid="ignore"):
+                    logr = (ndim - 1.) * np.log(z) + lq - lp[:,active]
+                logr[np.isneginf(lp[:,active]) & np.isfinite(lq)] = np.inf
+                acc = np.log(rng.uniform(size=(nspec, n))) < logr
+                p[:,active] = np.where(acc[...,np.newaxis], q, p[:,active])
+                lp[:,active] = np.where(acc, lq, lp[:,active])
+                accepted[:,active] += acc
+            if step >= burn and (step - burn) % thin == 0:
+                chain[:,(step - burn) / thin] = p
+        self.acceptance = accepted / nsteps
+        return chain.reshape(nspec, -1, ndim)
+
+def hpd(x, alpha=0.3173105):
+    """ Highest posterior density interval of the samples x containing a
+    fraction 1 - alpha of the samples. """
+    x = np.sort(x)
+    n = int(np.floor((1 - alpha) * len(x)))
+    widths = x[n:] - x[:len(x) - n]
+    i = np.argmin(widths)
+    return x[i], x[i + n]
+
+def chain_store(basename, nwalkers=32, nsteps=1000, burn=400, thin=4,
+                ndim=3):
+    """ Store of the chains of a run of the sampler. The number of samples
+    of each spectrum depends on nwalkers, nsteps, burn and thin, and an
+    existing store made with other values raises a ValueError; use
+    MCStore(basename) to read a store without knowing them. """
+    nsamples = nwalkers * len(range(burn, nsteps, thin))
+    return MCStore(basename, nsamples, nindex=ndim)
+
+def _batch_seed(spectra, seed):
+    """ Seed of a batch, which only depends on its spectra and on the global
+    seed. """
+    md5 = hashlib.md5(repr((list(spectra), seed)))
+    return int(md5.hexdigest()[:8], 16)
+
+_worker = {}
+
+def _init_worker(posterior, options):
+    """ Keep the posterior in each process of the pool. With fork, the
+    models are inherited from the parent and are not read again. """
+    _worker["posterior"] = posterior
+    _worker["options"] = options
+    return
+
+def _sample_worker(task):
+    """ Sample the posterior of a batch of spectra and write the chains.
+
+    Errors are returned instead of raised, so that one bad batch does not
+    stop the whole run. """
+    spectra, idx, seed = task
+    posterior = _worker["posterior"]
+    nwalkers, nsteps, burn, thin, basename = _worker["options"]
+    t0 = time.time()
+    try:
+        rng = np.random.RandomState(seed)
+        lo, hi = posterior.ranges.T
+        p0 = lo + (hi - lo) * rng.uniform(size=(len(idx), nwalkers,
+                                                posterior.ndim))
+        sampler = EnsembleSampler(posterior.subset(idx))
+        chains = sampler.run(p0, nsteps, burn=burn, thin=thin, rng=rng)
+        store = chain_store(basename, nwalkers, nsteps, burn, thin,
+                            posterior.ndim)
+        for spec, chain in zip(spectra, chains):
+            store.write(spec, 0, chain)
+    except Exception:
+        return spectra, None, traceback.format_exc(), time.time() - t0
+    return spectra, sampler.acceptance.mean(axis=1), None, time.time() - t0
+
+def run_sampler(ssp, spectra, data, errs, ranges, basename, nwalkers=32,
+                nsteps=1000, burn=400, thin=4, batch=16, nprocs=1, seed=0,
+                force=False):
+    """ Sample the posterior of the SSP parameters of a list of spectra.
+
+    ===================
+    Input Parameters
+    ===================
+    ssp, data, errs, ranges :
+        Models, observed indices, errors and limits of the priors, see
+        SSPPosterior.
+    spectra : list
+        Names of the spectra, one for each row of data.
+    basename : str
+        Basename of the files of the store of the chains, see MCStore.
+    nwalkers : int
+        Number of walkers of each spectrum.
+    nsteps, burn, thin : int
+        Number of steps of the walkers, number of steps discarded in the
+        beginning and interval between the steps kept in the chains.
+    batch : int
+        Number of spectra sampled together in each task.
+    nprocs : int
+        Number of processes. The batches are run in the current process if
+        nprocs is 1.
+    seed : int
+        Global seed of the walkers.
+    force : bool
+        Sample all spectra. By default, spectra with chains in the store
+        are skipped.
+
+    ==================
+    Output
+    ==================
+    Returns the store of the chains, with an array (nwalkers * nkeep, ndim)
+    for each spectrum, where nkeep is the number of steps kept.
+    """
+    posterior = SSPPosterior(ssp, data, errs, ranges)
+    store = chain_store(basename, nwalkers, nsteps, burn, thin,
+                        posterior.ndim)
+    store.add(spectra)
+    done = [] if force else store.done()
+    todo = [i for i, spec in enumerate(spectra) if spec not in done]
+    tasks = []
+    for j in range(0, len(todo), batch):
+        idx = np.array(todo[j:j+batch], dtype=int)
+        names = [spectra[i] for i in idx]
+        tasks.append((names, idx, _batch_seed(names, seed)))
+    print "Sampling {0} spectra in {1} batches ({2} unchanged)".format(
+          len(todo), len(tasks), len(spectra) - len(todo))
+    if not tasks:
+        return store
+    ##########################################################################
+    options = (nwalkers, nsteps, burn, thin, basename)
+    if nprocs > 1 and len(tasks) > 1:
+        pool = Pool(nprocs, _init_worker, (posterior, options))
+        outputs = pool.imap_unordered(_sample_worker, tasks)
+    else:
+        pool = None
+        _init_worker(posterior, options)
+        outputs = (_sample_worker(task) for task in tasks)
+    t0 = time.time()
+    nsampled = 0
+    try:
+        for i, (names, acceptance, err, dt) in enumerate(outputs):
+            if err is not None:
+                print "Failed batch {0}:\n{1}".format(", ".join(names), err)
+                continue
+            nsampled += len(names)
+            print "Done batch {0} of {1} in {2:.1f} s, acceptance fraction " \
+                  "{3:.2f}-{4:.2f}".format(i+1, len(tasks), dt,
+                                           acceptance.min(), acceptance.max())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    ##########################################################################
+    # Throughput, counting the evaluations of all steps of the walkers and
+    # the samples kept in the chains
+    dt = time.time() - t0
+    print "Sampled {0} spectra in {1:.1f} s: {2:.0f} posterior evaluations " \
+          "per second, {3:.0f} samples per second".format(nsampled, dt,
+          nsampled * nwalkers * nsteps / dt, nsampled * store.nsim / dt)
+    return store
@@ -16,31 +16,23 @@ from scipy.stats import ks_2samp, anderson_ksamp
 
 from config import *
 from mcmc_analysis import gmm
+from results_store import MCStore
 
-def make_fe_traces(specs):
-    """ Create artificial [Fe/H] traces. """
-    for spec in specs:
-        print spec
-        path = os.path.join(os.getcwd(), spec.replace(".fits", "_db"),
-                                "Chain_0")
-        file1 = os.path.join(path, "alpha_dist.txt")
-        file2 = os.path.join(path, "metal_dist.txt")
-        fileout = os.path.join(path, "iron_dist.txt")
-        d1 = np.loadtxt(file1, usecols=(0,))
-        d2 = np.loadtxt(file2, usecols=(0,))
-        feh = d2 - 0.94 * d1
-        np.savetxt(fileout, feh)
+def read_trace(store, spec, filename):
+    """ Trace of a parameter of a spectrum in the store of the chains (see
+    ssp_sampler), by the name of the file of the old pymc databases. The
+    [Fe/H] trace is derived from the [Z/H] and [alpha/Fe] traces. """
+    ages, metal, alpha = np.array(store.read(spec), dtype=float).T
+    traces = {"age_dist.txt" : ages, "metal_dist.txt" : metal,
+              "alpha_dist.txt" : alpha, "iron_dist.txt" : metal - 0.94 * alpha}
+    return traces[filename]
 
-def get_data(specs, filename):
+def get_data(specs, filename, basename="ssp_chains"):
     """Stack results from traces of a given spectra"""
+    store = MCStore(basename)
+    data = np.zeros((len(specs), store.nsim))
     for i,spec in enumerate(specs):
-        path = os.path.join(os.getcwd(), spec.replace(".fits", "_db"),
-                                "Chain_0")
-        filename = os.path.join(path, filename)
-        d = np.loadtxt(filename, usecols=(0,))
-        if i == 0:
-            data = np.zeros((len(specs), len(d)))
-        data[i] = d
+        data[i] = read_trace(store, spec, filename)
     return data
 
 def mean_errors(table):